@@ -1,16 +1,28 @@
 import streamlit as st
-import pickle
-import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-import faiss
-import re
+
+import time
+from dataclasses import asdict
 
 # === Configuratore: importa le regole
-from rules_configuratore_mk import ConfigInput, genera_distinta
+from rules_configuratore_mk import ConfigInput
+# === Motore dei preventivi: locale (modello in questo processo) o servizio.py
+# se è impostata BALTUR_MOTORE_URL (un solo modello per tutte le repliche della UI)
+from motore import get_motore
+from preventivo import fattore_sconti, messaggio_mancanti, prezza
+# === Tempi per fase (BALTUR_METRICHE=1 o pannello di debug nella sidebar)
+import metriche
 
 st.set_page_config(page_title="Baltur PREVENDITA AI", layout="centered")
 
+# Avvia il caricamento in background mentre l'utente compila il modulo
+motore = get_motore()
+motore.riscalda()
+
+# Pannello di debug: tempi per fase dell'ultimo preventivo di questa sessione
+# (le metriche di processo restano come sono: vedi metriche.richiesta(forza=...))
+debug_tempi = st.sidebar.checkbox("Tempi per fase (debug)", value=metriche.attive())
+
 # Logo grande centrato da file locale
 st.image("baltur_logo.png", width=300)
 
@@ -26,6 +38,7 @@ descrizione = st.text_area(
 )
 
 mostra_netto = st.checkbox("Mostra prezzi netti invece del listino")
+ricerca_rigorosa = st.checkbox("Ricerca rigorosa (tutte le parole devono comparire nel prodotto)")
 
 if mostra_netto:
     sconti = [
@@ -134,138 +147,156 @@ elif macro_value in ("SINGOLO_INT", "SINGOLO_EST"):
 
 # =========================
 # **BOTTONE ORIGINALE** (resta dov’è e fa tutto)
+# La ricerca gira solo qui; risultati e alternative restano in session_state,
+# così cambiare alternativa o sconti non rifà encoding e search.
 # =========================
-if st.button("Genera preventivo"):
-    with open("embeddings.pkl", "rb") as f:
-        data = pickle.load(f)
-
-    df = data["df"]
+n_alternative = st.number_input("Alternative proposte per riga", min_value=1, max_value=10, value=5, step=1)
 
-    testo_completo = (
-        df["Codice"].fillna('').astype(str) + " " +
-        df["Prodotto"].fillna('').astype(str) + " " +
-        df["Descrizione"].fillna('').astype(str)
-    ).str.lower()
+if st.button("Genera preventivo"):
+    with metriche.richiesta("preventivo_app", forza=debug_tempi) as tempi:
+        # Ricerca e distinta devono usare la stessa versione del listino: se è
+        # stato ricaricato tra le due chiamate si rifanno entrambe (una volta)
+        for _ in range(2):
+            # Tutte le voci in una sola chiamata: un solo encode e una sola search
+            ricerca = motore.cerca(
+                descrizione, k=int(n_alternative),
+                modalita="rigorosa" if ricerca_rigorosa else "ibrida",
+            )
+
+            distinta, errore_cfg = None, None
+            if cfg_input is not None:
+                try:
+                    distinta = motore.distinta(asdict(cfg_input))   # righe risolte sul listino + codici mancanti
+                except Exception as e:
+                    errore_cfg = str(e)
+            if distinta is None or distinta["listino"] == ricerca["listino"]:
+                break
+
+    st.session_state["preventivo"] = {
+        "id": st.session_state.get("preventivo", {}).get("id", 0) + 1,
+        "listino": ricerca["listino"],      # versione del listino usata per i prezzi
+        "voci": ricerca["voci"],
+        "distinta": distinta,
+        "errore_cfg": errore_cfg,
+        "tempi": tempi,
+    }
 
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+if "preventivo" in st.session_state:
+    inizio_render = time.perf_counter()
+    preventivo = st.session_state["preventivo"]
+
+    # Prezzi calcolati in blocco (tutte le alternative, tutte le righe della
+    # distinta) con un solo fattore di sconto; qui sotto solo formattazione
+    fattore = fattore_sconti(sconti)
+    prezzi_ricerca = prezza(
+        [alt["prezzo_listino"] for voce in preventivo["voci"] for alt in voce["alternative"]],
+        [voce["quantita"] for voce in preventivo["voci"] for _ in voce["alternative"]],
+        fattore,
+    )
+    righe_distinta = (preventivo["distinta"] or {}).get("righe", [])
+    prezzi_distinta = prezza(
+        [riga["prezzo_listino"] for riga in righe_distinta],
+        [riga["quantita"] for riga in righe_distinta],
+        fattore,
+    )
 
     righe_tabella = []
-    totale_configurazione = 0.0
+    scelte = []         # indice in prezzi_ricerca dell'alternativa scelta per ogni voce
 
     # ======= Parte 1: RICERCA TESTUALE (identica alla tua) =======
-    descrizioni_singole = [s.strip() for s in descrizione.split("+") if s.strip()]
-
-    for singola in descrizioni_singole:
-        query = singola.lower()
-
-        quantita = 1
-
-        quant_match = re.search(r"^\s*(\d+)\s*[xX]\s*", query)
-        if quant_match:
-            quantita = int(quant_match.group(1))
-            query = query[quant_match.end():]
-        else:
-            quant_match = re.search(r"[xX]\s*(\d+)$", query)
-            if quant_match:
-                quantita = int(quant_match.group(1))
-                query = query[:quant_match.start()]
-
-        keywords = [w for w in re.findall(r"\b\w{2,}\b", query) if w not in {"da","in","di","con","e"}]
-        exact_keywords = re.findall(r"'([^']+)'|\"([^\"]+)\"", singola)
-        exact_keywords = [ek[0] or ek[1] for ek in exact_keywords if ek[0] or ek[1]]
-
-        maschera = testo_completo.apply(
-            lambda x: all(k in x for k in keywords) and all(re.search(rf"\b{re.escape(k)}\b", x) for k in exact_keywords)
-        )
-        df_filtrato = df[maschera].copy()
-
-        if df_filtrato.empty:
+    base = 0
+    for n, voce in enumerate(preventivo["voci"]):
+        singola = voce["testo"]
+        quantita = voce["quantita"]
+        alternative = voce["alternative"]
+        inizio = base
+        base += len(alternative)
+
+        if not alternative:
             st.warning(f"Nessun prodotto trovato per: **{singola}**")
             continue
 
-        query_embedding = model.encode([singola])
-        testo_emb = (
-            df_filtrato["Codice"].fillna('').astype(str) + " " +
-            df_filtrato["Prodotto"].fillna('').astype(str) + " " +
-            df_filtrato["Descrizione"].fillna('').astype(str)
-        ).tolist()
-        emb_parziali = model.encode(testo_emb)
-
-        index_parziale = faiss.IndexFlatL2(len(emb_parziali[0]))
-        index_parziale.add(np.array(emb_parziali))
-
-        D, I = index_parziale.search(np.array(query_embedding), 1)
-        idx = I[0][0]
-
-        prodotto = df_filtrato.iloc[idx]
-        prezzo_unitario = prodotto["Prezzo di listino"]
-
-        if mostra_netto:
-            for sconto in sconti:
-                prezzo_unitario *= (1 - sconto / 100)
-
-        prezzo_totale = prezzo_unitario * quantita
-        totale_configurazione += prezzo_totale
+        scelta = 0
+        if len(alternative) > 1:
+            scelta = st.selectbox(
+                f"Prodotto per: {singola}",
+                range(len(alternative)),
+                format_func=lambda j, alt=alternative: (
+                    f"{alt[j]['prodotto']} — {alt[j]['codice']} (punteggio {alt[j]['punteggio']:.2f})"
+                ),
+                key=f"alternativa_{preventivo['id']}_{n}",
+            )
+
+        prodotto = alternative[scelta]
+        scelte.append(inizio + scelta)
+        prezzo_unitario = prezzi_ricerca.prezzo_unitario[inizio + scelta]
+        prezzo_totale = prezzi_ricerca.prezzo_totale[inizio + scelta]
 
         st.markdown(f"""
-        🧾 **{prodotto['Prodotto']}**  
-        **Codice:** `{prodotto['Codice']}`  
+        🧾 **{prodotto['prodotto']}**  
+        **Codice:** `{prodotto['codice']}`  
         **Quantità:** {quantita}  
         **Prezzo unitario:** {prezzo_unitario:,.2f} € ({'netto' if mostra_netto else 'listino'})  
         **Prezzo totale:** {prezzo_totale:,.2f} €  
-        **Descrizione:** {prodotto['Descrizione']}  
+        **Descrizione:** {prodotto['descrizione']}  
         """)
 
         righe_tabella.append({
-            "Codice": prodotto["Codice"],
-            "Prodotto": prodotto["Prodotto"],
+            "Codice": prodotto["codice"],
+            "Prodotto": prodotto["prodotto"],
             "Quantità": quantita,
             "Prezzo unitario": f"{prezzo_unitario:,.2f} €",
             "Prezzo totale": f"{prezzo_totale:,.2f} €"
         })
 
     # ======= Parte 2: DISTINTA dal CONFIGURATORE (se usato) =======
-    if cfg_input is not None:
-        try:
-            distinta = genera_distinta(cfg_input)   # List[LineItem] (code,name,qty)
-            for item in distinta:
-                rec = df[df["Codice"].astype(str) == str(item.code)]
-                if rec.empty:
-                    st.warning(f"Codice non trovato in listino: {item.code} ({item.name})")
-                    continue
-                prodotto_row = rec.iloc[0]
-
-                prezzo_unitario = prodotto_row["Prezzo di listino"]
-                if mostra_netto:
-                    for sconto in sconti:
-                        prezzo_unitario *= (1 - sconto / 100)
-
-                prezzo_totale = prezzo_unitario * item.qty
-                totale_configurazione += prezzo_totale
-
-                # stampa breve (coerente con la parte sopra)
-                st.markdown(f"""
-                🧾 **{prodotto_row['Prodotto']}**  
-                **Codice:** `{prodotto_row['Codice']}`  
-                **Quantità:** {item.qty}  
-                **Prezzo unitario:** {prezzo_unitario:,.2f} € ({'netto' if mostra_netto else 'listino'})  
-                **Prezzo totale:** {prezzo_totale:,.2f} €  
-                **Descrizione:** {prodotto_row['Descrizione']}  
-                """)
-
-                righe_tabella.append({
-                    "Codice": prodotto_row["Codice"],
-                    "Prodotto": prodotto_row["Prodotto"],
-                    "Quantità": item.qty,
-                    "Prezzo unitario": f"{prezzo_unitario:,.2f} €",
-                    "Prezzo totale": f"{prezzo_totale:,.2f} €"
-                })
-        except Exception as e:
-            st.error(f"Configuratore: {e}")
+    if preventivo["errore_cfg"] is not None:
+        st.error(f"Configuratore: {preventivo['errore_cfg']}")
+    elif preventivo["distinta"] is not None:
+        distinta = preventivo["distinta"]
+        if distinta["mancanti"]:
+            st.warning(messaggio_mancanti([(m["codice"], m["nome"]) for m in distinta["mancanti"]]))
+
+        for i, riga in enumerate(distinta["righe"]):
+            prezzo_unitario = prezzi_distinta.prezzo_unitario[i]
+            prezzo_totale = prezzi_distinta.prezzo_totale[i]
+
+            # stampa breve (coerente con la parte sopra)
+            st.markdown(f"""
+            🧾 **{riga['prodotto']}**  
+            **Codice:** `{riga['codice']}`  
+            **Quantità:** {riga['quantita']}  
+            **Prezzo unitario:** {prezzo_unitario:,.2f} € ({'netto' if mostra_netto else 'listino'})  
+            **Prezzo totale:** {prezzo_totale:,.2f} €  
+            **Descrizione:** {riga['descrizione']}  
+            """)
+
+            righe_tabella.append({
+                "Codice": riga["codice"],
+                "Prodotto": riga["prodotto"],
+                "Quantità": riga["quantita"],
+                "Prezzo unitario": f"{prezzo_unitario:,.2f} €",
+                "Prezzo totale": f"{prezzo_totale:,.2f} €"
+            })
 
     # ======= Riepilogo finale (come già facevi) =======
+    totale_configurazione = float(prezzi_ricerca.prezzo_totale[scelte].sum()) + prezzi_distinta.totale()
     if righe_tabella:
         st.subheader("📊 Riepilogo preventivo")
         df_tabella = pd.DataFrame(righe_tabella)
         st.table(df_tabella)
         st.markdown(f"**Totale configurazione:** {totale_configurazione:,.2f} €")
+        st.caption(f"Listino {preventivo['listino'][:12]}")
+
+    # ======= Tempi per fase (pannello di debug) =======
+    durata_render = time.perf_counter() - inizio_render
+    if metriche.attive():
+        metriche.osserva("fase", "render", durata_render)
+    if debug_tempi:
+        tempi = dict(preventivo.get("tempi") or {}, render=durata_render)
+        with st.sidebar.expander("⏱️ Tempi ultimo preventivo", expanded=True):
+            st.table(pd.DataFrame(
+                [{"Fase": fase, "ms": round(secondi * 1000, 2)} for fase, secondi in tempi.items()]
+            ))
+            st.caption("Fasi annidate: i tempi di cerca/distinta includono le loro sotto-fasi.")
+            st.code(motore.metriche(), language="text")    # istogrammi del processo del motore
@@ -0,0 +1,300 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+from functools import cached_property
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import faiss
+
+from bm25 import B, K1, IndiceBM25, pesi_bm25, pesi_bm25_fetta
+from indice_token import IndiceToken
+from indici import INFO_LEGACY, dtype_vettori
+from listino import testo_catalogo
+
+# =========================
+# Artefatto dell'indice: una cartella versionata con manifest
+#   manifest.json      versione schema, encoder, dimensione, hash del contenuto
+#   vettori.npy        embedding float32, o float16 con vettori compressi (mmap)
+#   indice.faiss       indice FAISS, serializzatore nativo (mmap dove supportato)
+#   catalogo.parquet   colonne del listino in formato colonnare
+#   hash_righe.npy     hash del testo embeddato di ogni riga (rebuild incrementale)
+#   token_*            indice invertito per il filtro parole chiave
+#   bm25_pesi.npy      pesi BM25 allineati alle posting list dei token
+#   shard/<famiglia>/  (build con --shard) indice FAISS, indice token e pesi
+#                      BM25 delle righe [inizio, fine) di una famiglia di prodotto
+#                      (BM25 con le statistiche dell'intero listino)
+#   shard_centroidi.npy  direzione media dei vettori di ogni shard (router)
+# I file aperti in mmap condividono le pagine tra i processi worker tramite la
+# page cache del sistema operativo.
+# =========================
+SCHEMA_VERSIONE = 2
+SCHEMI_LEGGIBILI = {1, 2}      # schema 1: senza tipo di indice, sempre flat-l2
+FILE_MANIFEST = "manifest.json"
+FILE_VETTORI = "vettori.npy"
+FILE_INDICE = "indice.faiss"
+FILE_CATALOGO = "catalogo.parquet"
+FILE_HASH_RIGHE = "hash_righe.npy"
+FILE_BM25 = "bm25_pesi.npy"
+CARTELLA_SHARD = "shard"
+FILE_CENTROIDI = "shard_centroidi.npy"
+
+
+def hash_righe(testi) -> np.ndarray:
+    # Impronta del testo embeddato di ogni riga (Codice + Prodotto + Descrizione):
+    # righe con lo stesso hash hanno lo stesso vettore e non vanno ricalcolate.
+    return np.array([hashlib.sha1(t.encode("utf-8")).hexdigest() for t in testi], dtype="S40")
+
+
+def _sha256_file(percorso: str) -> str:
+    h = hashlib.sha256()
+    with open(percorso, "rb") as f:
+        for blocco in iter(lambda: f.read(1 << 20), b""):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _hash_contenuto(hash_file: Dict[str, str]) -> str:
+    h = hashlib.sha256()
+    for nome in sorted(hash_file):
+        h.update(f"{nome}:{hash_file[nome]}\n".encode())
+    return h.hexdigest()
+
+
+def _leggi_indice(percorso: str) -> faiss.Index:
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(percorso, flag)
+    except RuntimeError:
+        # tipo di indice senza supporto mmap: lettura completa
+        return faiss.read_index(percorso)
+
+
+def _salva_parti(cartella: str, index: faiss.Index, indice_token: IndiceToken, pesi: np.ndarray) -> List[str]:
+    # Indice FAISS, indice token e pesi BM25: per l'artefatto e per ogni shard
+    faiss.write_index(index, os.path.join(cartella, FILE_INDICE))
+    file_token = indice_token.salva(cartella)
+    np.save(os.path.join(cartella, FILE_BM25), pesi)
+    return [FILE_INDICE, FILE_BM25] + file_token
+
+
+def salva_artefatto(
+    cartella: str,
+    df: pd.DataFrame,
+    vettori: np.ndarray,
+    index: faiss.Index,
+    indice_token: IndiceToken,
+    modello: str,
+    info_indice: Optional[Dict] = None,
+    encoder: str = "fp32",
+    shard: Optional[List[Dict]] = None,
+) -> dict:
+    # shard: dict con nome, inizio, fine, parole, indice (info), index,
+    # indice_token e centroide, nell'ordine delle righe (vedi famiglie.py)
+    # Scrive in una cartella temporanea e poi la sostituisce a quella esistente,
+    # così chi legge non vede mai un artefatto a metà.
+    cartella = os.path.abspath(cartella)
+    tmp = f"{cartella}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    info_indice = info_indice or dict(INFO_LEGACY)
+    vettori = np.ascontiguousarray(vettori, dtype=dtype_vettori(info_indice))
+    np.save(os.path.join(tmp, FILE_VETTORI), vettori)
+    df.to_parquet(os.path.join(tmp, FILE_CATALOGO), index=False)
+    np.save(os.path.join(tmp, FILE_HASH_RIGHE), hash_righe(testo_catalogo(df).tolist()))
+    pesi = pesi_bm25(indice_token)
+    nomi: List[str] = [FILE_VETTORI, FILE_CATALOGO, FILE_HASH_RIGHE] + _salva_parti(tmp, index, indice_token, pesi)
+
+    info_shard = []
+    for s in shard or ():
+        relativa = f"{CARTELLA_SHARD}/{s['nome']}"
+        os.makedirs(os.path.join(tmp, relativa))
+        pesi_shard = pesi_bm25_fetta(indice_token, pesi, s["indice_token"], s["inizio"])
+        parti = _salva_parti(os.path.join(tmp, relativa), s["index"], s["indice_token"], pesi_shard)
+        nomi += [f"{relativa}/{nome}" for nome in parti]
+        info_shard.append({k: s[k] for k in ("nome", "inizio", "fine", "parole", "indice")})
+    if info_shard:
+        np.save(os.path.join(tmp, FILE_CENTROIDI), np.stack([s["centroide"] for s in shard]).astype("float32"))
+        nomi.append(FILE_CENTROIDI)
+
+    hash_file = {nome: _sha256_file(os.path.join(tmp, nome)) for nome in nomi}
+    manifest = {
+        "schema": SCHEMA_VERSIONE,
+        "modello": modello,                 # nome dell'encoder (encoder.nome_encoder)
+        "encoder": encoder,
+        "dim": int(vettori.shape[1]),
+        "n_righe": int(len(df)),
+        "indice": info_indice,
+        "bm25": {"k1": K1, "b": B},
+        "shard": info_shard,
+        "creato": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "file": hash_file,
+        "hash": _hash_contenuto(hash_file),
+    }
+    with open(os.path.join(tmp, FILE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    vecchia = f"{cartella}.old"
+    shutil.rmtree(vecchia, ignore_errors=True)
+    if os.path.exists(cartella):
+        os.replace(cartella, vecchia)
+    os.replace(tmp, cartella)
+    shutil.rmtree(vecchia, ignore_errors=True)
+    return manifest
+
+
+def hash_manifest(cartella: str) -> Optional[str]:
+    # Versione dell'artefatto su disco senza aprirlo (None = manifest assente o
+    # illeggibile, es. durante la sostituzione della cartella in salva_artefatto)
+    try:
+        with open(os.path.join(cartella, FILE_MANIFEST), encoding="utf-8") as f:
+            return json.load(f).get("hash")
+    except (OSError, ValueError):
+        return None
+
+
+class Artefatto:
+    # Apre solo il manifest; vettori, indice, catalogo e indice token sono
+    # caricati al primo accesso.
+    def __init__(self, cartella: str, modello: Optional[str] = None):
+        self.cartella = cartella
+        with open(self._percorso(FILE_MANIFEST), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("schema") not in SCHEMI_LEGGIBILI:
+            raise ValueError(
+                f"Artefatto '{cartella}' con schema {self.manifest.get('schema')}, "
+                f"atteso {SCHEMA_VERSIONE}: rieseguire build_index.py"
+            )
+        if modello is not None and self.manifest["modello"] != modello:
+            # vettori di encoder diversi non sono confrontabili: niente indici misti
+            raise ValueError(
+                f"Artefatto '{cartella}' costruito con l'encoder {self.manifest['modello']} "
+                f"({self.encoder}), non con {modello}: rieseguire build_index.py con lo stesso "
+                f"--encoder usato a runtime (BALTUR_ENCODER)"
+            )
+
+    def _percorso(self, nome: str) -> str:
+        return os.path.join(self.cartella, nome)
+
+    @property
+    def hash(self) -> str:
+        return self.manifest["hash"]
+
+    @property
+    def encoder(self) -> str:
+        return self.manifest.get("encoder", "fp32")    # artefatti precedenti: sempre fp32
+
+    @property
+    def info_indice(self) -> Dict:
+        info = self.manifest.get("indice")
+        return info if isinstance(info, dict) else INFO_LEGACY
+
+    @cached_property
+    def vettori(self) -> np.ndarray:
+        return np.load(self._percorso(FILE_VETTORI), mmap_mode="r")
+
+    @cached_property
+    def index(self) -> faiss.Index:
+        return _leggi_indice(self._percorso(FILE_INDICE))
+
+    @cached_property
+    def df(self) -> pd.DataFrame:
+        return pd.read_parquet(self._percorso(FILE_CATALOGO))
+
+    @cached_property
+    def testo_completo(self) -> pd.Series:
+        return testo_catalogo(self.df)
+
+    @cached_property
+    def hash_righe(self) -> np.ndarray:
+        if FILE_HASH_RIGHE in self.manifest["file"]:
+            return np.load(self._percorso(FILE_HASH_RIGHE))
+        return hash_righe(self.testo_completo.tolist())   # artefatti precedenti
+
+    @cached_property
+    def indice_token(self) -> IndiceToken:
+        return IndiceToken.carica(self.cartella, self.testo_completo.tolist())
+
+    @cached_property
+    def bm25(self) -> IndiceBM25:
+        if FILE_BM25 in self.manifest["file"]:
+            pesi = np.load(self._percorso(FILE_BM25), mmap_mode="r")
+        else:
+            pesi = pesi_bm25(self.indice_token)   # artefatti precedenti
+        return IndiceBM25(self.indice_token, pesi)
+
+    @cached_property
+    def shard(self) -> List["Shard"]:
+        return [Shard(self, s) for s in self.manifest.get("shard", [])]    # [] = artefatto senza shard
+
+    @cached_property
+    def centroidi(self) -> np.ndarray:
+        return np.load(self._percorso(FILE_CENTROIDI))
+
+    def verifica(self) -> bool:
+        # Ricalcola gli hash dei file (lettura completa: solo per controlli espliciti)
+        hash_file = {nome: _sha256_file(self._percorso(nome)) for nome in self.manifest["file"]}
+        return hash_file == self.manifest["file"] and _hash_contenuto(hash_file) == self.hash
+
+
+class Shard:
+    # Una famiglia di prodotto: righe [inizio, fine) del listino, con indice
+    # FAISS, indice token e BM25 propri (posizioni locali allo shard).
+    # Vettori e testi sono fette di quelli dell'artefatto: niente copie.
+    # Stessi attributi dell'artefatto usati da ricerca.py.
+    def __init__(self, artefatto: Artefatto, info: Dict):
+        self.artefatto = artefatto
+        self.nome: str = info["nome"]
+        self.inizio: int = info["inizio"]
+        self.fine: int = info["fine"]
+        self.parole: List[str] = info["parole"]
+        self.info_indice: Dict = info["indice"]
+        self.cartella = artefatto._percorso(f"{CARTELLA_SHARD}/{self.nome}")
+
+    @property
+    def vettori(self) -> np.ndarray:
+        return self.artefatto.vettori[self.inizio:self.fine]
+
+    @cached_property
+    def index(self) -> faiss.Index:
+        return _leggi_indice(os.path.join(self.cartella, FILE_INDICE))
+
+    @cached_property
+    def indice_token(self) -> IndiceToken:
+        return IndiceToken.carica(self.cartella, self.artefatto.testo_completo[self.inizio:self.fine].tolist())
+
+    @cached_property
+    def bm25(self) -> IndiceBM25:
+        return IndiceBM25(self.indice_token, np.load(os.path.join(self.cartella, FILE_BM25), mmap_mode="r"))
+
+    def precarica(self) -> None:
+        for nome in ("index", "indice_token", "bm25"):
+            getattr(self, nome)
+
+
+def converti_pickle(percorso_pkl: str, cartella: str, modello: str) -> dict:
+    # Migrazione dal vecchio embeddings.pkl monolitico, senza ricalcolare gli embedding
+    import pickle
+    with open(percorso_pkl, "rb") as f:
+        data = pickle.load(f)
+    df = data["df"]
+    indice_token = data.get("indice_token")
+    if indice_token is None:
+        indice_token = IndiceToken.costruisci(testo_catalogo(df).tolist())
+    return salva_artefatto(cartella, df, data["embeddings"], data["index"], indice_token, modello, INFO_LEGACY)
+
+
+if __name__ == "__main__":
+    # python artefatto.py embeddings.pkl [cartella]
+    from encoder import NOME_MODELLO
+    from risorse import PERCORSO_ARTEFATTO
+    sorgente = sys.argv[1] if len(sys.argv) > 1 else "embeddings.pkl"
+    destinazione = sys.argv[2] if len(sys.argv) > 2 else PERCORSO_ARTEFATTO
+    m = converti_pickle(sorgente, destinazione, NOME_MODELLO)
+    print(f"✅ Artefatto scritto in '{destinazione}' ({m['n_righe']} righe, hash {m['hash'][:12]})")
@@ -0,0 +1,474 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import replace
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import build_index
+import rules_configuratore_mk as regole
+import tabella_configuratore
+from artefatto import Artefatto
+from cache_embedding import CacheEmbedding
+from encoder import TIPI_ENCODER, crea_encoder
+from indici import normalizza
+from listino import IndiceCodici, testo_catalogo
+from preventivo import fattore_sconti, prezza_codici
+from ricerca import MODALITA, cerca_voci, parse_descrizione
+from risorse import ENCODER_MAX_ATTESA_MS, ENCODER_MAX_BATCH, Risorse
+from scheduler_encoder import SchedulerEncoder
+
+# =========================
+# Benchmark di build, caricamento, ricerca e configuratore
+#   python benchmark.py --righe 1000 10000 100000 --output bench.json
+#   python benchmark.py --confronta bench_prima.json bench_dopo.json
+#   python benchmark.py --confronta-encoder prodotti.xlsx --output encoder.json
+# Listini sintetici con lo schema reale (Codice, Prodotto, Prezzo di listino,
+# Descrizione) e, di default, l'encoder hash (encoder.py, senza modello): gira
+# offline e i numeri sono confrontabili tra commit sulla stessa macchina.
+#   build         ingest Excel -> parquet, build completo, build incrementale
+#                 (nessuna riga cambiata)
+#   caricamento   apertura dell'artefatto e di tutte le sue parti: freddo = primo
+#                 caricamento nel processo (i file possono essere nella page
+#                 cache), caldo = mediana dei caricamenti successivi
+#   ricerca       parse_descrizione + cerca_voci di app.py, una voce per query,
+#                 cache query vuota e poi piena
+#                 (--shard: artefatti per famiglia, ricerca tramite il router)
+#   configuratore genera_distinta su tutte le configurazioni MK (regole e
+#                 tabella) e prezzatura delle distinte sul listino sintetico
+#   encoder       (--confronta-encoder) fp32/int8/hash sul listino reale, vedi sotto
+# =========================
+VERSIONE_BENCHMARK = 1
+CARTELLA_BENCHMARK = ".benchmark"
+PARTI_ARTEFATTO = ("df", "vettori", "index", "indice_token", "bm25")
+
+
+# =========================
+# Listino sintetico
+# =========================
+FAMIGLIE = (
+    "POMPA", "CIRCOLATORE", "ACCUMULO", "BOLLITORE", "VALVOLA", "BRUCIATORE", "CALDAIA",
+    "COLLETTORE", "SCAMBIATORE", "CENTRALINA", "TERMOSTATO", "KIT TUBI", "VASO ESPANSIONE",
+    "FILTRO", "SONDA", "TERMINALE", "RACCORDO", "FLANGIA", "PANNELLO", "QUADRO",
+)
+QUALIFICHE = (
+    "INOX", "3VIE", "MODULANTE", "GAS", "GASOLIO", "SOLARE", "ORIZZ.", "VERT.", "DX", "SX",
+    "DN65", "DN100", '1"', '3/4"', "ENERGY", "PRO", "SL", "MAX", "MK", "TK",
+)
+PAROLE = (
+    "per", "installazione", "interna", "esterna", "kit", "completo", "di", "attacchi", "flangiati",
+    "acciaio", "inox", "rame", "potenza", "nominale", "portata", "pressione", "massima", "bar",
+    "alimentazione", "elettrica", "monofase", "trifase", "regolazione", "climatica", "sonda",
+    "esterna", "modulo", "box", "caldaia", "condensazione", "bruciatore", "gas", "metano", "gpl",
+    "gasolio", "accumulo", "acqua", "calda", "sanitaria", "serpentino", "solare", "isolamento",
+    "poliuretano", "valvola", "sicurezza", "inail", "collettore", "fumi", "scarico", "condensa",
+)
+
+
+def catalogo_sintetico(righe: int, seed: int = 0) -> pd.DataFrame:
+    # Prime righe: i codici del configuratore MK (così la prezzatura delle
+    # distinte trova i suoi articoli), poi righe casuali ma riproducibili.
+    rng = np.random.default_rng(seed)
+    mk = list(dict.fromkeys(regole.C.values()))[:righe]
+    n = righe - len(mk)
+    nomi_mk = {codice: chiave.replace("_", " ") for chiave, codice in regole.C.items()}
+
+    codici = (40_000_000 + rng.permutation(n * 10)[:n]).astype(str).tolist()
+    famiglie = rng.integers(len(FAMIGLIE), size=n)
+    qualifiche = rng.integers(len(QUALIFICHE), size=n)
+    taglie = rng.choice([25, 32, 50, 80, 100, 150, 200, 300, 500, 800, 1000], size=n)
+    lunghezze = rng.integers(6, 15, size=n)
+    parole = rng.integers(len(PAROLE), size=(n, 14))
+    senza_descrizione = rng.random(n) < 0.1
+
+    prodotti = [f"{FAMIGLIE[f]} {QUALIFICHE[q]} {t}" for f, q, t in zip(famiglie, qualifiche, taglie)]
+    descrizioni = [
+        None if vuota else " ".join(PAROLE[p] for p in riga[:lunghezza])
+        for vuota, riga, lunghezza in zip(senza_descrizione, parole, lunghezze)
+    ]
+    prezzi = np.round(rng.lognormal(5.0, 1.2, size=righe), 2)
+    return pd.DataFrame({
+        "Codice": mk + codici,
+        "Prodotto": [nomi_mk[c] for c in mk] + prodotti,
+        "Prezzo di listino": prezzi,
+        "Descrizione": [None] * len(mk) + descrizioni,
+    })
+
+
+def query_sintetiche(df: pd.DataFrame, n: int, seed: int = 1) -> List[str]:
+    # Una voce per query, dal nome prodotto di righe a caso più una parola
+    # della descrizione; tutte diverse (la prima passata non trova la cache)
+    rng = np.random.default_rng(seed)
+    pos = rng.choice(len(df), size=min(n * 3, len(df)), replace=False)
+    query: Dict[str, None] = {}
+    for p in pos.tolist():
+        prodotto = str(df["Prodotto"].iat[p]).lower()
+        descrizione = df["Descrizione"].iat[p]
+        parole = descrizione.split() if isinstance(descrizione, str) else []
+        extra = parole[int(rng.integers(min(3, len(parole))))] if parole else ""
+        query.setdefault(f"{int(rng.integers(1, 4))}x {prodotto} {extra}".strip())
+        if len(query) == n:
+            break
+    return list(query)
+
+
+# =========================
+# Misure
+# =========================
+def _statistiche_ms(tempi: Sequence[float]) -> Dict[str, float]:
+    ms = np.asarray(tempi) * 1000
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "media_ms": float(ms.mean()),
+    }
+
+
+def misura_build(xlsx: str, cartella: str, indice: str, encoder: str, shard: bool = False) -> Dict[str, float]:
+    cache = os.path.join(cartella, "cache")
+    artefatto = os.path.join(cartella, "indice")
+    shutil.rmtree(cache, ignore_errors=True)
+    t = time.perf_counter()
+    build_index.leggi_listino(xlsx, cache)
+    ingest = time.perf_counter() - t
+
+    argv = [
+        "--input", xlsx, "--output", artefatto, "--cache", cache, "--indice", indice,
+        "--encoder", encoder, "--report-query", "0",
+    ] + (["--shard"] if shard else [])
+    with redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        build_index.costruisci(build_index.parse_args(argv + ["--completo"]))
+        completo = time.perf_counter() - t
+        t = time.perf_counter()
+        build_index.costruisci(build_index.parse_args(argv))
+        incrementale = time.perf_counter() - t
+    return {"ingest_s": ingest, "build_s": completo, "build_incrementale_s": incrementale}
+
+
+def _carica(cartella: str, modello: Optional[str] = None) -> Artefatto:
+    artefatto = Artefatto(cartella, modello=modello)
+    for nome in PARTI_ARTEFATTO:
+        getattr(artefatto, nome)
+    for shard in artefatto.shard:
+        shard.precarica()
+    IndiceCodici.costruisci(artefatto.df)
+    return artefatto
+
+
+def misura_caricamento(cartella: str, ripetizioni: int = 5) -> Dict[str, float]:
+    t = time.perf_counter()
+    _carica(cartella)
+    freddo = time.perf_counter() - t
+    caldi = []
+    for _ in range(ripetizioni):
+        t = time.perf_counter()
+        _carica(cartella)
+        caldi.append(time.perf_counter() - t)
+    return {"carica_freddo_s": freddo, "carica_caldo_s": float(np.median(caldi))}
+
+
+def misura_ricerca(risorse: Risorse, query: Sequence[str], k: int = 5) -> Dict[str, Dict[str, float]]:
+    # Latenza per voce con la cache query vuota (ogni modalità parte da zero) e
+    # piena. Include l'attesa del micro-batching dell'encoder, come in app.py.
+    def passata(r: Risorse, modalita: str) -> Dict[str, float]:
+        tempi = []
+        for q in query:
+            t = time.perf_counter()
+            cerca_voci(r, parse_descrizione(q), k=k, modalita=modalita)
+            tempi.append(time.perf_counter() - t)
+        return _statistiche_ms(tempi)
+
+    out = {}
+    for modalita in MODALITA:
+        r = replace(risorse, cache_query=CacheEmbedding("benchmark", max(2048, len(query)), None))
+        out[modalita] = passata(r, modalita)
+    out["ibrida_cache"] = passata(r, "ibrida")       # stesse query, embedding già in cache
+    return out
+
+
+def misura_configuratore() -> Dict[str, float]:
+    cfgs = list(tabella_configuratore.enumera_input())
+
+    t = time.perf_counter()
+    for cfg in cfgs:
+        try:
+            regole._genera_distinta(cfg)
+        except ValueError:
+            pass
+    regole_s = time.perf_counter() - t
+
+    t = time.perf_counter()
+    tabella_configuratore.leggi_tabella()
+    caricamento = time.perf_counter() - t
+    tabella_configuratore.get_tabella()
+
+    t = time.perf_counter()
+    for cfg in cfgs:
+        try:
+            tabella_configuratore.genera_distinta(cfg)
+        except ValueError:
+            pass
+    tabella_s = time.perf_counter() - t
+    return {
+        "configurazioni": len(cfgs),
+        "regole_per_s": len(cfgs) / regole_s,
+        "tabella_per_s": len(cfgs) / tabella_s,
+        "tabella_caricamento_s": caricamento,
+    }
+
+
+def misura_prezzatura(codici: IndiceCodici, sconti: Sequence[float] = (50, 10, 5)) -> Dict[str, float]:
+    # Tutte le distinte valide del configuratore prezzate in un solo passaggio
+    distinte = [d for d in tabella_configuratore.get_tabella().values() if not isinstance(d, str)]
+    articoli = [item.code for d in distinte for item in d]
+    quantita = [item.qty for d in distinte for item in d]
+    t = time.perf_counter()
+    prezza_codici(codici, articoli, quantita, fattore_sconti(sconti))
+    secondi = time.perf_counter() - t
+    return {"distinte": len(distinte), "righe": len(articoli), "righe_per_s": len(articoli) / secondi}
+
+
+def benchmark_listino(righe: int, args, encoder) -> Dict[str, object]:
+    cartella = os.path.join(args.cartella, f"listino_{righe}")
+    os.makedirs(cartella, exist_ok=True)
+    xlsx = os.path.join(cartella, f"listino_{righe}_{args.seed}.xlsx")
+    risultato: Dict[str, object] = {}
+    if not os.path.exists(xlsx):
+        t = time.perf_counter()
+        catalogo_sintetico(righe, args.seed).to_excel(xlsx, index=False)
+        risultato["genera_s"] = time.perf_counter() - t
+
+    risultato.update(misura_build(xlsx, cartella, args.indice, encoder.tipo, args.shard))
+    artefatto = os.path.join(cartella, "indice")
+    risultato.update(misura_caricamento(artefatto))
+
+    a = _carica(artefatto, modello=encoder.nome)
+    risorse = Risorse(
+        model=encoder,
+        artefatto=a,
+        cache_query=CacheEmbedding("benchmark", 2048, None),
+        encoder=SchedulerEncoder(encoder, ENCODER_MAX_BATCH, ENCODER_MAX_ATTESA_MS),
+    )
+    risultato["ricerca"] = misura_ricerca(risorse, query_sintetiche(a.df, args.query, args.seed + 1))
+    risultato["prezzatura"] = misura_prezzatura(risorse.codici)
+    return risultato
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def esegui(args) -> dict:
+    encoder = crea_encoder(args.encoder)
+    risultati = {
+        "versione": VERSIONE_BENCHMARK,
+        "commit": _commit(),
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpu": os.cpu_count(),
+        "encoder": args.encoder,
+        "indice": args.indice,
+        "shard": args.shard,
+        "query": args.query,
+        "configuratore": misura_configuratore(),
+        "listini": {},
+    }
+    print(f"configuratore: {risultati['configuratore']}", file=sys.stderr)
+    for righe in args.righe:
+        t = time.perf_counter()
+        risultati["listini"][str(righe)] = benchmark_listino(righe, args, encoder)
+        print(f"listino {righe} righe: {time.perf_counter() - t:.1f}s", file=sys.stderr)
+    return risultati
+
+
+# =========================
+# Confronto tra encoder sul listino reale
+#   python benchmark.py --confronta-encoder prodotti.xlsx --tipi fp32 int8 hash
+# Ogni encoder in un processo nuovo (spawn), così la memoria misurata è la sua.
+#   carica_s               caricamento dell'encoder
+#   rss_mb                 memoria residente dopo il caricamento (rss_encoder_mb: la
+#                          parte dovuta all'encoder), rss_picco_mb: picco del processo
+#   catalogo_righe_per_s   encode di tutto il listino (come build_index.py)
+#   query                  latenza di encode di una query alla volta (come app.py)
+#   accordo_top1_fp32      frazione di query con lo stesso primo risultato di fp32
+#                          (ricerca densa esatta, coseno, sul listino embeddato
+#                          dallo stesso encoder)
+# =========================
+def _memoria_mb(campo: str) -> Optional[float]:
+    # VmRSS / VmHWM da /proc (Linux); None altrove
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for riga in f:
+                if riga.startswith(campo + ":"):
+                    return int(riga.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _misura_encoder(tipo: str, testi: Sequence[str], query: Sequence[str], batch_size: int) -> Dict[str, object]:
+    rss_base = _memoria_mb("VmRSS")
+    t = time.perf_counter()
+    encoder = crea_encoder(tipo)
+    carica = time.perf_counter() - t
+    rss = _memoria_mb("VmRSS")
+    encoder.encode(list(query[:8]), batch_size=batch_size)       # riscaldamento
+
+    t = time.perf_counter()
+    vettori = normalizza(encoder.encode(list(testi), batch_size=batch_size))
+    catalogo = time.perf_counter() - t
+
+    tempi = []
+    for q in query:
+        t = time.perf_counter()
+        encoder.encode([q])
+        tempi.append(time.perf_counter() - t)
+
+    vq = normalizza(encoder.encode(list(query), batch_size=batch_size))
+    return {
+        "nome": encoder.nome,
+        "carica_s": carica,
+        "rss_mb": rss,
+        "rss_encoder_mb": None if rss is None or rss_base is None else rss - rss_base,
+        "rss_picco_mb": _memoria_mb("VmHWM"),
+        "catalogo_righe_per_s": len(testi) / catalogo,
+        "query": _statistiche_ms(tempi),
+        "top1": np.argmax(vq @ vettori.T, axis=1).tolist(),
+    }
+
+
+def confronta_encoder(xlsx: str, tipi: Sequence[str], n_query: int, seed: int, cartella: str) -> dict:
+    df = build_index.leggi_listino(xlsx, os.path.join(cartella, "cache"))
+    testi = testo_catalogo(df).tolist()
+    query = query_sintetiche(df, n_query, seed)
+    contesto = multiprocessing.get_context("spawn")
+    encoder: Dict[str, Dict[str, object]] = {}
+    for tipo in tipi:
+        t = time.perf_counter()
+        with ProcessPoolExecutor(1, mp_context=contesto) as pool:
+            try:
+                encoder[tipo] = pool.submit(_misura_encoder, tipo, testi, query, 64).result()
+            except Exception as e:      # es. modello non scaricabile in un ambiente isolato
+                encoder[tipo] = {"errore": f"{type(e).__name__}: {e}"}
+        print(f"encoder {tipo}: {time.perf_counter() - t:.1f}s", file=sys.stderr)
+
+    riferimento = encoder.get("fp32", {}).get("top1")
+    for risultato in encoder.values():
+        top1 = risultato.pop("top1", None)
+        if riferimento is not None and top1 is not None:
+            risultato["accordo_top1_fp32"] = float(np.mean(np.equal(top1, riferimento)))
+    return {
+        "versione": VERSIONE_BENCHMARK,
+        "commit": _commit(),
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpu": os.cpu_count(),
+        "listino": os.path.basename(xlsx),
+        "righe": len(df),
+        "query": len(query),
+        "encoder": encoder,
+    }
+
+
+def _cifra(valore: Optional[float], larghezza: int, decimali: int) -> str:
+    return f"{valore:>{larghezza}.{decimali}f}" if valore is not None else f"{'-':>{larghezza}}"
+
+
+def stampa_encoder(risultati: dict) -> None:
+    print(f"{'encoder':<8} {'carica s':>9} {'RSS MB':>8} {'righe/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'top1 fp32':>10}")
+    for tipo, r in risultati["encoder"].items():
+        if "errore" in r:
+            print(f"{tipo:<8} {r['errore']}")
+            continue
+        print(f"{tipo:<8} {r['carica_s']:>9.2f} {_cifra(r['rss_mb'], 8, 0)} {r['catalogo_righe_per_s']:>10.0f} "
+              f"{r['query']['p50_ms']:>8.2f} {r['query']['p99_ms']:>8.2f} "
+              f"{_cifra(r.get('accordo_top1_fp32'), 10, 3)}")
+
+
+# =========================
+# Confronto tra due file di risultati
+# =========================
+def _appiattisci(dati, prefisso: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for chiave, valore in dati.items():
+        nome = f"{prefisso}{chiave}"
+        if isinstance(valore, dict):
+            out.update(_appiattisci(valore, nome + "."))
+        elif isinstance(valore, (int, float)) and not isinstance(valore, bool):
+            out[nome] = float(valore)
+    return out
+
+
+def confronta(prima: dict, dopo: dict, soglia: float = 10.0) -> List[str]:
+    # Metriche in comune (configuratore e listini); "_per_s" = più alto è meglio
+    a = _appiattisci({"configuratore": prima["configuratore"], "listini": prima["listini"]})
+    b = _appiattisci({"configuratore": dopo["configuratore"], "listini": dopo["listini"]})
+    print(f"{'metrica':<52} {prima.get('commit') or 'prima':>12} {dopo.get('commit') or 'dopo':>12} {'delta':>8}")
+    peggiorate = []
+    for nome in sorted(set(a) & set(b)):
+        if a[nome] == 0:
+            continue
+        delta = (b[nome] - a[nome]) / a[nome] * 100
+        peggio = -delta if nome.endswith("_per_s") else delta
+        segno = "  ⚠" if peggio > soglia and not nome.endswith(("configurazioni", "distinte", "righe")) else ""
+        if segno:
+            peggiorate.append(nome)
+        print(f"{nome:<52} {a[nome]:>12.4g} {b[nome]:>12.4g} {delta:>+7.1f}%{segno}")
+    return peggiorate
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark di build, caricamento, ricerca e configuratore")
+    p.add_argument("--righe", type=int, nargs="+", default=[1000, 10000, 100000],
+                   help="dimensioni dei listini sintetici")
+    p.add_argument("--output", default="benchmark.json", help="file JSON dei risultati")
+    p.add_argument("--cartella", default=CARTELLA_BENCHMARK, help="listini e artefatti sintetici")
+    p.add_argument("--encoder", choices=TIPI_ENCODER, default="hash",
+                   help="encoder per build e ricerca (hash: senza modello, gira offline)")
+    p.add_argument("--indice", choices=build_index.TIPI_INDICE, default="flat-ip")
+    p.add_argument("--shard", action="store_true", help="artefatti con un indice per famiglia (build_index.py --shard)")
+    p.add_argument("--query", type=int, default=200, help="query per misura di latenza")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--confronta", nargs=2, metavar=("PRIMA", "DOPO"),
+                   help="confronta due file di risultati invece di misurare")
+    p.add_argument("--soglia", type=float, default=10.0, help="peggioramento %% segnalato nel confronto")
+    p.add_argument("--confronta-encoder", metavar="LISTINO",
+                   help="confronta gli encoder (--tipi) su un listino Excel reale invece di misurare")
+    p.add_argument("--tipi", choices=TIPI_ENCODER, nargs="+", default=list(TIPI_ENCODER),
+                   help="encoder da confrontare (fp32 serve come riferimento per il top-1)")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.confronta:
+        with open(args.confronta[0], encoding="utf-8") as f1, open(args.confronta[1], encoding="utf-8") as f2:
+            peggiorate = confronta(json.load(f1), json.load(f2), args.soglia)
+        sys.exit(1 if peggiorate else 0)
+    if args.confronta_encoder:
+        risultati = confronta_encoder(args.confronta_encoder, args.tipi, args.query, args.seed, args.cartella)
+        stampa_encoder(risultati)
+    else:
+        risultati = esegui(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(risultati, f, indent=2, ensure_ascii=False)
+    print(f"✅ Risultati in {args.output}", file=sys.stderr)
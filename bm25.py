@@ -0,0 +1,93 @@
+from __future__ import annotations
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from indice_token import IndiceToken
+
+# =========================
+# Indice lessicale BM25 su Codice/Prodotto/Descrizione
+# Riusa le posting list dei token di IndiceToken: per ogni coppia (token, riga)
+# il peso BM25 è precalcolato in un array allineato a token_righe, quindi il
+# punteggio di una query è una somma di slice numpy, senza Python per riga.
+# =========================
+K1 = 1.2
+B = 0.75
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def pesi_bm25(indice: IndiceToken, k1: float = K1, b: float = B) -> np.ndarray:
+    n = indice.n_righe
+    pesi = np.zeros(len(indice.token_righe), dtype=np.float32)
+    if n == 0:
+        return pesi
+    lunghezze = np.zeros(n, dtype=np.float32)
+    cursore = np.zeros(len(indice.token_chiavi), dtype=np.int64)
+    tf = np.zeros(len(indice.token_righe), dtype=np.float32)
+    # le posting list sono in ordine di riga: il cursore per token dà la posizione
+    for i, x in enumerate(indice.testi):
+        conteggi = Counter(_TOKEN_RE.findall(x))
+        lunghezze[i] = sum(conteggi.values())
+        for t, c in conteggi.items():
+            slot = indice.token_chiavi[t]
+            tf[indice.token_offset[slot] + cursore[slot]] = c
+            cursore[slot] += 1
+
+    df = np.diff(indice.token_offset).astype(np.float32)
+    idf = np.log1p((n - df + 0.5) / (df + 0.5))
+    media = float(lunghezze.mean()) or 1.0
+    righe = np.asarray(indice.token_righe)
+    norm = k1 * (1 - b + b * lunghezze[righe] / media)
+    pesi[:] = np.repeat(idf, df.astype(np.int64)) * tf * (k1 + 1) / (tf + norm)
+    return pesi
+
+
+def pesi_bm25_fetta(globale: IndiceToken, pesi: np.ndarray, fetta: IndiceToken, inizio: int) -> np.ndarray:
+    # Pesi di un indice costruito sulle righe [inizio, inizio + n) dello stesso
+    # listino (uno shard), con idf e lunghezza media dell'intero listino: i
+    # punteggi di shard diversi restano confrontabili. Le posting list sono in
+    # ordine di riga, quindi quella dello shard è una fetta di quella globale.
+    out = np.empty(len(fetta.token_righe), dtype=np.float32)
+    for t, slot in fetta.token_chiavi.items():
+        g = globale.token_chiavi[t]
+        a = int(globale.token_offset[g])
+        da = a + int(np.searchsorted(globale.token_righe[a:globale.token_offset[g + 1]], inizio))
+        a_f, z_f = fetta.token_offset[slot], fetta.token_offset[slot + 1]
+        out[a_f:z_f] = pesi[da:da + (z_f - a_f)]
+    return out
+
+
+@dataclass(frozen=True)
+class IndiceBM25:
+    indice: IndiceToken
+    pesi: np.ndarray            # allineato a indice.token_righe
+
+    def punteggi(self, tokens: Sequence[str]) -> np.ndarray:
+        score = np.zeros(self.indice.n_righe, dtype=np.float32)
+        it = self.indice
+        for t in set(tokens):
+            slot = it.token_chiavi.get(t)
+            if slot is None:
+                continue
+            a, z = it.token_offset[slot], it.token_offset[slot + 1]
+            score[it.token_righe[a:z]] += self.pesi[a:z]   # righe uniche nella posting
+        return score
+
+    def top_k(self, score: np.ndarray, k: int, consentite=None) -> Tuple[np.ndarray, np.ndarray]:
+        # Le k righe con punteggio > 0 più alto (eventualmente tra le sole consentite)
+        if consentite is not None:
+            righe = np.asarray(consentite)
+            s = score[righe]
+        else:
+            righe = np.flatnonzero(score > 0)
+            s = score[righe]
+        positivi = s > 0
+        righe, s = righe[positivi], s[positivi]
+        if righe.size > k:
+            scelte = np.argpartition(-s, k - 1)[:k]
+            righe, s = righe[scelte], s[scelte]
+        ordine = np.argsort(-s, kind="stable")
+        return righe[ordine], s[ordine]
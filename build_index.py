@@ -1,39 +1,507 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from typing import List
+
 import pandas as pd
 import numpy as np
-import pickle
-from sentence_transformers import SentenceTransformer
+from pandas.io.parsers import TextParser
 import faiss
+import openpyxl
+
+from artefatto import Artefatto, hash_righe, salva_artefatto
+from cache_embedding import CacheEmbedding
+from encoder import TIPI_ENCODER, crea_encoder, nome_encoder, tipo_encoder
+from famiglie import carica_famiglie, centroide, ordina_per_famiglia
+from indice_token import IndiceToken
+from indici import (
+    DTYPE_VETTORI, RERANK_PREDEFINITO, TIPI_INDICE, VETTORI, cerca_indice, crea_indice, dtype_vettori, normalizza,
+    normalizzato, righe_training, ripiego_piccolo,
+)
+from listino import testo_catalogo
+from ricerca import MODALITA, cerca_voci, parse_voce
+from risorse import PERCORSO_ARTEFATTO, Risorse
+
+# =========================
+# Build dell'indice del listino
+#   python build_index.py --input prodotti.xlsx --batch-size 64 --workers 4
+#   python build_index.py --encoder int8     (encoder.py; l'app va avviata con lo stesso)
+#   python build_index.py --shard            (un indice per famiglia di prodotto, famiglie.py)
+# =========================
+COLONNE_ATTESE = {"Codice", "Prodotto", "Prezzo di listino", "Descrizione"}
+CARTELLA_CACHE = ".cache_listino"
+
+
+# =========================
+# Lettura Excel: streaming in sola lettura, convertita una volta in parquet
+# (cache indicizzata per mtime + hash del file)
+# =========================
+def _sha256_file(percorso: str) -> str:
+    h = hashlib.sha256()
+    with open(percorso, "rb") as f:
+        for blocco in iter(lambda: f.read(1 << 20), b""):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _ingest_excel(percorso: str, blocco: int = 10000) -> pd.DataFrame:
+    # openpyxl in read_only scorre il foglio senza costruire l'albero XML completo;
+    # le righe passano a TextParser (stessa inferenza dei tipi di pd.read_excel)
+    # a blocchi: in memoria come liste Python c'è al più un blocco di righe.
+    wb = openpyxl.load_workbook(percorso, read_only=True, data_only=True)
+    try:
+        righe = wb.worksheets[0].iter_rows(values_only=True)
+        intestazione = list(next(righe, ()))
+        parti = []
+        while True:
+            parte = [list(r) for r in itertools.islice(righe, blocco)]
+            if not parte:
+                break
+            parti.append(TextParser([intestazione] + parte, header=0).read())
+    finally:
+        wb.close()
+    if parti:
+        df = pd.concat(parti, ignore_index=True)
+    else:
+        df = TextParser([intestazione], header=0).read()
+    # intestazioni del listino con spazi finali ("Codice ", "Descrizione ")
+    df.columns = [str(c).strip() for c in df.columns]
+    return df
+
+
+def leggi_listino(percorso: str, cartella_cache: str = CARTELLA_CACHE) -> pd.DataFrame:
+    os.makedirs(cartella_cache, exist_ok=True)
+    nome = os.path.splitext(os.path.basename(percorso))[0]
+    percorso_meta = os.path.join(cartella_cache, f"{nome}.json")
+    st = os.stat(percorso)
+
+    meta = {}
+    if os.path.exists(percorso_meta):
+        with open(percorso_meta, encoding="utf-8") as f:
+            meta = json.load(f)
+    parquet = meta.get("parquet")
+    valida = parquet and os.path.exists(parquet)
+
+    if valida and meta.get("mtime") == st.st_mtime and meta.get("size") == st.st_size:
+        return pd.read_parquet(parquet)
+
+    sha = _sha256_file(percorso)
+    if not (valida and meta.get("sha256") == sha):
+        df = _ingest_excel(percorso)
+        parquet = os.path.join(cartella_cache, f"{nome}-{sha[:16]}.parquet")
+        df.to_parquet(parquet, index=False)
+        if meta.get("parquet") and meta["parquet"] != parquet and os.path.exists(meta["parquet"]):
+            os.remove(meta["parquet"])
+    else:
+        df = pd.read_parquet(parquet)
+
+    with open(percorso_meta, "w", encoding="utf-8") as f:
+        json.dump({"mtime": st.st_mtime, "size": st.st_size, "sha256": sha, "parquet": parquet}, f)
+    return df
+
+
+# =========================
+# Encoding a blocchi, opzionalmente su più processi
+# =========================
+_model_worker = None
+
+
+def _init_worker(tipo_encoder: str, thread: int) -> None:
+    global _model_worker
+    _model_worker = crea_encoder(tipo_encoder, thread_torch=thread)
+
+
+def _encode_worker(testi, batch_size: int) -> np.ndarray:
+    return np.asarray(_model_worker.encode(testi, batch_size=batch_size), dtype="float32")
+
+
+def encode_a_blocchi(testi, batch_size: int, workers: int, blocco: int, tipo_encoder: str = "fp32"):
+    # Genera (inizio, vettori) blocco per blocco: in memoria c'è al più un blocco
+    # di vettori per worker (più uno in coda), il resto va subito scritto su
+    # disco dal chiamante.
+    inizi = range(0, len(testi), blocco)
+    if not inizi:
+        return
+    if workers <= 1:
+        model = crea_encoder(tipo_encoder)
+        for inizio in inizi:
+            yield inizio, np.asarray(model.encode(testi[inizio:inizio + blocco], batch_size=batch_size), dtype="float32")
+        return
+    thread = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker, initargs=(tipo_encoder, thread),
+    ) as pool:
+        # finestra limitata di blocchi inviati: pool.map li sottometterebbe tutti subito
+        in_corso = deque()
+        for inizio in inizi:
+            in_corso.append((inizio, pool.submit(_encode_worker, testi[inizio:inizio + blocco], batch_size)))
+            if len(in_corso) >= 2 * workers:
+                primo, futuro = in_corso.popleft()
+                yield primo, futuro.result()
+        while in_corso:
+            primo, futuro = in_corso.popleft()
+            yield primo, futuro.result()
+
+
+# =========================
+# Indice FAISS: training (IVF, sq8, pq) su un campione riproducibile,
+# poi add a blocchi dal file mappato
+# =========================
+def popola_indice(index, info_indice, vettori, blocco: int) -> None:
+    n = len(vettori)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        campione = np.sort(rng.choice(n, min(n, righe_training(info_indice)), replace=False))
+        index.train(np.ascontiguousarray(vettori[campione]))
+    for inizio in range(0, n, blocco):
+        index.add(np.ascontiguousarray(vettori[inizio:inizio + blocco]))
+
+
+# =========================
+# Report recall/latenza dell'indice scelto rispetto alla ricerca esatta
+# =========================
+def _latenze_ms(cerca, query) -> np.ndarray:
+    tempi = []
+    for q in query:
+        t = time.perf_counter()
+        cerca(q[None, :])
+        tempi.append((time.perf_counter() - t) * 1000)
+    return np.asarray(tempi)
+
+
+def report_indice(index, info_indice, vettori, n_query: int, seed: int = 0, stampa: bool = True) -> dict:
+    # Query campione: vettori di righe estratte a caso, esclusa la riga stessa
+    # dai risultati (altrimenti il top-1 sarebbe banale). L'indice è interrogato
+    # come a runtime: con sq8/pq rerank sui vettori nel formato di vettori.npy.
+    n = len(vettori)
+    rng = np.random.default_rng(seed)
+    pos = np.sort(rng.choice(n, min(n_query, n), replace=False))
+    query = np.ascontiguousarray(vettori[pos])
+    k = min(5, n - 1)
+    if k < 1:
+        return {}
+
+    esatto = faiss.IndexFlatIP(query.shape[1]) if info_indice["metrica"] == "ip" else faiss.IndexFlatL2(query.shape[1])
+    for inizio in range(0, n, 65536):
+        esatto.add(np.ascontiguousarray(vettori[inizio:inizio + 65536]))
+
+    def senza_se_stessa(I):
+        return np.array([[j for j in riga if j != p][:k] for p, riga in zip(pos, I)])
+
+    rerank = np.asarray(vettori, dtype=dtype_vettori(info_indice)) if info_indice.get("rerank") else vettori
+
+    def cerca(q):
+        return cerca_indice(index, info_indice, rerank, q, k + 1)
+
+    _, I_esatto = esatto.search(query, k + 1)
+    _, I_indice = cerca(query)
+    vero, trovato = senza_se_stessa(I_esatto), senza_se_stessa(I_indice)
+
+    recall_1 = float(np.mean(vero[:, 0] == trovato[:, 0]))
+    # scarto medio di punteggio esatto tra il vero top-1 e quello trovato: misura
+    # la perdita reale quando il recall scende per righe quasi identiche
+    v = np.asarray(vettori[np.concatenate([vero[:, 0], trovato[:, 0]])], dtype="float32").reshape(2, len(pos), -1)
+    if info_indice["metrica"] == "ip":
+        punteggi = (v * query).sum(axis=2)
+    else:
+        punteggi = -((v - query) ** 2).sum(axis=2)
+    scarto_1 = float(np.mean(punteggi[0] - punteggi[1]))
+    recall_k = float(np.mean([len(set(v) & set(t)) / k for v, t in zip(vero, trovato)]))
+    lat_esatto = _latenze_ms(lambda q: esatto.search(q, k + 1), query)
+    lat_indice = _latenze_ms(cerca, query)
+    report = {
+        "query": len(pos), "recall@1": recall_1, f"recall@{k}": recall_k, "scarto_top1": scarto_1,
+        "p50_ms": float(np.percentile(lat_indice, 50)), "p99_ms": float(np.percentile(lat_indice, 99)),
+        "esatto_p50_ms": float(np.percentile(lat_esatto, 50)), "esatto_p99_ms": float(np.percentile(lat_esatto, 99)),
+    }
+    if stampa:
+        print(f"   indice {info_indice['tipo']} ({info_indice.get('vettori', 'fp32')}): recall@1 {recall_1:.3f}, "
+              f"recall@{k} {recall_k:.3f} su {len(pos)} query (scarto top-1 {scarto_1:.2e})")
+        print(f"   latenza p50/p99: {report['p50_ms']:.3f}/{report['p99_ms']:.3f} ms "
+              f"(esatta {report['esatto_p50_ms']:.3f}/{report['esatto_p99_ms']:.3f} ms)")
+    return report
+
+
+# =========================
+# Budget di memoria per ogni memorizzazione dei vettori (--report-memoria)
+# Stesso tipo di indice e stessi vettori del build, una riga per opzione:
+#   indice      byte dell'indice FAISS serializzato
+#   vettori     byte di vettori.npy (float32 o float16)
+#   privata     memoria propria di ogni worker: 0 se l'indice si apre in mmap
+#               (flat, fp16, sq8 su flat), altrimenti tutto l'indice;
+#               vettori.npy è sempre in mmap, condiviso tra i worker
+#   100k        indice + vettori riportati a 100.000 righe
+#   recall@1    rispetto alla ricerca esatta fp32 (con il rerank di runtime)
+#   scarto      perdita media di punteggio esatto sul top-1
+# =========================
+def report_memoria(args, vettori, n_query: int) -> list:
+    n, dim = vettori.shape
+    righe = []
+    for opzione in VETTORI:
+        index, info = crea_indice(
+            args.indice, dim, n, nlist=args.nlist, nprobe=args.nprobe, hnsw_m=args.hnsw_m,
+            ef_search=args.ef_search, vettori=opzione, pq_m=args.pq_m, rerank=args.rerank,
+        )
+        popola_indice(index, info, vettori, args.blocco)
+        byte_indice = int(faiss.serialize_index(index).nbytes)
+        byte_vettori = n * dim * np.dtype(dtype_vettori(info)).itemsize
+        in_mmap = isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes)
+        report = report_indice(index, info, vettori, n_query, stampa=False) if n_query > 0 else {}
+        righe.append({
+            "vettori": opzione,
+            "indice_mb": byte_indice / 2**20,
+            "vettori_mb": byte_vettori / 2**20,
+            "privata_worker_mb": 0.0 if in_mmap else byte_indice / 2**20,
+            "mb_100k": (byte_indice + byte_vettori) / n * 100_000 / 2**20,
+            "recall@1": report.get("recall@1"),
+            "scarto_top1": report.get("scarto_top1"),
+            "p50_ms": report.get("p50_ms"),
+        })
+
+    print(f"   budget di memoria, indice {args.indice}, {n} righe x {dim} dim:")
+    print(f"   {'vettori':<8} {'indice MB':>10} {'vettori MB':>11} {'privata MB':>11} {'100k MB':>9} "
+          f"{'recall@1':>9} {'scarto':>9} {'p50 ms':>8}")
+    for r in righe:
+        recall = f"{r['recall@1']:>9.3f}" if r["recall@1"] is not None else f"{'-':>9}"
+        scarto = f"{r['scarto_top1']:>9.1e}" if r["scarto_top1"] is not None else f"{'-':>9}"
+        p50 = f"{r['p50_ms']:>8.3f}" if r["p50_ms"] is not None else f"{'-':>8}"
+        print(f"   {r['vettori']:<8} {r['indice_mb']:>10.2f} {r['vettori_mb']:>11.2f} "
+              f"{r['privata_worker_mb']:>11.2f} {r['mb_100k']:>9.1f} {recall} {scarto} {p50}")
+    return righe
+
+
+# =========================
+# Shard per famiglia: stesso tipo di indice e stessa memorizzazione dei vettori
+# dell'indice completo, sulle righe contigue di ogni famiglia
+# =========================
+def costruisci_shard(args, shard, vettori, testi) -> None:
+    dimensione = vettori.shape[1]
+    ripieghi = []
+    for s in shard:
+        parte = vettori[s["inizio"]:s["fine"]]
+        tipo, memoria = ripiego_piccolo(args.indice, args.vettori, len(parte))
+        if (tipo, memoria) != (args.indice, args.vettori):
+            ripieghi.append(f"{s['nome']} {tipo} ({memoria})")
+        index, s["indice"] = crea_indice(
+            tipo, dimensione, len(parte),
+            nlist=args.nlist, nprobe=args.nprobe, hnsw_m=args.hnsw_m, ef_search=args.ef_search,
+            vettori=memoria, pq_m=args.pq_m, rerank=args.rerank,
+        )
+        popola_indice(index, s["indice"], parte, args.blocco)
+        s.update(
+            index=index,
+            indice_token=IndiceToken.costruisci(testi[s["inizio"]:s["fine"]]),
+            centroide=centroide(parte),
+        )
+    print("   shard: " + ", ".join(f"{s['nome']} {s['fine'] - s['inizio']}" for s in shard))
+    if ripieghi:
+        print(f"   shard troppo piccoli per {args.indice} ({args.vettori}): " + ", ".join(ripieghi))
+
+
+# =========================
+# Report del router (--shard): ricerca instradata sugli shard contro la ricerca
+# sull'indice completo dell'artefatto appena salvato, stesse voci e modalità.
+#   top-1   voci con la stessa prima alternativa
+#   top-k   quota media delle k alternative complete ritrovate dal router
+# Voci campione: nome prodotto di righe a caso e una sua parola da sola
+# (voci generiche come "pompa", dove il router rischia di più).
+# =========================
+def voci_campione(df: pd.DataFrame, n: int, seed: int = 0) -> List[str]:
+    rng = np.random.default_rng(seed)
+    voci = {}
+    for p in rng.permutation(len(df)).tolist():
+        prodotto = str(df["Prodotto"].iat[p]).lower().strip()
+        parole = re.findall(r"[^\W\d_]{4,}", prodotto)
+        voci.setdefault(prodotto)
+        if parole:
+            voci.setdefault(parole[int(rng.integers(len(parole)))])
+        if len(voci) >= n:
+            break
+    return list(voci)[:n]
+
+
+def report_router(cartella: str, tipo: str, n_query: int, k: int = 5, seed: int = 0, stampa: bool = True) -> dict:
+    model = crea_encoder(tipo)
+    instradate = Risorse(
+        model=model,
+        artefatto=Artefatto(cartella, modello=nome_encoder(tipo)),
+        cache_query=CacheEmbedding(model.impronta, max(n_query, 1), None),
+        encoder=model,
+    )
+    complete = replace(instradate, usa_shard=False)
+    voci = [parse_voce(t) for t in voci_campione(instradate.df, n_query, seed)]
+    report = {"query": len(voci)}
+    for modalita in MODALITA:
+        coppie = [
+            (r.righe.tolist(), c.righe.tolist())
+            for r, c in zip(cerca_voci(instradate, voci, k, modalita), cerca_voci(complete, voci, k, modalita))
+            if c.trovato
+        ]
+        if not coppie:
+            continue
+        report[modalita] = {
+            "top1": float(np.mean([r[:1] == c[:1] for r, c in coppie])),
+            f"top{k}": float(np.mean([len(set(r) & set(c)) / len(c) for r, c in coppie])),
+        }
+        if stampa:
+            print(f"   router {modalita}: top-1 {report[modalita]['top1']:.3f}, "
+                  f"top-{k} {report[modalita][f'top{k}']:.3f} rispetto all'indice completo su {len(coppie)} voci")
+    return report
+
+
+# =========================
+# Build
+# =========================
+def costruisci(args) -> dict:
+    t0 = time.perf_counter()
+    df = leggi_listino(args.input, args.cache)
+
+    # Controllo colonne obbligatorie
+    if not COLONNE_ATTESE.issubset(df.columns):
+        raise ValueError(f"Il file Excel deve contenere le colonne: {COLONNE_ATTESE}")
+    if df.empty:
+        raise ValueError(f"Nessuna riga da indicizzare in {args.input}")
+
+    # Con gli shard il catalogo si riordina per famiglia (righe contigue per shard)
+    shard = []
+    if args.shard:
+        df, shard = ordina_per_famiglia(df, carica_famiglie(args.famiglie))
+
+    # Prepara i testi da embeddare
+    testi = testo_catalogo(df).tolist()
+
+    # Rebuild incrementale: si riusano i vettori delle righe il cui testo embeddato
+    # (Codice + Prodotto + Descrizione) non è cambiato rispetto all'artefatto esistente
+    # (solo se l'artefatto è dello stesso encoder e ha vettori nello stesso spazio:
+    # normalizzati o grezzi come richiede il tipo di indice, mai mescolati)
+    hash_nuovi = hash_righe(testi).tolist()
+    nome = nome_encoder(args.encoder)
+    vettori_vecchi = None
+    pos_vecchie = {}
+    if not args.completo:
+        try:
+            precedente = Artefatto(args.output, modello=nome)
+            # vettori float16 di un artefatto compresso non si riusano in uno float32
+            if (
+                precedente.vettori.dtype in (np.float32, np.dtype(DTYPE_VETTORI[args.vettori]))
+                and precedente.info_indice["normalizzato"] == normalizzato(args.indice)
+            ):
+                vettori_vecchi = precedente.vettori
+                pos_vecchie = {h: i for i, h in enumerate(precedente.hash_righe.tolist())}
+        except (FileNotFoundError, ValueError):
+            pass    # nessun artefatto compatibile: rebuild completo
+
+    da_calcolare = [i for i, h in enumerate(hash_nuovi) if h not in pos_vecchie]
+    riuso = [(i, pos_vecchie[h]) for i, h in enumerate(hash_nuovi) if h in pos_vecchie]
+    eliminate = len(set(pos_vecchie) - set(hash_nuovi))
+
+    # I vettori si scrivono man mano in un file mappato: la memoria di picco non
+    # cresce con il numero di righe da embeddare
+    # (il modello si carica solo se c'è qualcosa da calcolare:
+    # un aggiornamento dei soli prezzi non tocca l'encoder)
+    encoder = encode_a_blocchi(
+        [testi[i] for i in da_calcolare], args.batch_size, args.workers, args.blocco, args.encoder
+    )
+    primo = next(encoder, None)
+    # listino non vuoto: se non c'è nulla da calcolare tutte le righe sono riusate
+    dimensione = primo[1].shape[1] if primo is not None else vettori_vecchi.shape[1]
+
+    percorso_vettori = f"{os.path.abspath(args.output)}.vettori.npy"
+    embeddings = np.lib.format.open_memmap(
+        percorso_vettori, mode="w+", dtype="float32", shape=(len(testi), dimensione)
+    )
+    try:
+        for inizio in range(0, len(riuso), args.blocco):
+            pos_nuove, pos_vecchie_riuso = map(list, zip(*riuso[inizio:inizio + args.blocco]))
+            embeddings[pos_nuove] = vettori_vecchi[pos_vecchie_riuso]
+        if primo is not None:
+            posizioni = np.asarray(da_calcolare)
+            for inizio, vettori in itertools.chain([primo], encoder):
+                embeddings[posizioni[inizio:inizio + len(vettori)]] = vettori
+                print(f"   embeddate {min(inizio + len(vettori), len(da_calcolare))}/{len(da_calcolare)}")
+
+        # Costruisci l’indice FAISS (a blocchi dal file mappato)
+        index, info_indice = crea_indice(
+            args.indice, dimensione, len(testi),
+            nlist=args.nlist, nprobe=args.nprobe, hnsw_m=args.hnsw_m, ef_search=args.ef_search,
+            vettori=args.vettori, pq_m=args.pq_m, rerank=args.rerank,
+        )
+        if info_indice["normalizzato"]:
+            # vettori salvati già normalizzati: coseno = prodotto scalare.
+            # Quelli riusati sono già normalizzati e non si toccano
+            # (rinormalizzare non è bit-identico e cambierebbe l'hash).
+            righe = np.asarray(da_calcolare, dtype=np.int64)
+            for inizio in range(0, len(righe), args.blocco):
+                parte = righe[inizio:inizio + args.blocco]
+                embeddings[parte] = normalizza(embeddings[parte])
+        popola_indice(index, info_indice, embeddings, args.blocco)
+
+        if args.report_query > 0:
+            report_indice(index, info_indice, embeddings, args.report_query)
+        if args.report_memoria:
+            report_memoria(args, embeddings, args.report_query)
+
+        # Indice invertito (n-grammi e token -> righe) per il filtro parole chiave
+        indice_token = IndiceToken.costruisci(testi)
+        if shard:
+            costruisci_shard(args, shard, embeddings, testi)
+
+        # Salva l'artefatto (cartella versionata con manifest, vedi artefatto.py)
+        manifest = salva_artefatto(
+            args.output, df, embeddings, index, indice_token, nome, info_indice, args.encoder, shard
+        )
+    finally:
+        del embeddings
+        os.remove(percorso_vettori)
+
+    print(f"✅ Indice salvato in '{args.output}' (encoder {args.encoder}, hash {manifest['hash'][:12]}) "
+          f"in {time.perf_counter() - t0:.1f}s")
+    print(f"   righe embeddate: {len(da_calcolare)}, riusate: {len(riuso)}, eliminate: {eliminate}")
+    if shard and args.report_query > 0:
+        report_router(args.output, args.encoder, args.report_query)
+    return manifest
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Costruisce l'indice di ricerca del listino")
+    p.add_argument("--input", default="prodotti.xlsx", help="file Excel del listino")
+    p.add_argument("--output", default=PERCORSO_ARTEFATTO, help="cartella dell'artefatto")
+    p.add_argument("--cache", default=CARTELLA_CACHE, help="cartella della cache parquet del listino")
+    p.add_argument("--batch-size", type=int, default=64, help="batch dell'encoder")
+    p.add_argument("--blocco", type=int, default=4096, help="righe per blocco di encoding/scrittura")
+    p.add_argument("--workers", type=int, default=1, help="processi di encoding")
+    p.add_argument("--completo", action="store_true", help="ricalcola tutti gli embedding")
+    p.add_argument("--encoder", choices=TIPI_ENCODER, default=tipo_encoder(),
+                   help="encoder degli embedding (default: BALTUR_ENCODER o fp32)")
+    p.add_argument("--indice", choices=TIPI_INDICE, default="flat-ip", help="tipo di indice vettoriale")
+    p.add_argument("--nlist", type=int, default=None, help="IVF: numero di liste (default ~sqrt(N))")
+    p.add_argument("--nprobe", type=int, default=8, help="IVF: liste visitate per query")
+    p.add_argument("--hnsw-m", type=int, default=32, help="HNSW: vicini per nodo")
+    p.add_argument("--ef-search", type=int, default=64, help="HNSW: ampiezza della ricerca")
+    p.add_argument("--vettori", choices=VETTORI, default="fp32",
+                   help="memorizzazione dei vettori: fp32, fp16, sq8 (int8) o pq (product quantization)")
+    p.add_argument("--pq-m", type=int, default=None, help="PQ: byte per vettore (default dim/8)")
+    p.add_argument("--rerank", type=int, default=RERANK_PREDEFINITO,
+                   help="sq8/pq: candidati riordinati con i vettori float")
+    p.add_argument("--report-memoria", action="store_true",
+                   help="confronta memoria e recall di tutte le opzioni di --vettori")
+    p.add_argument("--shard", action="store_true",
+                   help="un indice vettoriale e un indice token per famiglia di prodotto, con router")
+    p.add_argument("--famiglie", default=None,
+                   help="JSON famiglia -> parole chiave al posto della tabella di famiglie.py")
+    p.add_argument("--report-query", type=int, default=200,
+                   help="query campione per il report recall/latenza (0 = niente report)")
+    return p.parse_args(argv)
+
 
-# Carica il file Excel (modifica il nome se serve)
-df = pd.read_excel("listino_prodotti.xlsx")
-
-# Controllo colonne obbligatorie
-colonne_attese = {"Codice", "Prodotto", "Prezzo di listino", "Descrizione"}
-if not colonne_attese.issubset(df.columns):
-    raise ValueError(f"Il file Excel deve contenere le colonne: {colonne_attese}")
-
-# Prepara i testi da embeddare
-testi = (
-    df["Codice"].fillna('').astype(str) + " " +
-    df["Prodotto"].fillna('').astype(str) + " " +
-    df["Descrizione"].fillna('').astype(str)
-).str.lower().tolist()
-
-# Embedding
-model = SentenceTransformer("all-MiniLM-L6-v2")
-embeddings = model.encode(testi)
-
-# Costruisci l’indice FAISS
-dimensione = embeddings[0].shape[0]
-index = faiss.IndexFlatL2(dimensione)
-index.add(np.array(embeddings))
-
-# Salva tutto in un file
-with open("embeddings.pkl", "wb") as f:
-    pickle.dump({
-        "df": df,
-        "embeddings": embeddings,
-        "index": index
-    }, f)
-
-print("✅ Embedding salvato in 'embeddings.pkl'")
+if __name__ == "__main__":
+    costruisci(parse_args())
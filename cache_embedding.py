@@ -0,0 +1,128 @@
+from __future__ import annotations
+import atexit
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# =========================
+# Cache LRU degli embedding delle query (testo normalizzato -> vettore)
+# - limitata a max_voci, con espulsione del meno usato di recente
+# - opzionalmente persistita su disco (sopravvive ai riavvii), da un thread
+#   ogni intervallo_salvataggio secondi e all'uscita, mai durante le ricerche
+# - invalidata se cambia l'impronta del modello (nome/versione)
+# =========================
+
+
+def normalizza_query(testo: str) -> str:
+    # Il tokenizer di all-MiniLM-L6-v2 è uncased e ignora gli spazi multipli:
+    # queste varianti producono lo stesso embedding e condividono la voce in cache.
+    return " ".join(testo.split()).lower()
+
+
+class CacheEmbedding:
+    def __init__(
+        self,
+        impronta_modello: str,
+        max_voci: int = 2048,
+        percorso: Optional[str] = None,
+        intervallo_salvataggio: float = 30.0,
+    ):
+        self.impronta_modello = impronta_modello
+        self.max_voci = max_voci
+        self.percorso = percorso
+        self.intervallo_salvataggio = intervallo_salvataggio
+        self.hits = 0
+        self.misses = 0
+        self._voci: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._modificata = False
+        if percorso:
+            self._carica()
+            atexit.register(self.salva)
+            threading.Thread(target=self._salvataggio_periodico, name="salvataggio-cache-query", daemon=True).start()
+
+    # ---- persistenza ----
+    def _carica(self) -> None:
+        if not os.path.exists(self.percorso):
+            return
+        try:
+            with open(self.percorso, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            return
+        if data.get("impronta_modello") != self.impronta_modello:
+            return  # modello cambiato: la cache su disco non è più valida
+        for testo, vettore in list(data["voci"].items())[-self.max_voci:]:
+            self._voci[testo] = vettore
+
+    def salva(self) -> None:
+        if not self.percorso:
+            return
+        with self._lock:
+            if not self._modificata:
+                return
+            data = {"impronta_modello": self.impronta_modello, "voci": dict(self._voci)}
+            self._modificata = False
+        tmp = f"{self.percorso}.{os.getpid()}.tmp"   # più processi possono salvare insieme
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f)
+        os.replace(tmp, self.percorso)
+
+    def _salvataggio_periodico(self) -> None:
+        while True:
+            time.sleep(self.intervallo_salvataggio)
+            try:
+                self.salva()
+            except OSError:
+                pass        # si riprova al giro dopo (e comunque all'uscita)
+
+    # ---- encode con cache ----
+    def encode(self, model, testi: Sequence[str]) -> np.ndarray:
+        chiavi = [normalizza_query(t) for t in testi]
+        trovati: Dict[str, np.ndarray] = {}
+        mancanti: List[str] = []
+        with self._lock:
+            for c in chiavi:
+                if c in trovati:
+                    continue
+                v = self._voci.get(c)
+                if v is None:
+                    if c not in mancanti:
+                        mancanti.append(c)
+                    continue
+                self._voci.move_to_end(c)
+                trovati[c] = v
+            # chiavi distinte: una query ripetuta nella stessa chiamata non è un hit
+            self.hits += len(trovati)
+            self.misses += len(mancanti)
+
+        if mancanti:
+            # un solo forward batch per tutte le query non in cache
+            vettori = np.asarray(model.encode(mancanti), dtype="float32")
+            with self._lock:
+                for c, v in zip(mancanti, vettori):
+                    v.setflags(write=False)
+                    trovati[c] = v
+                    self._voci[c] = v
+                    self._voci.move_to_end(c)
+                while len(self._voci) > self.max_voci:
+                    self._voci.popitem(last=False)
+                self._modificata = True
+
+        return np.stack([trovati[c] for c in chiavi])
+
+    def statistiche(self) -> Dict[str, float]:
+        with self._lock:
+            totale = self.hits + self.misses
+            return {
+                "voci": len(self._voci),
+                "max_voci": self.max_voci,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / totale if totale else 0.0,
+            }
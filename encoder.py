@@ -0,0 +1,118 @@
+from __future__ import annotations
+import os
+import zlib
+from dataclasses import dataclass
+from importlib.metadata import version
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+# =========================
+# Encoder del testo (query e righe di listino), scelto da configurazione:
+# BALTUR_ENCODER nell'ambiente, --encoder in build_index.py/benchmark.py
+#   fp32   all-MiniLM-L6-v2 in PyTorch fp32 (riferimento)
+#   int8   stesso modello con i Linear quantizzati dinamicamente in int8:
+#          pesi ~4x più piccoli, encode più veloce su CPU
+#   hash   n-grammi di caratteri hashati in un vettore: niente modello,
+#          niente torch, niente rete (ambienti isolati, test, benchmark)
+# Il nome dell'encoder finisce nel manifest dell'artefatto (campo "modello"):
+# un indice costruito con un encoder non si apre con un altro.
+# Stessa interfaccia di SentenceTransformer (encode, get_sentence_embedding_dimension),
+# quindi va bene per SchedulerEncoder e CacheEmbedding.
+# =========================
+NOME_MODELLO = "all-MiniLM-L6-v2"
+TIPI_ENCODER = ("fp32", "int8", "hash")
+VARIABILE_ENCODER = "BALTUR_ENCODER"
+TIPO_PREDEFINITO = "fp32"
+
+DIMENSIONE_HASH = 384
+NGRAMMI_HASH = (3, 4)
+
+
+def tipo_encoder(tipo: Optional[str] = None) -> str:
+    # None = BALTUR_ENCODER, poi fp32
+    tipo = tipo or os.environ.get(VARIABILE_ENCODER) or TIPO_PREDEFINITO
+    if tipo not in TIPI_ENCODER:
+        raise ValueError(f"Encoder non riconosciuto: {tipo} (attesi: {', '.join(TIPI_ENCODER)})")
+    return tipo
+
+
+def nome_encoder(tipo: Optional[str] = None) -> str:
+    # Nome registrato nell'artefatto, senza caricare il modello.
+    # fp32 resta il nome del modello: gli artefatti esistenti restano validi.
+    tipo = tipo_encoder(tipo)
+    if tipo == "fp32":
+        return NOME_MODELLO
+    if tipo == "int8":
+        return f"{NOME_MODELLO}+int8-dinamico"
+    return f"hash-char{NGRAMMI_HASH[0]}-{NGRAMMI_HASH[-1]}-{DIMENSIONE_HASH}"
+
+
+# =========================
+# Encoder lessicale: n-grammi di caratteri hashati
+# =========================
+class EncoderHash:
+    # Ogni n-gramma del testo (minuscolo, con uno spazio ai bordi) va in una
+    # delle `dimensione` componenti (crc32, stabile tra processi e macchine)
+    # con segno +-1, così le collisioni tendono a compensarsi. Testi con molti
+    # n-grammi in comune -> vettori vicini: cattura codici, sigle e misure
+    # ("dn65", "200l"), non i sinonimi.
+    def __init__(self, dimensione: int = DIMENSIONE_HASH, ngrammi: Sequence[int] = NGRAMMI_HASH):
+        self.dimensione = dimensione
+        self.ngrammi: Tuple[int, ...] = tuple(ngrammi)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimensione
+
+    def encode(self, testi: Sequence[str], batch_size: int = 32, **_) -> np.ndarray:
+        out = np.zeros((len(testi), self.dimensione), dtype="float32")
+        for i, testo in enumerate(testi):
+            t = f" {' '.join(str(testo).lower().split())} "
+            h = np.fromiter(
+                (zlib.crc32(t[j:j + n].encode()) for n in self.ngrammi for j in range(len(t) - n + 1)),
+                dtype=np.uint32,
+            )
+            segno = np.where(h & 0x80000000, 1.0, -1.0)
+            out[i] = np.bincount(h % self.dimensione, weights=segno, minlength=self.dimensione)
+        return out
+
+
+# =========================
+# Encoder configurato
+# =========================
+@dataclass(frozen=True)
+class Encoder:
+    tipo: str
+    nome: str           # registrato nel manifest dell'artefatto
+    impronta: str       # invalida la cache degli embedding delle query
+    model: object       # SentenceTransformer (fp32/int8) o EncoderHash
+
+    def encode(self, testi: Sequence[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        return self.model.encode(testi, batch_size=batch_size, **kwargs)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+
+def crea_encoder(tipo: Optional[str] = None, thread_torch: Optional[int] = None) -> Encoder:
+    tipo = tipo_encoder(tipo)
+    nome = nome_encoder(tipo)
+    if tipo == "hash":
+        return Encoder(tipo, nome, f"{nome}|v1", EncoderHash())
+
+    # sentence_transformers/torch importati solo per gli encoder neurali
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if thread_torch:
+        torch.set_num_threads(thread_torch)
+    model = SentenceTransformer(NOME_MODELLO, device="cpu" if tipo == "int8" else None)
+    if tipo == "int8":
+        # Pesi dei Linear in int8, attivazioni quantizzate al volo a ogni forward
+        # (niente calibrazione); i kernel quantizzati esistono solo su CPU
+        model.eval()
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    impronta = (
+        f"{nome}|st={version('sentence-transformers')}|torch={torch.__version__}"
+        f"|dim={model.get_sentence_embedding_dimension()}"
+    )
+    return Encoder(tipo, nome, impronta, model)
@@ -0,0 +1,135 @@
+from __future__ import annotations
+import json
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from indici import normalizza
+
+# =========================
+# Famiglie di prodotto per gli shard dell'indice (build_index.py --shard)
+# Ogni famiglia ha parole chiave, cercate come inizio di parola (minuscolo):
+#   1) sul campo Prodotto, nell'ordine della tabella (un "KIT ... SMILE"
+#      resta un accessorio anche se nomina una caldaia)
+#   2) altrimenti su Prodotto + Descrizione, stesso ordine
+#   3) altrimenti FAMIGLIA_RESIDUA
+# La tabella si può sostituire con un JSON {"famiglia": ["parola", ...], ...}
+# (--famiglie); nomi e parole usati finiscono nel manifest dell'artefatto.
+# =========================
+FAMIGLIE: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("accessori", (
+        "kit", "valvola", "sonda", "vaso", "comando", "pannello", "scheda", "curva", "prolunga",
+        "terminale", "flangia", "filtro", "separat", "griglia", "tegola", "rosone", "staffe", "dima",
+        "termostato", "cronoterm", "controllo", "kondpro", "liquipro", "serb", "eta pump",
+    )),
+    ("ibridi", ("hybrid", "ibrido", "ibrida")),
+    ("accumuli", ("bollitore", "accumulo", "volano", "produttore istantaneo", "pss", "brr", "sbacs", "sbpar")),
+    ("chiller", ("chiller", "refrigeratore", "bchm", "bchs", "bfan", "ventilconvettore")),
+    ("clima", ("climatizzatore", "clima", "monosplit", "multisplit")),
+    ("fotovoltaico", ("fotovoltaico", "bfv")),
+    ("caldaie", (
+        "caldaia", "modulo termico", "gruppo termico", "steeltre", "steelnox", "gtmix", "mcs", "mci",
+        "perfecta", "smile",
+    )),
+    ("pompe_calore", ("pompa di calore", "mhpr", "genio")),
+    ("scambiatori", ("scambiatore", "ssb", "sii")),
+    ("solare", ("solare", "etasun")),
+)
+FAMIGLIA_RESIDUA = "altro"
+
+# Instradamento: le famiglie nominate dalla voce più quella con il centroide
+# più vicino alla query, se stacca la seconda di almeno MARGINE_CENTROIDE
+# (coseno). Senza parole chiave o con centroidi incerti si cerca ovunque:
+# il centroide da solo può escludere lo shard giusto ("pompa" -> pompe di
+# calore invece dell'accessorio KONDPRO POMPA).
+MARGINE_CENTROIDE = 0.05
+
+
+def carica_famiglie(percorso: Optional[str]) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    if percorso is None:
+        return FAMIGLIE
+    with open(percorso, encoding="utf-8") as f:
+        dati = json.load(f)
+    if not isinstance(dati, dict):
+        raise ValueError(f"{percorso}: atteso un oggetto JSON famiglia -> lista di parole chiave")
+    famiglie = []
+    for nome, parole in dati.items():
+        if not re.fullmatch(r"\w+", nome):
+            raise ValueError(f"{percorso}: nome di famiglia non valido: {nome!r} (solo lettere, cifre e _)")
+        if not isinstance(parole, list) or not all(isinstance(p, str) and p.strip() for p in parole):
+            raise ValueError(f"{percorso}: la famiglia {nome} deve avere una lista di parole chiave")
+        famiglie.append((nome, tuple(p.strip().lower() for p in parole)))
+    return tuple(famiglie)
+
+
+def _regex(parole: Sequence[str]) -> Optional[re.Pattern]:
+    if not parole:
+        return None
+    return re.compile(r"\b(?:" + "|".join(re.escape(p) for p in sorted(parole, key=len, reverse=True)) + ")")
+
+
+def assegna_famiglie(df: pd.DataFrame, famiglie=FAMIGLIE) -> List[str]:
+    # Famiglia di ogni riga del listino (vedi regole in testa al file)
+    regex = [(nome, _regex(parole)) for nome, parole in famiglie]
+    prodotti = df["Prodotto"].fillna("").astype(str).str.lower().tolist()
+    testi = (df["Prodotto"].fillna("").astype(str) + " " + df["Descrizione"].fillna("").astype(str)).str.lower()
+    out = []
+    for prodotto, testo in zip(prodotti, testi.tolist()):
+        nome = next((n for n, r in regex if r is not None and r.search(prodotto)), None)
+        if nome is None:
+            nome = next((n for n, r in regex if r is not None and r.search(testo)), FAMIGLIA_RESIDUA)
+        out.append(nome)
+    return out
+
+
+def ordina_per_famiglia(df: pd.DataFrame, famiglie=FAMIGLIE) -> Tuple[pd.DataFrame, List[Dict]]:
+    # Catalogo riordinato (stabile) per famiglia, nell'ordine della tabella:
+    # ogni shard è un intervallo contiguo di righe [inizio, fine), così i suoi
+    # vettori sono una fetta del vettori.npy in mmap, senza copie.
+    assegnate = pd.Series(assegna_famiglie(df, famiglie), index=df.index)
+    ordine = [nome for nome, _ in famiglie] + [FAMIGLIA_RESIDUA]
+    parole = dict(famiglie)
+    rango = assegnate.map({nome: i for i, nome in enumerate(ordine)})
+    posizioni = np.argsort(rango.to_numpy(), kind="stable")
+    df = df.iloc[posizioni].reset_index(drop=True)
+    conteggi = assegnate.value_counts()
+
+    shard, inizio = [], 0
+    for nome in ordine:
+        n = int(conteggi.get(nome, 0))
+        if n:
+            shard.append({"nome": nome, "inizio": inizio, "fine": inizio + n, "parole": list(parole.get(nome, ()))})
+            inizio += n
+    return df, shard
+
+
+def centroide(vettori: np.ndarray) -> np.ndarray:
+    # Direzione media (normalizzata) dei vettori di uno shard
+    return normalizza(normalizza(vettori).mean(axis=0))[0]
+
+
+# =========================
+# Router: per ogni voce, gli shard in cui cercare
+# =========================
+class Router:
+    def __init__(self, shard: Sequence, centroidi: np.ndarray, margine: float = MARGINE_CENTROIDE):
+        self.shard = list(shard)            # artefatto.Shard, nell'ordine delle righe
+        self.centroidi = np.asarray(centroidi, dtype="float32")
+        self.margine = margine
+        self._regex = [_regex(s.parole) for s in self.shard]
+
+    def instrada(self, testo: str, query_embedding: np.ndarray) -> List[int]:
+        # Famiglie nominate nella voce ∪ famiglia del centroide più vicino alla query
+        tutti = list(range(len(self.shard)))
+        testo = testo.lower()
+        scelti = {i for i, r in enumerate(self._regex) if r is not None and r.search(testo)}
+        if not scelti or len(tutti) < 2:
+            return tutti
+        simili = self.centroidi @ normalizza(query_embedding)[0]
+        secondo, primo = np.argsort(simili)[-2:]
+        if simili[primo] - simili[secondo] < self.margine:
+            return tutti
+        scelti.add(int(primo))
+        return sorted(scelti)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+import json
+import os
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# =========================
+# Indice invertito del listino (costruito da build_index.py)
+# - n-grammi di caratteri (1..N_MAX) -> righe che contengono la sottostringa
+# - token \w+ -> righe che contengono il token come parola intera
+# Le posting list sono array int32 ordinati, concatenati in formato CSR.
+# =========================
+N_MAX = 3
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _csr(posting: Dict[str, List[int]]):
+    # Chiavi ordinate: a parità di listino i file salvati (e l'hash dell'artefatto)
+    # non dipendono dall'ordine di iterazione dei set
+    voci = sorted(posting.items())
+    chiavi: Dict[str, int] = {}
+    offset = np.zeros(len(voci) + 1, dtype=np.int64)
+    for slot, (chiave, righe) in enumerate(voci):
+        chiavi[chiave] = slot
+        offset[slot + 1] = offset[slot] + len(righe)
+    righe = np.fromiter(
+        (r for _, lista in voci for r in lista), dtype=np.int32, count=int(offset[-1])
+    )
+    return chiavi, offset, righe
+
+
+@dataclass(frozen=True)
+class IndiceToken:
+    testi: List[str]            # testo_completo minuscolo, per la verifica finale
+    gram_chiavi: Dict[str, int]
+    gram_offset: np.ndarray
+    gram_righe: np.ndarray
+    token_chiavi: Dict[str, int]
+    token_offset: np.ndarray
+    token_righe: np.ndarray
+
+    @classmethod
+    def costruisci(cls, testi: Sequence[str]) -> "IndiceToken":
+        grams: Dict[str, List[int]] = defaultdict(list)
+        tokens: Dict[str, List[int]] = defaultdict(list)
+        for i, x in enumerate(testi):
+            visti = set()
+            for n in range(1, N_MAX + 1):
+                for j in range(len(x) - n + 1):
+                    visti.add(x[j:j + n])
+            for g in visti:
+                grams[g].append(i)
+            for t in set(_TOKEN_RE.findall(x)):
+                tokens[t].append(i)
+        gk, go, gr = _csr(grams)
+        tk, to, tr = _csr(tokens)
+        return cls(list(testi), gk, go, gr, tk, to, tr)
+
+    # ---- persistenza (cartella dell'artefatto, array aperti in mmap) ----
+    def salva(self, cartella: str) -> List[str]:
+        with open(os.path.join(cartella, "token_chiavi.json"), "w", encoding="utf-8") as f:
+            json.dump({"gram": list(self.gram_chiavi), "token": list(self.token_chiavi)}, f, ensure_ascii=False)
+        for nome in ("gram_offset", "gram_righe", "token_offset", "token_righe"):
+            np.save(os.path.join(cartella, f"token_{nome}.npy"), getattr(self, nome))
+        return ["token_chiavi.json"] + [f"token_{n}.npy" for n in
+                                        ("gram_offset", "gram_righe", "token_offset", "token_righe")]
+
+    @classmethod
+    def carica(cls, cartella: str, testi: Sequence[str]) -> "IndiceToken":
+        with open(os.path.join(cartella, "token_chiavi.json"), encoding="utf-8") as f:
+            chiavi = json.load(f)
+        arr = {
+            nome: np.load(os.path.join(cartella, f"token_{nome}.npy"), mmap_mode="r")
+            for nome in ("gram_offset", "gram_righe", "token_offset", "token_righe")
+        }
+        return cls(
+            list(testi),
+            {k: i for i, k in enumerate(chiavi["gram"])}, arr["gram_offset"], arr["gram_righe"],
+            {k: i for i, k in enumerate(chiavi["token"])}, arr["token_offset"], arr["token_righe"],
+        )
+
+    @property
+    def n_righe(self) -> int:
+        return len(self.testi)
+
+    # ---- posting list ----
+    def _posting(self, chiavi, offset, righe, chiave: str) -> np.ndarray:
+        slot = chiavi.get(chiave)
+        if slot is None:
+            return righe[:0]
+        return righe[offset[slot]:offset[slot + 1]]
+
+    def _righe_sottostringa(self, k: str) -> np.ndarray:
+        # Sottostringhe lunghe fino a N_MAX: posting esatta.
+        # Più lunghe: intersezione dei trigrammi (sovrainsieme, da verificare).
+        if len(k) <= N_MAX:
+            return self._posting(self.gram_chiavi, self.gram_offset, self.gram_righe, k)
+        liste = sorted(
+            (self._posting(self.gram_chiavi, self.gram_offset, self.gram_righe, k[j:j + N_MAX])
+             for j in range(len(k) - N_MAX + 1)),
+            key=len,
+        )
+        out = liste[0]
+        for p in liste[1:]:
+            if out.size == 0:
+                break
+            out = np.intersect1d(out, p, assume_unique=True)
+        return out
+
+    # ---- filtro ----
+    def filtra(self, keywords: Sequence[str], exact_keywords: Sequence[str]) -> np.ndarray:
+        # Stessa semantica del filtro originale di app.py:
+        #   all(k in x for k in keywords) and all(re.search(rf"\b{re.escape(k)}\b", x) for k in exact_keywords)
+        # Restituisce le posizioni (ordinate) delle righe che lo soddisfano.
+        candidati: Optional[np.ndarray] = None
+        sub_da_verificare: List[str] = []
+        exact_da_verificare: List[re.Pattern] = []
+
+        for k in keywords:
+            p = self._righe_sottostringa(k)
+            if len(k) > N_MAX:
+                sub_da_verificare.append(k)
+            candidati = p if candidati is None else np.intersect1d(candidati, p, assume_unique=True)
+            if candidati.size == 0:
+                return candidati.astype(np.int64)
+
+        for k in exact_keywords:
+            if _TOKEN_RE.fullmatch(k):
+                # parola intera: \bk\b equivale a "k è uno dei token \w+ della riga"
+                p = self._posting(self.token_chiavi, self.token_offset, self.token_righe, k)
+            else:
+                p = self._righe_sottostringa(k)
+                exact_da_verificare.append(re.compile(rf"\b{re.escape(k)}\b"))
+            candidati = p if candidati is None else np.intersect1d(candidati, p, assume_unique=True)
+            if candidati.size == 0:
+                return candidati.astype(np.int64)
+
+        if candidati is None:
+            return np.arange(self.n_righe, dtype=np.int64)
+        if sub_da_verificare or exact_da_verificare:
+            testi = self.testi
+            candidati = np.fromiter(
+                (i for i in candidati.tolist()
+                 if all(k in testi[i] for k in sub_da_verificare)
+                 and all(r.search(testi[i]) for r in exact_da_verificare)),
+                dtype=np.int64,
+            )
+        return candidati.astype(np.int64)
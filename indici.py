@@ -0,0 +1,217 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import faiss
+
+# =========================
+# Tipi di indice vettoriale selezionabili in build_index.py (--indice)
+#   flat-l2   ricerca esatta L2 su vettori non normalizzati (artefatti storici)
+#   flat-ip   ricerca esatta, prodotto scalare su vettori normalizzati (= coseno)
+#   hnsw      grafo HNSW, coseno, approssimato
+#   ivf       IVF-Flat con nlist liste e nprobe liste visitate, coseno, approssimato
+# Il tipo e i parametri finiscono nel manifest ("indice") e app.py li legge da lì.
+#
+# Memorizzazione dei vettori (--vettori), per ogni tipo di indice:
+#   fp32   vettori float32 nell'indice e in vettori.npy (storico)
+#   fp16   float16 nell'indice (scalar quantizer) e in vettori.npy: metà memoria
+#   sq8    int8 per componente nell'indice (1/4), vettori.npy in float16
+#   pq     product quantization, pq_m byte per vettore (1/32 con 384 dim e
+#          pq_m=48), vettori.npy in float16
+# Con sq8 e pq l'indice restituisce `rerank` candidati, riordinati poi con i
+# vettori float di vettori.npy (mmap: si leggono solo le righe candidate).
+# Flat + pq è un IVF a una sola lista: esaustivo come flat, ma con il supporto
+# dei selettori di candidati che IndexPQ non ha. Hnsw + pq costruisce il grafo
+# sulle distanze approssimate: recall sensibilmente più basso delle altre
+# combinazioni (vedi --report-memoria in build_index.py).
+# =========================
+TIPI_INDICE = ("flat-l2", "flat-ip", "hnsw", "ivf")
+INFO_LEGACY = {"tipo": "flat-l2", "metrica": "l2", "normalizzato": False}
+
+VETTORI = ("fp32", "fp16", "sq8", "pq")
+DTYPE_VETTORI = {"fp32": "float32", "fp16": "float16", "sq8": "float16", "pq": "float16"}
+RERANK_PREDEFINITO = 100
+# faiss avvisa (e allena quantizzatori degeneri) sotto 39 righe di training per centroide
+MIN_RIGHE_CENTROIDE = 39
+_QT = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+
+def normalizza(vettori: np.ndarray) -> np.ndarray:
+    v = np.array(vettori, dtype="float32", copy=True, ndmin=2)
+    faiss.normalize_L2(v)
+    return v
+
+
+def normalizzato(tipo: str) -> bool:
+    # flat-l2 lavora sui vettori grezzi, gli altri tipi sul coseno
+    return tipo != "flat-l2"
+
+
+def _pq_m(dim: int, pq_m: Optional[int]) -> int:
+    # default: 8 componenti per sottoquantizzatore; pq_m deve dividere dim
+    m = max(1, min(pq_m or dim // 8, dim))
+    while dim % m:
+        m -= 1
+    return m
+
+
+def crea_indice(
+    tipo: str,
+    dim: int,
+    n_righe: int,
+    nlist: Optional[int] = None,
+    nprobe: int = 8,
+    hnsw_m: int = 32,
+    ef_construction: int = 80,
+    ef_search: int = 64,
+    vettori: str = "fp32",
+    pq_m: Optional[int] = None,
+    rerank: int = RERANK_PREDEFINITO,
+) -> Tuple[faiss.Index, Dict]:
+    if tipo not in TIPI_INDICE:
+        raise ValueError(f"Tipo di indice non riconosciuto: {tipo} (ammessi: {', '.join(TIPI_INDICE)})")
+    if vettori not in VETTORI:
+        raise ValueError(f"Memorizzazione vettori non riconosciuta: {vettori} (ammesse: {', '.join(VETTORI)})")
+    if not normalizzato(tipo):
+        info: Dict = dict(INFO_LEGACY)
+        metrica = faiss.METRIC_L2
+    else:
+        info = {"tipo": tipo, "metrica": "ip", "normalizzato": True}
+        metrica = faiss.METRIC_INNER_PRODUCT
+    info["vettori"] = vettori
+    if vettori == "pq":
+        # 2^pq_bit centroidi per sottoquantizzatore, faiss ne vuole >= 39 righe l'uno
+        if n_righe < 2 * MIN_RIGHE_CENTROIDE:
+            raise ValueError(
+                f"Troppe poche righe per vettori pq: {n_righe} (servono almeno {2 * MIN_RIGHE_CENTROIDE}, usare sq8)"
+            )
+        pq_bit = int(min(8, np.log2(n_righe // MIN_RIGHE_CENTROIDE)))
+        info.update(pq_m=_pq_m(dim, pq_m), pq_bit=pq_bit)
+    if vettori in ("sq8", "pq"):
+        info["rerank"] = rerank
+
+    if tipo == "hnsw":
+        if vettori == "fp32":
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, metrica)
+        elif vettori == "pq":
+            index = faiss.IndexHNSWPQ(dim, info["pq_m"], hnsw_m, info["pq_bit"], metrica)
+        else:
+            index = faiss.IndexHNSWSQ(dim, _QT[vettori], hnsw_m, metrica)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        info.update(M=hnsw_m, ef_construction=ef_construction, ef_search=ef_search)
+        return index, info
+
+    if tipo == "ivf" or vettori == "pq":
+        if tipo == "ivf" and n_righe < MIN_RIGHE_CENTROIDE:
+            raise ValueError(
+                f"Troppe poche righe per un indice ivf: {n_righe} (servono almeno {MIN_RIGHE_CENTROIDE}, usare flat-ip)"
+            )
+        if tipo == "ivf":
+            # regola pratica: ~sqrt(N) liste, almeno MIN_RIGHE_CENTROIDE vettori di training per lista
+            if nlist is None:
+                nlist = int(np.sqrt(max(n_righe, 1)))
+            nlist = max(1, min(nlist, n_righe // MIN_RIGHE_CENTROIDE or 1))
+        else:
+            nlist = nprobe = 1       # flat + pq: una lista, visitata sempre
+        quantizer = faiss.IndexFlatL2(dim) if metrica == faiss.METRIC_L2 else faiss.IndexFlatIP(dim)
+        if vettori == "fp32":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metrica)
+        elif vettori == "pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, info["pq_m"], info["pq_bit"], metrica)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, _QT[vettori], metrica)
+        index.nprobe = min(nprobe, nlist)
+        info.update(nlist=nlist, nprobe=index.nprobe)
+        return index, info
+
+    if vettori == "fp32":
+        return (faiss.IndexFlatL2(dim) if metrica == faiss.METRIC_L2 else faiss.IndexFlatIP(dim)), info
+    return faiss.IndexScalarQuantizer(dim, _QT[vettori], metrica), info
+
+
+def ripiego_piccolo(tipo: str, vettori: str, n_righe: int) -> Tuple[str, str]:
+    # Shard con troppe poche righe per allenare i quantizzatori di ivf/pq:
+    # ricerca esatta con la stessa metrica, vettori sq8 al posto di pq
+    # (stesso formato di vettori.npy, nessun clustering da allenare)
+    if vettori == "pq" and n_righe < 2 * MIN_RIGHE_CENTROIDE:
+        vettori = "sq8"
+    if tipo == "ivf" and n_righe < MIN_RIGHE_CENTROIDE:
+        tipo = "flat-ip"
+    return tipo, vettori
+
+
+def righe_training(info: Dict) -> int:
+    # IVF: ~256 vettori per lista; sq8/pq: campione ampio per intervalli e centroidi
+    n = 256 * info.get("nlist", 1)
+    if info.get("vettori") in ("sq8", "pq"):
+        n = max(n, 40 * 256)
+    return n
+
+
+def dtype_vettori(info: Dict) -> str:
+    return DTYPE_VETTORI[info.get("vettori", "fp32")]
+
+
+def esatto(info: Dict) -> bool:
+    # tutti i candidati visitati (con sq8/pq i punteggi esatti arrivano dal rerank)
+    return info["tipo"] in ("flat-l2", "flat-ip")
+
+
+def parametri_ricerca(info: Dict, sel: Optional[faiss.IDSelector] = None) -> faiss.SearchParameters:
+    if info["tipo"] == "hnsw":
+        # con il rerank la coda esplorata deve contenere tutti i candidati
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=max(info["ef_search"], info.get("rerank", 0)))
+    if "nprobe" in info:        # ivf, e flat + pq (IVF a una lista)
+        return faiss.SearchParametersIVF(sel=sel, nprobe=info["nprobe"])
+    return faiss.SearchParameters(sel=sel)
+
+
+def riordina_esatto(
+    info: Dict, vettori: np.ndarray, query: np.ndarray, I: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Candidati di un indice compresso riordinati con i vettori float
+    # dell'artefatto: si leggono solo le righe candidate
+    ip = info["metrica"] == "ip"
+    D_out = np.full((len(query), k), -np.inf if ip else np.inf, dtype="float32")
+    I_out = np.full((len(query), k), -1, dtype="int64")
+    for r in range(len(query)):
+        righe = I[r][I[r] >= 0]
+        if righe.size == 0:
+            continue
+        v = np.asarray(vettori[righe], dtype="float32")
+        d = v @ query[r] if ip else ((v - query[r]) ** 2).sum(axis=1)
+        ordine = np.argsort(-d if ip else d, kind="stable")[:k]
+        D_out[r, :ordine.size], I_out[r, :ordine.size] = d[ordine], righe[ordine]
+    return D_out, I_out
+
+
+def cerca_indice(
+    index: faiss.Index, info: Dict, vettori: np.ndarray, query: np.ndarray, k: int,
+    sel: Optional[faiss.IDSelector] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Ricerca sull'indice, con rerank esatto dei candidati se i vettori sono compressi
+    rerank = info.get("rerank", 0)
+    D, I = index.search(query, max(k, rerank), params=parametri_ricerca(info, sel))
+    if rerank:
+        return riordina_esatto(info, vettori, query, I, k)
+    return D, I
+
+
+def prepara_query(info: Dict, query_embeddings: np.ndarray) -> np.ndarray:
+    if info.get("normalizzato"):
+        return normalizza(query_embeddings)
+    return np.ascontiguousarray(np.atleast_2d(query_embeddings), dtype="float32")
+
+
+def cerca_esatta(
+    info: Dict, vettori: np.ndarray, query: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Brute force sui vettori passati (posizioni locali), stessa metrica dell'indice
+    metrica = faiss.METRIC_INNER_PRODUCT if info["metrica"] == "ip" else faiss.METRIC_L2
+    return faiss.knn(
+        np.ascontiguousarray(query, dtype="float32"),
+        np.ascontiguousarray(vettori, dtype="float32"),
+        k,
+        metric=metrica,
+    )
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import metriche
+
+# =========================
+# Testo di ricerca di una riga: Codice + Prodotto + Descrizione, minuscolo
+# (lo stesso usato da build_index.py per gli embedding)
+# =========================
+def testo_catalogo(df: pd.DataFrame) -> pd.Series:
+    return (
+        df["Codice"].fillna('').astype(str) + " " +
+        df["Prodotto"].fillna('').astype(str) + " " +
+        df["Descrizione"].fillna('').astype(str)
+    ).str.lower()
+
+
+# =========================
+# Indice codice -> riga del listino (costruito una volta con il catalogo)
+# =========================
+
+
+def normalizza_codice(codice) -> str:
+    # "96870610", 96870610 e 96870610.0 (colonna letta come float) sono lo stesso codice
+    s = str(codice).strip()
+    if s.endswith(".0") and s[:-2].isdigit():
+        s = s[:-2]
+    return s
+
+
+class RigaListino(NamedTuple):
+    posizione: int
+    codice: str
+    prodotto: str
+    prezzo: float
+    descrizione: str
+
+
+@dataclass(frozen=True)
+class IndiceCodici:
+    posizioni: Dict[str, int]   # codice normalizzato -> posizione (prima occorrenza)
+    prezzi: np.ndarray
+    prodotti: List[str]
+    descrizioni: List[str]
+    codici: List[str]           # codice normalizzato di ogni posizione ("" se assente)
+    chiavi: pd.Index            # codici normalizzati (chiavi di posizioni), per il join vettoriale
+    posizioni_chiavi: np.ndarray
+
+    @classmethod
+    def costruisci(cls, df: pd.DataFrame) -> "IndiceCodici":
+        posizioni: Dict[str, int] = {}
+        for pos, codice in enumerate(df["Codice"].tolist()):
+            if pd.isna(codice):
+                continue
+            posizioni.setdefault(normalizza_codice(codice), pos)
+        prezzi = df["Prezzo di listino"].to_numpy(dtype="float64", copy=True)
+        prezzi.setflags(write=False)
+        return cls(
+            posizioni,
+            prezzi,
+            # celle vuote -> "": un NaN finirebbe nelle risposte JSON del motore
+            df["Prodotto"].fillna("").tolist(),
+            df["Descrizione"].fillna("").tolist(),
+            ["" if pd.isna(c) else normalizza_codice(c) for c in df["Codice"].tolist()],
+            pd.Index(list(posizioni), dtype=object),
+            np.fromiter(posizioni.values(), dtype=np.int64, count=len(posizioni)),
+        )
+
+    def posizione(self, codice) -> Optional[int]:
+        return self.posizioni.get(normalizza_codice(codice))
+
+    def posizioni_di(self, codici: Iterable) -> np.ndarray:
+        # Join vettoriale codice -> posizione (-1 se assente). I codici già
+        # normalizzati (il caso comune: distinte del configuratore) passano da
+        # un solo get_indexer; solo quelli non trovati vengono normalizzati.
+        codici = list(codici)
+        if not codici:
+            return np.empty(0, dtype=np.int64)
+        with metriche.fase("listino.join"):
+            idx = self.chiavi.get_indexer(pd.Index(codici, dtype=object))
+            trovati = idx >= 0
+            pos = np.full(len(codici), -1, dtype=np.int64)
+            pos[trovati] = self.posizioni_chiavi[idx[trovati]]
+            for i in np.flatnonzero(~trovati).tolist():
+                pos[i] = self.posizioni.get(normalizza_codice(codici[i]), -1)
+        return pos
+
+    def riga(self, codice) -> Optional[RigaListino]:
+        pos = self.posizione(codice)
+        if pos is None:
+            return None
+        return RigaListino(pos, normalizza_codice(codice), self.prodotti[pos],
+                           float(self.prezzi[pos]), self.descrizioni[pos])
+
+    def risolvi(self, codici: Iterable) -> Tuple[List[Optional[RigaListino]], List[str]]:
+        # Per ogni codice la riga di listino (None se assente) + i codici mancanti in blocco
+        codici = list(codici)
+        righe = [
+            None if pos < 0 else
+            RigaListino(pos, self.codici[pos], self.prodotti[pos], float(self.prezzi[pos]), self.descrizioni[pos])
+            for pos in self.posizioni_di(codici).tolist()
+        ]
+        mancanti = [normalizza_codice(c) for c, r in zip(codici, righe) if r is None]
+        return righe, mancanti
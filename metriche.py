@@ -0,0 +1,222 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# =========================
+# Tempi per fase della pipeline dei preventivi
+#   with metriche.richiesta("preventivo"):      una richiesta (click, chiamata HTTP)
+#       with metriche.fase("ricerca.encode"):   una fase al suo interno
+# Ogni richiesta produce:
+#   - il dict fase -> secondi (pannello di debug di app.py)
+#   - una riga di log JSON sul logger "baltur.metriche"
+#   - osservazioni negli istogrammi di processo, esportati in formato testo
+#     Prometheus (GET /metriche di servizio.py) insieme alle statistiche delle cache
+# Disattivate (default, o BALTUR_METRICHE=0) fase() e richiesta() restituiscono
+# un contesto vuoto condiviso: un controllo di un bool per fase.
+# richiesta(..., forza=True) raccoglie i tempi di quella sola richiesta anche
+# con le metriche spente (pannello di debug di una sessione), senza log né
+# istogrammi: il resto del processo non ne risente.
+# =========================
+VARIABILE_ATTIVE = "BALTUR_METRICHE"
+BUCKET_SECONDI = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("baltur.metriche")
+
+_attive = False
+_tempi: ContextVar[Optional[Dict[str, float]]] = ContextVar("tempi_richiesta", default=None)
+
+
+def attive() -> bool:
+    return _attive
+
+
+def abilita(valore: bool = True) -> None:
+    global _attive
+    _attive = valore
+    if valore and not logger.handlers:
+        gestore = logging.StreamHandler(sys.stderr)
+        gestore.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(gestore)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+abilita(os.environ.get(VARIABILE_ATTIVE, "0").lower() in ("1", "true", "si", "sì", "on"))
+
+
+# =========================
+# Istogrammi di processo
+# =========================
+class Istogramma:
+    def __init__(self):
+        self.bucket = [0] * (len(BUCKET_SECONDI) + 1)      # ultimo = +Inf
+        self.somma = 0.0
+        self.conteggio = 0
+
+    def osserva(self, secondi: float) -> None:
+        self.bucket[bisect_left(BUCKET_SECONDI, secondi)] += 1
+        self.somma += secondi
+        self.conteggio += 1
+
+
+_lock = threading.Lock()
+_istogrammi: Dict[Tuple[str, str], Istogramma] = {}        # (metrica, nome) -> istogramma
+_statistiche: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+
+def osserva(metrica: str, nome: str, secondi: float) -> None:
+    with _lock:
+        ist = _istogrammi.get((metrica, nome))
+        if ist is None:
+            ist = _istogrammi[(metrica, nome)] = Istogramma()
+        ist.osserva(secondi)
+
+
+def registra_statistiche(nome: str, funzione: Callable[[], Dict[str, float]]) -> None:
+    # Gauge esportati a ogni dump: baltur_<nome>_<chiave> per i valori numerici
+    # (es. cache_query -> baltur_cache_query_hit_rate)
+    _statistiche[nome] = funzione
+
+
+def azzera() -> None:
+    with _lock:
+        _istogrammi.clear()
+
+
+# =========================
+# Fasi e richieste
+# =========================
+class _Fase:
+    __slots__ = ("nome", "inizio")
+
+    def __init__(self, nome: str):
+        self.nome = nome
+
+    def __enter__(self):
+        self.inizio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        durata = time.perf_counter() - self.inizio
+        tempi = _tempi.get()
+        if tempi is not None:
+            tempi[self.nome] = tempi.get(self.nome, 0.0) + durata    # fasi ripetute: somma
+        if _attive:
+            osserva("fase", self.nome, durata)
+        return False
+
+
+class _Nulla:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULLA = _Nulla()
+
+
+def fase(nome: str):
+    if not _attive and _tempi.get() is None:
+        return _NULLA
+    return _Fase(nome)
+
+
+@contextmanager
+def richiesta(nome: str, forza: bool = False, **campi) -> Iterator[Optional[Dict[str, float]]]:
+    # Dentro un'altra richiesta (app.py -> motore locale) conta come una sua fase
+    if _tempi.get() is not None:
+        with _Fase(nome):
+            yield _tempi.get()
+        return
+    if not _attive and not forza:
+        yield None
+        return
+    tempi: Dict[str, float] = {}
+    token = _tempi.set(tempi)
+    errore = None
+    inizio = time.perf_counter()
+    try:
+        yield tempi
+    except Exception as e:
+        errore = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        totale = time.perf_counter() - inizio
+        _tempi.reset(token)
+        tempi["totale"] = totale
+        if _attive:
+            _registra(nome, tempi, totale, errore, campi)
+
+
+def _registra(nome: str, tempi: Dict[str, float], totale: float, errore: Optional[str], campi: dict) -> None:
+    # Istogramma della richiesta e riga di log JSON
+    osserva("richiesta", nome, totale)
+    riga = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "evento": "richiesta",
+        "richiesta": nome,
+        "ms": round(totale * 1000, 3),
+        "fasi_ms": {f: round(s * 1000, 3) for f, s in tempi.items() if f != "totale"},
+        **campi,
+    }
+    if errore:
+        riga["errore"] = errore
+    logger.info(json.dumps(riga, ensure_ascii=False))
+
+
+# =========================
+# Esportazione Prometheus (formato testo 0.0.4)
+# =========================
+def _etichetta(valore: str) -> str:
+    return valore.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _nome_metrica(nome: str) -> str:
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in nome)
+
+
+def prometheus() -> str:
+    righe: List[str] = []
+    with _lock:
+        istogrammi = {k: (list(v.bucket), v.somma, v.conteggio) for k, v in _istogrammi.items()}
+    for metrica, etichetta, aiuto in (
+        ("fase", "fase", "Durata delle fasi della pipeline dei preventivi"),
+        ("richiesta", "richiesta", "Durata complessiva delle richieste"),
+    ):
+        nome = f"baltur_{metrica}_secondi"
+        righe += [f"# HELP {nome} {aiuto}", f"# TYPE {nome} histogram"]
+        for (m, valore), (bucket, somma, conteggio) in sorted(istogrammi.items()):
+            if m != metrica:
+                continue
+            lab = f'{etichetta}="{_etichetta(valore)}"'
+            cumulato = 0
+            for limite, n in zip(BUCKET_SECONDI + (float("inf"),), bucket):
+                cumulato += n
+                le = "+Inf" if limite == float("inf") else repr(limite)
+                righe.append(f'{nome}_bucket{{{lab},le="{le}"}} {cumulato}')
+            righe.append(f"{nome}_sum{{{lab}}} {somma!r}")
+            righe.append(f"{nome}_count{{{lab}}} {conteggio}")
+    for sorgente, funzione in sorted(_statistiche.items()):
+        try:
+            valori = funzione()
+        except Exception:
+            continue        # sorgente non ancora inizializzata
+        for chiave, valore in valori.items():
+            if isinstance(valore, bool) or not isinstance(valore, (int, float)):
+                continue
+            nome = _nome_metrica(f"baltur_{sorgente}_{chiave}")
+            righe += [f"# TYPE {nome} gauge", f"{nome} {float(valore)!r}"]
+    return "\n".join(righe) + "\n"
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import json
+import os
+import re
+import urllib.error
+import urllib.request
+from dataclasses import asdict, fields
+from typing import Optional, Sequence
+
+import metriche
+from listino import normalizza_codice
+from preventivo import Richiesta, prepara_preventivi, prezza_codici
+from ricerca import cerca_voci, parse_descrizione
+from rules_configuratore_mk import ConfigInput, statistiche_cache_distinte
+from tabella_configuratore import genera_distinta
+
+# =========================
+# Motore dei preventivi: ricerca, distinta del configuratore e preventivo
+# prezzato, con input e output JSON (dict/list semplici).
+#   MotoreLocale   modello e indice in questo processo (risorse.py)
+#   ClienteMotore  stessa interfaccia, chiamate HTTP a servizio.py
+# app.py usa il client se è impostata BALTUR_MOTORE_URL, altrimenti il
+# motore locale: più repliche della UI condividono un solo modello in RAM.
+# =========================
+VARIABILE_URL = "BALTUR_MOTORE_URL"
+_CAMPI_CFG = {f.name for f in fields(ConfigInput)}
+
+
+def cfg_da_dict(dati: Optional[dict]) -> Optional[ConfigInput]:
+    if not dati:
+        return None
+    if not isinstance(dati, dict):
+        raise ValueError("cfg deve essere un oggetto JSON")
+    sconosciuti = set(dati) - _CAMPI_CFG
+    if sconosciuti:
+        raise ValueError(f"Campi di configurazione non riconosciuti: {', '.join(sorted(sconosciuti))}")
+    if "macro" not in dati:
+        raise ValueError("cfg: manca il campo macro")
+    caldaie = dati.get("caldaie")
+    if caldaie is not None:
+        dati = dict(dati, caldaie=_leggi_caldaie(caldaie))
+    return ConfigInput(**dati)
+
+
+def _leggi_caldaie(caldaie) -> dict:
+    # oggetto {nome: qty} o coppie [nome, qty] (forma canonica di ConfigInput);
+    # quantità solo intere JSON >= 0: niente troncamenti di 2.5 o stringhe "3"
+    if isinstance(caldaie, dict):
+        coppie = list(caldaie.items())
+    elif isinstance(caldaie, (list, tuple)) and all(isinstance(c, (list, tuple)) and len(c) == 2 for c in caldaie):
+        coppie = caldaie
+    else:
+        raise ValueError(f"cfg: caldaie deve essere un oggetto {{nome: quantità}} o una lista di coppie [nome, quantità]: {caldaie!r}")
+    for nome, qty in coppie:
+        if not isinstance(nome, str):
+            raise ValueError(f"cfg: nome caldaia non valido: {nome!r}")
+        if isinstance(qty, bool) or not isinstance(qty, int) or qty < 0:
+            raise ValueError(f"cfg: quantità caldaie non valida per {nome}: {qty!r} (intero >= 0)")
+    return dict(coppie)
+
+
+def leggi_sconti(sconti) -> tuple:
+    # lista di percentuali o testo in cascata "50+10+5" (anche 7,5 o separati da ;)
+    originale = sconti
+    if isinstance(sconti, str):
+        sconti = [s.replace(",", ".") for s in re.split(r"[+;]", sconti) if s.strip()]
+    try:
+        sconti = tuple(float(s) for s in (sconti or ()))
+    except (TypeError, ValueError):
+        raise ValueError(f"Sconti non validi: {originale}")
+    if any(not 0 <= s <= 100 for s in sconti):
+        raise ValueError(f"Sconti fuori intervallo 0-100: {originale}")
+    return sconti
+
+
+class MotoreLocale:
+    # risorse.py (e sentence_transformers) importato solo se il motore è locale
+    def __init__(self, risorse=None):
+        self._risorse = risorse
+
+    @property
+    def risorse(self):
+        if self._risorse is None:
+            from risorse import get_risorse
+            return get_risorse()
+        return self._risorse
+
+    def riscalda(self) -> None:
+        if self._risorse is None:
+            from risorse import riscalda, sorveglia
+            riscalda()
+            sorveglia()         # ricarica a caldo del listino quando cambia l'artefatto
+
+    def stato(self) -> dict:
+        r = self.risorse
+        ricarica = {}
+        if self._risorse is None:
+            from risorse import statistiche_ricarica
+            ricarica = statistiche_ricarica()
+        return {
+            "listino": r.artefatto.hash,
+            "modello": r.model.nome,
+            "prodotti": len(r.df),
+            "indice": r.artefatto.info_indice,
+            "shard": [s.nome for s in r.router.shard] if r.router is not None else [],
+            "cache_query": r.cache_query.statistiche(),
+            "encoder": r.encoder.statistiche(),
+            "distinte": statistiche_cache_distinte(),
+            "metriche": metriche.attive(),
+            "ricarica": ricarica,
+        }
+
+    def metriche(self) -> str:
+        return metriche.prometheus()
+
+    def cerca(self, descrizione: str, k: int = 1, modalita: str = "ibrida") -> dict:
+        with metriche.richiesta("cerca", modalita=modalita):
+            return self._cerca(descrizione, k, modalita)
+
+    def _cerca(self, descrizione: str, k: int, modalita: str) -> dict:
+        r = self.risorse
+        codici = r.codici
+        voci = []
+        for risultato in cerca_voci(r, parse_descrizione(descrizione or ""), k=k, modalita=modalita):
+            voci.append({
+                "testo": risultato.voce.testo,
+                "quantita": risultato.voce.quantita,
+                "alternative": [
+                    {
+                        "codice": codici.codici[pos],
+                        "prodotto": codici.prodotti[pos],
+                        "descrizione": codici.descrizioni[pos],
+                        "prezzo_listino": float(codici.prezzi[pos]),
+                        "punteggio": float(punteggio),
+                    }
+                    for pos, punteggio in zip(risultato.righe.tolist(), risultato.punteggi.tolist())
+                ],
+            })
+        return {"listino": r.artefatto.hash, "voci": voci}
+
+    def distinta(self, cfg: dict) -> dict:
+        with metriche.richiesta("distinta"):
+            return self._distinta(cfg)
+
+    def _distinta(self, cfg: dict) -> dict:
+        # Righe del configuratore risolte sul listino, a prezzo di listino
+        config = cfg_da_dict(cfg)
+        if config is None:
+            raise ValueError("cfg mancante")
+        distinta = genera_distinta(config)
+        r = self.risorse
+        codici = r.codici
+        tabella = prezza_codici(codici, (item.code for item in distinta), [item.qty for item in distinta])
+        righe, mancanti = [], []
+        for item, pos, prezzo in zip(distinta, tabella.posizioni.tolist(), tabella.prezzo_listino.tolist()):
+            if pos < 0:
+                mancanti.append({"codice": normalizza_codice(item.code), "nome": item.name})
+                continue
+            righe.append({
+                "codice": codici.codici[pos], "nome": item.name, "quantita": item.qty,
+                "prodotto": codici.prodotti[pos], "descrizione": codici.descrizioni[pos], "prezzo_listino": prezzo,
+            })
+        return {"listino": r.artefatto.hash, "righe": righe, "mancanti": mancanti}
+
+    def preventivo(self, descrizione: str = "", cfg: Optional[dict] = None,
+                   sconti: Sequence[float] = (), modalita: str = "ibrida") -> dict:
+        with metriche.richiesta("preventivo", modalita=modalita):
+            richiesta = Richiesta(descrizione or "", cfg_da_dict(cfg), leggi_sconti(sconti))
+            p = prepara_preventivi(self.risorse, [richiesta], modalita=modalita)[0]
+        return {
+            "listino": p.listino,
+            "righe": [asdict(riga) for riga in p.righe],
+            "avvisi": p.avvisi,
+            "errori": p.errori,
+            "totale": p.totale,
+        }
+
+
+class ClienteMotore:
+    def __init__(self, url: str, timeout: float = 30.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _chiama(self, percorso: str, dati: Optional[dict] = None) -> dict:
+        corpo = None if dati is None else json.dumps(dati).encode("utf-8")
+        req = urllib.request.Request(
+            self.url + percorso, data=corpo, headers={"Content-Type": "application/json"},
+            method="GET" if corpo is None else "POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as risposta:
+                return json.load(risposta)
+        except urllib.error.HTTPError as e:
+            if e.code == 400:
+                # errore di validazione lato motore: stessa eccezione del motore locale
+                raise ValueError(json.load(e).get("errore", str(e)))
+            raise
+
+    def riscalda(self) -> None:
+        pass        # il servizio si riscalda da sé all'avvio
+
+    def stato(self) -> dict:
+        return self._chiama("/stato")
+
+    def metriche(self) -> str:
+        with urllib.request.urlopen(self.url + "/metriche", timeout=self.timeout) as risposta:
+            return risposta.read().decode("utf-8")
+
+    def cerca(self, descrizione: str, k: int = 1, modalita: str = "ibrida") -> dict:
+        return self._chiama("/cerca", {"descrizione": descrizione, "k": k, "modalita": modalita})
+
+    def distinta(self, cfg: dict) -> dict:
+        return self._chiama("/distinta", {"cfg": cfg})
+
+    def preventivo(self, descrizione: str = "", cfg: Optional[dict] = None,
+                   sconti: Sequence[float] = (), modalita: str = "ibrida") -> dict:
+        return self._chiama("/preventivo", {
+            "descrizione": descrizione, "cfg": cfg, "sconti": list(sconti), "modalita": modalita,
+        })
+
+
+_motore = None
+
+
+def get_motore():
+    global _motore
+    if _motore is None:
+        url = os.environ.get(VARIABILE_URL)
+        _motore = ClienteMotore(url) if url else MotoreLocale()
+    return _motore
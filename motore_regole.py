@@ -0,0 +1,124 @@
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Callable, List, Mapping, Sequence, Tuple, TypeVar, Union
+
+# =========================
+# Motore di regole a tabelle per i configuratori di prodotto
+# Una distinta è descritta da un albero di nodi (dati, non codice):
+#   Riga        riga di distinta con quantità fissa o presa dal contesto
+#   Decisione   sceglie un ramo in base a una grandezza del contesto
+#               (Scelta = dict su valori esatti, Intervalli = soglie)
+#   Errore      combinazione non valida: solleva l'eccezione
+#   sequenza    nodi valutati in ordine e concatenati
+#   None        nessuna riga
+# Le tabelle sono compilate una volta all'import (dict, soglie ordinate per
+# bisect) e valutate su un contesto di grandezze calcolate dall'input
+# (qty, potenze, attacchi...). Una nuova linea di prodotto è un nuovo albero
+# di dati, senza catene di if/elif.
+# =========================
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Errore:
+    # messaggio con segnaposto {grandezza} del contesto
+    messaggio: str
+    tipo: type = ValueError
+
+
+class Intervalli:
+    # Soglie ("<", 250, a), ("<=", 450, b) provate in ordine, poi "altrimenti".
+    # Compilate in una lista ordinata per bisect: "< s" diventa (s, 0),
+    # "<= s" diventa (s, 1), e x si cerca come (x, 0.5), che cade sempre
+    # strettamente tra le due forme della stessa soglia.
+    def __init__(self, soglie: Sequence[Tuple[str, float, object]], altrimenti: object = None):
+        chiavi = []
+        for op, soglia, _ in soglie:
+            if op not in ("<", "<="):
+                raise ValueError(f"Operatore di soglia non supportato: {op}")
+            chiavi.append((soglia, 0 if op == "<" else 1))
+        if chiavi != sorted(chiavi):
+            raise ValueError("Le soglie devono essere in ordine crescente")
+        self._chiavi = chiavi
+        self._rami = [ramo for _, _, ramo in soglie] + [altrimenti]
+
+    def __getitem__(self, x):
+        return self._rami[bisect_right(self._chiavi, (x, 0.5))]
+
+
+class Scelta:
+    # Dispatch su valore esatto, con ramo di default
+    def __init__(self, casi: Mapping, altrimenti: object = None):
+        self._casi = dict(casi)
+        self._altrimenti = altrimenti
+
+    def __getitem__(self, chiave):
+        return self._casi.get(chiave, self._altrimenti)
+
+
+@dataclass(frozen=True)
+class Decisione:
+    su: str                                  # grandezza del contesto
+    rami: Union[Scelta, Intervalli]
+
+
+@dataclass(frozen=True)
+class Riga:
+    # codice: chiave della tabella codici, oppure "$grandezza" del contesto
+    #         (riga omessa se vuota)
+    # qty:    intero, oppure nome di una grandezza del contesto
+    # opzionale: riga omessa se la quantità non è positiva
+    codice: str
+    nome: str
+    qty: Union[int, str] = 1
+    opzionale: bool = False
+
+
+Nodo = Union[Riga, Decisione, Errore, Sequence["Nodo"], None]
+
+
+def valore(nodo: Nodo, contesto: Mapping[str, object]):
+    # Segue le Decisione fino a una foglia (tabelle di valori, non di righe)
+    while isinstance(nodo, Decisione):
+        nodo = nodo.rami[contesto[nodo.su]]
+    if isinstance(nodo, Errore):
+        raise nodo.tipo(nodo.messaggio.format_map(contesto))
+    return nodo
+
+
+def espandi(
+    nodo: Nodo,
+    contesto: Mapping[str, object],
+    codici: Mapping[str, str],
+    fabbrica: Callable[[str, str, int], T],
+) -> List[T]:
+    out: List[T] = []
+    _espandi(nodo, contesto, codici, fabbrica, out)
+    return out
+
+
+def _espandi(nodo, contesto, codici, fabbrica, out) -> None:
+    # type(...) is: percorso caldo, chiamato per ogni nodo dell'albero
+    while type(nodo) is Decisione:
+        nodo = nodo.rami[contesto[nodo.su]]
+    if nodo is None:
+        return
+    tipo = type(nodo)
+    if tipo is Riga:
+        codice = nodo.codice
+        if codice[0] == "$":
+            codice = contesto.get(codice[1:])
+            if not codice:
+                return
+        else:
+            codice = codici[codice]
+        qty = nodo.qty if type(nodo.qty) is int else contesto[nodo.qty]
+        if nodo.opzionale and qty <= 0:
+            return
+        out.append(fabbrica(codice, nodo.nome, qty))
+    elif tipo is Errore:
+        valore(nodo, contesto)
+    else:
+        for figlio in nodo:
+            _espandi(figlio, contesto, codici, fabbrica, out)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+import metriche
+from listino import IndiceCodici, normalizza_codice
+from ricerca import cerca_voci, parse_descrizione
+from rules_configuratore_mk import ConfigInput, LineItem
+from tabella_configuratore import genera_distinta
+
+# =========================
+# Prezzatura di un preventivo, condivisa da app.py, motore.py e preventivo_batch.py:
+# stessa ricerca, stessa distinta del configuratore, stessi sconti in cascata.
+# I prezzi sono calcolati in blocco (array numpy), la formattazione è compito
+# di chi mostra il risultato.
+# =========================
+
+
+def fattore_sconti(sconti: Sequence[float]) -> float:
+    # Sconti in cascata ridotti a un solo fattore (es. 50 + 10 -> 0.45, cioè 55% complessivo)
+    fattore = 1.0
+    for sconto in sconti:
+        fattore *= (1 - sconto / 100)
+    return fattore
+
+
+@dataclass(frozen=True)
+class TabellaPrezzi:
+    # Una riga per articolo, colonne tipizzate
+    quantita: np.ndarray            # int64
+    prezzo_listino: np.ndarray      # float64, unitario di listino (NaN = codice assente)
+    prezzo_unitario: np.ndarray     # float64, unitario dopo gli sconti
+    prezzo_totale: np.ndarray       # float64, prezzo_unitario * quantita
+    posizioni: Optional[np.ndarray] = None   # int64, riga di listino (-1 = assente), se prezzata da codici
+
+    def __len__(self) -> int:
+        return len(self.quantita)
+
+    @property
+    def trovati(self) -> np.ndarray:
+        return ~np.isnan(self.prezzo_listino)
+
+    def totale(self) -> float:
+        return float(np.nansum(self.prezzo_totale))
+
+
+def prezza(prezzi_listino, quantita, fattore: Union[float, np.ndarray] = 1.0,
+           posizioni: Optional[np.ndarray] = None) -> TabellaPrezzi:
+    # fattore: uno per tutte le righe (fattore_sconti) o uno per riga
+    # (preventivi diversi prezzati insieme)
+    listino = np.asarray(prezzi_listino, dtype=np.float64)
+    quantita = np.asarray(quantita, dtype=np.int64)
+    unitario = listino * fattore
+    return TabellaPrezzi(quantita, listino, unitario, unitario * quantita, posizioni)
+
+
+def prezza_codici(codici: IndiceCodici, articoli: Iterable, quantita,
+                  fattore: Union[float, np.ndarray] = 1.0) -> TabellaPrezzi:
+    # (codice, quantità) -> prezzi, con un solo join sul listino
+    posizioni = codici.posizioni_di(articoli)
+    listino = np.full(len(posizioni), np.nan)
+    trovati = posizioni >= 0
+    listino[trovati] = codici.prezzi[posizioni[trovati]]
+    return prezza(listino, quantita, fattore, posizioni)
+
+
+@dataclass
+class RigaPreventivo:
+    origine: str                # "ricerca" | "configuratore"
+    voce: str                   # testo della voce richiesta o nome in distinta
+    codice: str
+    prodotto: str
+    descrizione: str
+    quantita: int
+    prezzo_unitario: float
+    prezzo_totale: float
+    punteggio: Optional[float] = None
+
+
+def messaggio_mancanti(mancanti: Sequence[Tuple[str, str]]) -> str:
+    return "Codici non trovati in listino: " + ", ".join(f"{c} ({nome})" for c, nome in mancanti)
+
+
+# =========================
+# Preventivo completo di una richiesta (descrizione libera + configuratore)
+# =========================
+@dataclass
+class Richiesta:
+    descrizione: str = ""
+    cfg: Optional[ConfigInput] = None
+    sconti: Tuple[float, ...] = ()          # vuoto = prezzi di listino
+    id: str = ""
+
+
+@dataclass
+class Preventivo:
+    richiesta: Richiesta
+    righe: List[RigaPreventivo] = field(default_factory=list)
+    avvisi: List[str] = field(default_factory=list)
+    errori: List[str] = field(default_factory=list)
+    listino: str = ""           # hash dell'artefatto su cui è stato prezzato
+
+    @property
+    def totale(self) -> float:
+        return sum(r.prezzo_totale for r in self.righe)
+
+
+def prepara_preventivi(risorse, richieste: Sequence[Richiesta],
+                       modalita: str = "ibrida") -> List[Preventivo]:
+    # Le voci di tutte le richieste vanno in un'unica cerca_voci (un encode, una search)
+    # e tutte le righe (ricerca + distinte) in un'unica prezzatura
+    voci_per_richiesta = [parse_descrizione(r.descrizione) for r in richieste]
+    risultati = cerca_voci(risorse, [v for voci in voci_per_richiesta for v in voci], k=1, modalita=modalita)
+    codici = risorse.codici
+
+    preventivi: List[Preventivo] = []
+    distinte: List[List[LineItem]] = []
+    inizio = 0
+    for richiesta, voci in zip(richieste, voci_per_richiesta):
+        p = Preventivo(richiesta, listino=risorse.artefatto.hash)
+        for risultato in risultati[inizio:inizio + len(voci)]:
+            if not risultato.trovato:
+                p.avvisi.append(f"Nessun prodotto trovato per: {risultato.voce.testo}")
+        inizio += len(voci)
+        distinta: List[LineItem] = []
+        if richiesta.cfg is not None:
+            try:
+                distinta = genera_distinta(richiesta.cfg)
+            except Exception as e:
+                p.errori.append(f"Configuratore: {e}")
+        preventivi.append(p)
+        distinte.append(distinta)
+
+    # Un solo join per i codici di tutte le distinte
+    pos_distinte = codici.posizioni_di(item.code for distinta in distinte for item in distinta).tolist()
+
+    # Righe di tutti i preventivi in ordine: (preventivo, voce, posizione, quantità, punteggio)
+    righe: List[Tuple[int, str, str, int, int, Optional[float]]] = []
+    inizio = fine_d = 0
+    for i, (p, voci, distinta) in enumerate(zip(preventivi, voci_per_richiesta, distinte)):
+        for risultato in risultati[inizio:inizio + len(voci)]:
+            if risultato.trovato:
+                righe.append((i, "ricerca", risultato.voce.testo, int(risultato.righe[0]),
+                              risultato.voce.quantita, float(risultato.punteggi[0])))
+        inizio += len(voci)
+        mancanti: List[Tuple[str, str]] = []
+        for item, pos in zip(distinta, pos_distinte[fine_d:fine_d + len(distinta)]):
+            if pos < 0:
+                mancanti.append((normalizza_codice(item.code), item.name))
+            else:
+                righe.append((i, "configuratore", item.name, pos, item.qty, None))
+        fine_d += len(distinta)
+        if mancanti:
+            p.avvisi.append(messaggio_mancanti(mancanti))
+
+    with metriche.fase("prezzatura"):
+        fattori = np.array([fattore_sconti(p.richiesta.sconti) for p in preventivi])
+        posizioni = np.array([r[3] for r in righe], dtype=np.int64)
+        tabella = prezza(
+            codici.prezzi[posizioni], [r[4] for r in righe],
+            fattori[np.array([r[0] for r in righe], dtype=np.int64)], posizioni,
+        )
+        for (i, origine, voce, pos, quantita, punteggio), unitario, totale in zip(
+            righe, tabella.prezzo_unitario.tolist(), tabella.prezzo_totale.tolist()
+        ):
+            preventivi[i].righe.append(RigaPreventivo(
+                origine, voce, codici.codici[pos], codici.prodotti[pos], codici.descrizioni[pos],
+                quantita, unitario, totale, punteggio,
+            ))
+    return preventivi
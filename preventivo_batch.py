@@ -0,0 +1,243 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+import faiss
+
+from motore import leggi_sconti
+from preventivo import Preventivo, Richiesta, prepara_preventivi
+from ricerca import MODALITA
+from risorse import get_risorse
+from rules_configuratore_mk import ConfigInput
+
+# =========================
+# Preventivi in blocco da riga di comando (stessa logica di app.py)
+#   python preventivo_batch.py richieste.xlsx preventivi.csv --workers 4
+# Colonne del file di richieste (tutte opzionali tranne almeno una tra
+# descrizione e macro):
+#   id            identificativo riportato in uscita (default: numero di riga)
+#   descrizione   testo libero, es. 2x pompa '300' + accumulo 200L
+#   sconti        sconti in cascata, es. 50+10+5 (vuoto = prezzi di listino)
+#   macro         INT_LINEA | INT_ISOLA | ESTERNO | SINGOLO_INT | SINGOLO_EST
+#   caldaie       cascate: es. MK 50=2; MK 115=1
+#   separatore, sottoopzione, ssb_code, sii_code, centralina    cascate
+#   modello, sottocategoria                                     singole
+# Uscita .csv o .jsonl, una riga per articolo più avvisi, errori e totale,
+# scritta man mano che i blocchi di richieste sono pronti. La riga del totale
+# riporta in "listino" l'hash dell'artefatto usato per i prezzi.
+# =========================
+COLONNE_USCITA = [
+    "id", "origine", "voce", "codice", "prodotto", "quantita",
+    "prezzo_unitario", "prezzo_totale", "punteggio", "nota", "listino",
+]
+_SEP_LISTA = re.compile(r"[;,\n]")
+
+
+# =========================
+# Lettura delle richieste
+# =========================
+def leggi_richieste(percorso: str) -> pd.DataFrame:
+    if percorso.lower().endswith((".xlsx", ".xls")):
+        df = pd.read_excel(percorso, dtype=str, keep_default_na=False)
+    else:
+        df = pd.read_csv(percorso, dtype=str, keep_default_na=False, sep=None, engine="python")
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df
+
+
+def _campo(riga: Dict[str, str], nome: str) -> Optional[str]:
+    valore = str(riga.get(nome, "")).strip()
+    return valore or None
+
+
+def _caldaie(testo: Optional[str]) -> Optional[Dict[str, int]]:
+    if not testo:
+        return None
+    caldaie: Dict[str, int] = {}
+    for parte in _SEP_LISTA.split(testo):
+        if not parte.strip():
+            continue
+        nome, sep, qty = parte.partition("=")
+        if not sep or not qty.strip().isdigit():
+            raise ValueError(f"Caldaie non valide: '{parte.strip()}' (atteso es. MK 50=2)")
+        nome = " ".join(nome.split()).upper()
+        caldaie[nome] = caldaie.get(nome, 0) + int(qty)
+    return caldaie
+
+
+def richiesta_da_riga(riga: Dict[str, str], numero: int) -> Richiesta:
+    macro = _campo(riga, "macro")
+    cfg = None
+    if macro:
+        macro = macro.upper()
+        cfg = ConfigInput(
+            macro=macro,
+            caldaie=_caldaie(_campo(riga, "caldaie")),
+            separatore=(_campo(riga, "separatore") or "").upper() or None,
+            sottoopzione=(_campo(riga, "sottoopzione") or "").upper() or None,
+            ssb_code=_campo(riga, "ssb_code"),
+            sii_code=_campo(riga, "sii_code"),
+            centralina=(_campo(riga, "centralina") or "").upper() or None,
+            singola_modello=_campo(riga, "modello"),
+            singola_sottocat=(_campo(riga, "sottocategoria") or "").upper() or None,
+        )
+    return Richiesta(
+        descrizione=_campo(riga, "descrizione") or "",
+        cfg=cfg,
+        sconti=leggi_sconti(_campo(riga, "sconti")),
+        id=_campo(riga, "id") or str(numero),
+    )
+
+
+# =========================
+# Righe di uscita
+# =========================
+def righe_uscita(p: Preventivo) -> List[dict]:
+    rid = p.richiesta.id
+    out = [
+        {
+            "id": rid, "origine": r.origine, "voce": r.voce, "codice": r.codice,
+            "prodotto": r.prodotto, "quantita": r.quantita,
+            "prezzo_unitario": round(r.prezzo_unitario, 2), "prezzo_totale": round(r.prezzo_totale, 2),
+            "punteggio": None if r.punteggio is None else round(r.punteggio, 4), "nota": None,
+        }
+        for r in p.righe
+    ]
+    out += [{"id": rid, "origine": "avviso", "nota": a} for a in p.avvisi]
+    out += [{"id": rid, "origine": "errore", "nota": e} for e in p.errori]
+    out.append({
+        "id": rid, "origine": "totale", "prezzo_totale": round(p.totale, 2),
+        "nota": "netto" if p.richiesta.sconti else "listino", "listino": p.listino,
+    })
+    return out
+
+
+def quota_blocco(righe: List[Dict[str, str]], inizio: int, modalita: str) -> List[dict]:
+    # Un blocco di richieste: una sola cerca_voci per tutte le voci del blocco.
+    # L'uscita segue l'ordine del file, richieste non valide comprese.
+    richieste: List[Richiesta] = []
+    esiti: List[object] = []            # Richiesta oppure riga di errore
+    for n, riga in enumerate(righe, start=inizio):
+        try:
+            r = richiesta_da_riga(riga, n)
+            richieste.append(r)
+            esiti.append(r)
+        except ValueError as e:
+            esiti.append({"id": _campo(riga, "id") or str(n), "origine": "errore", "nota": f"Richiesta: {e}"})
+    preventivi = iter(prepara_preventivi(get_risorse(), richieste, modalita=modalita))
+    out: List[dict] = []
+    for esito in esiti:
+        if isinstance(esito, dict):
+            out.append(esito)
+        else:
+            out.extend(righe_uscita(next(preventivi)))
+    return out
+
+
+# =========================
+# Pool di processi: modello e indice caricati una volta
+#   fork   il padre carica tutto prima di creare i worker, che condividono
+#          le pagine (copy-on-write; artefatto in mmap dalla page cache)
+#   spawn  ogni worker carica le risorse nell'initializer
+# =========================
+def _init_worker(thread: int) -> None:
+    # torch arriva con sentence_transformers: niente import se l'encoder non lo usa
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(thread)
+    faiss.omp_set_num_threads(thread)
+    get_risorse().precarica()
+
+
+def quota_file(righe: List[Dict[str, str]], workers: int, blocco: int, modalita: str) -> Iterator[List[dict]]:
+    blocchi = [(righe[i:i + blocco], i + 1) for i in range(0, len(righe), blocco)]
+    if workers <= 1:
+        for parte, inizio in blocchi:
+            yield quota_blocco(parte, inizio, modalita)
+        return
+    metodi = multiprocessing.get_all_start_methods()
+    contesto = multiprocessing.get_context("fork" if "fork" in metodi else "spawn")
+    thread = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(workers, mp_context=contesto, initializer=_init_worker, initargs=(thread,)) as pool:
+        yield from pool.map(
+            quota_blocco, [p for p, _ in blocchi], [i for _, i in blocchi], [modalita] * len(blocchi)
+        )
+
+
+class ScrittoreUscita:
+    # CSV o JSON Lines in base all'estensione, flush a ogni blocco
+    def __init__(self, percorso: str):
+        self.jsonl = percorso.lower().endswith((".jsonl", ".ndjson"))
+        self.f = sys.stdout if percorso == "-" else open(percorso, "w", encoding="utf-8", newline="")
+        if not self.jsonl:
+            self.csv = csv.DictWriter(self.f, COLONNE_USCITA, restval="")
+            self.csv.writeheader()
+
+    def scrivi(self, righe: List[dict]) -> None:
+        if self.jsonl:
+            for r in righe:
+                self.f.write(json.dumps({c: r.get(c) for c in COLONNE_USCITA}, ensure_ascii=False) + "\n")
+        else:
+            self.csv.writerows({k: v for k, v in r.items() if v is not None} for r in righe)
+        self.f.flush()
+
+    def chiudi(self) -> None:
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+def esegui(args) -> dict:
+    t0 = time.perf_counter()
+    righe = leggi_richieste(args.input).to_dict("records")
+    if args.workers <= 1 or "fork" in multiprocessing.get_all_start_methods():
+        get_risorse().precarica()      # con fork i worker ereditano il processo già caricato
+    t_caricamento = time.perf_counter() - t0
+
+    t1 = time.perf_counter()
+    scrittore = ScrittoreUscita(args.output)
+    n_righe = n_errori = 0
+    try:
+        for uscita in quota_file(righe, args.workers, args.blocco, args.modalita):
+            scrittore.scrivi(uscita)
+            n_righe += sum(r["origine"] in ("ricerca", "configuratore") for r in uscita)
+            n_errori += len({r["id"] for r in uscita if r["origine"] == "errore"})
+    finally:
+        scrittore.chiudi()
+    durata = time.perf_counter() - t1
+
+    stats = {
+        "richieste": len(righe),
+        "righe_prezzate": n_righe,
+        "richieste_con_errori": n_errori,
+        "caricamento_s": round(t_caricamento, 2),
+        "durata_s": round(durata, 2),
+        "preventivi_al_secondo": round(len(righe) / durata, 1) if durata > 0 else None,
+    }
+    print(
+        f"✅ {stats['richieste']} preventivi ({n_righe} righe, {n_errori} con errori) in {durata:.2f}s "
+        f"→ {stats['preventivi_al_secondo']} preventivi/s (caricamento {t_caricamento:.1f}s)",
+        file=sys.stderr,
+    )
+    return stats
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Preventivi in blocco da un file CSV/XLSX di richieste")
+    p.add_argument("input", help="file CSV o XLSX delle richieste")
+    p.add_argument("output", help="file di uscita .csv o .jsonl ('-' = stdout, CSV)")
+    p.add_argument("--workers", type=int, default=1, help="processi di quotazione")
+    p.add_argument("--blocco", type=int, default=32, help="richieste per blocco (una ricerca per blocco)")
+    p.add_argument("--modalita", choices=MODALITA, default="ibrida", help="modalità di ricerca")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    esegui(parse_args())
@@ -0,0 +1,259 @@
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import faiss
+
+import metriche
+from indici import cerca_esatta, cerca_indice, esatto, prepara_query
+
+STOPWORDS = {"da", "in", "di", "con", "e"}
+
+# Quanti vicini chiedere nella ricerca batch sull'unione dei candidati:
+# se per una voce nessuno dei primi K_BATCH cade nei suoi candidati si ripiega
+# su una ricerca dedicata (caso raro, risultato comunque esatto).
+K_BATCH = 256
+
+
+# =========================
+# Parsing della richiesta ("2x pompa '300' + accumulo 200L + ...")
+# =========================
+@dataclass
+class Voce:
+    testo: str                  # testo originale della voce (usato per l'embedding)
+    quantita: int
+    keywords: List[str]
+    exact_keywords: List[str]
+
+
+def parse_voce(singola: str) -> Voce:
+    query = singola.lower()
+
+    quantita = 1
+
+    quant_match = re.search(r"^\s*(\d+)\s*[xX]\s*", query)
+    if quant_match:
+        quantita = int(quant_match.group(1))
+        query = query[quant_match.end():]
+    else:
+        quant_match = re.search(r"[xX]\s*(\d+)$", query)
+        if quant_match:
+            quantita = int(quant_match.group(1))
+            query = query[:quant_match.start()]
+
+    keywords = [w for w in re.findall(r"\b\w{2,}\b", query) if w not in STOPWORDS]
+    exact_keywords = re.findall(r"'([^']+)'|\"([^\"]+)\"", singola)
+    exact_keywords = [ek[0] or ek[1] for ek in exact_keywords if ek[0] or ek[1]]
+
+    return Voce(singola, quantita, keywords, exact_keywords)
+
+
+def parse_descrizione(descrizione: str) -> List[Voce]:
+    return [parse_voce(s.strip()) for s in descrizione.split("+") if s.strip()]
+
+
+# =========================
+# Ricerca vettoriale sull'indice persistito (build_index.py)
+# Le query arrivano già preparate per l'indice (indici.prepara_query).
+# candidati=None vuol dire tutto il listino (nessun selettore).
+# =========================
+def cerca_tra_candidati(
+    artefatto,
+    query_embeddings: np.ndarray,
+    candidati: Optional[np.ndarray],
+    k: int = 1,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Cerca le query solo tra le righe (posizioni nel listino) sopravvissute
+    # al filtro parole chiave: nessun re-encoding dei candidati.
+    info = artefatto.info_indice
+    q = np.ascontiguousarray(np.atleast_2d(query_embeddings), dtype="float32")
+    if candidati is None:
+        return cerca_indice(artefatto.index, info, artefatto.vettori, q, k)
+    candidati = np.ascontiguousarray(candidati, dtype="int64")
+    D, I = cerca_indice(artefatto.index, info, artefatto.vettori, q, k, faiss.IDSelectorBatch(candidati))
+
+    # Con IVF/HNSW pochi candidati possono restare fuori dalle liste/dal grafo
+    # visitati: in quel caso ricerca esatta sui soli vettori candidati.
+    if not esatto(info):
+        attesi = min(k, candidati.size)
+        for r in np.flatnonzero((I >= 0).sum(axis=1) < attesi):
+            d, i = cerca_esatta(info, artefatto.vettori[candidati], q[r:r + 1], attesi)
+            D[r, :attesi], I[r, :attesi] = d[0], candidati[i[0]]
+    return D, I
+
+
+def cerca_batch(
+    artefatto,
+    query_embeddings: np.ndarray,
+    candidati: Sequence[Optional[np.ndarray]],
+    k: int = 1,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # Una sola search per tutte le voci, ristretta all'unione dei candidati;
+    # poi per ogni voce si tengono i primi k risultati che cadono nei suoi candidati.
+    if not candidati:
+        return []
+    n_totale = artefatto.index.ntotal
+    if any(c is None for c in candidati):
+        unione, n_unione = None, n_totale
+    else:
+        unione = np.unique(np.concatenate(candidati))
+        n_unione = unione.size
+    k_batch = int(min(n_unione, max(K_BATCH, k)))
+    D, I = cerca_tra_candidati(artefatto, query_embeddings, unione, k_batch)
+
+    out: List[Tuple[np.ndarray, np.ndarray]] = []
+    for q, cand in enumerate(candidati):
+        k_voce = min(k, n_totale if cand is None else cand.size)
+        validi = I[q] >= 0
+        if cand is not None and cand.size < n_unione:
+            validi &= np.isin(I[q], cand, assume_unique=True)
+        righe, dist = I[q][validi][:k_voce], D[q][validi][:k_voce]
+        if righe.size < k_voce:
+            d1, i1 = cerca_tra_candidati(artefatto, query_embeddings[q], cand, k_voce)
+            righe, dist = i1[0], d1[0]
+        out.append((righe, dist))
+    return out
+
+
+def _punteggio_denso(info, vettori: np.ndarray, righe: np.ndarray, q: np.ndarray) -> np.ndarray:
+    # Similarità esatta query-righe, "più alto = meglio" per entrambe le metriche
+    v = np.asarray(vettori[righe], dtype="float32")
+    if info["metrica"] == "ip":
+        return v @ q
+    return -((v - q) ** 2).sum(axis=1)
+
+
+def _min_max(x: np.ndarray) -> np.ndarray:
+    lo, hi = float(x.min()), float(x.max())
+    if hi - lo <= 1e-12:
+        return np.ones_like(x) if hi > 0 else np.zeros_like(x)
+    return (x - lo) / (hi - lo)
+
+
+# =========================
+# Pipeline completa: parse -> filtro -> un encode batch -> una search batch
+# Modalità:
+#   "rigorosa"  tutte le parole chiave devono comparire (filtro storico), poi ranking denso
+#   "ibrida"    candidati = top BM25 ∪ top denso, punteggio fuso; solo le parole
+#               chiave tra virgolette restano vincolanti
+# =========================
+MODALITA = ("ibrida", "rigorosa")
+K_MASSIMO = 50               # alternative per voce: oltre non si classifica mezzo listino
+K_CANDIDATI_IBRIDA = 100     # candidati per fonte (lessicale/densa) nella modalità ibrida
+PESO_DENSO = 0.5             # peso del punteggio denso nella fusione (1 - PESO_DENSO al BM25)
+
+
+@dataclass
+class RisultatoVoce:
+    voce: Voce
+    righe: np.ndarray           # posizioni nel listino, dalla migliore
+    punteggi: np.ndarray        # più alto = meglio (ibrida: fuso 0..1; rigorosa: coseno o -L2)
+
+    @property
+    def trovato(self) -> bool:
+        return self.righe.size > 0
+
+
+def _punteggi_faiss(info, dist: np.ndarray) -> np.ndarray:
+    return dist if info["metrica"] == "ip" else -dist
+
+
+def _sorgenti(risorse) -> List[Tuple[object, int]]:
+    # (sorgente, prima riga nel listino): l'artefatto intero o i suoi shard
+    if risorse.router is None:
+        return [(risorse.artefatto, 0)]
+    return [(s, s.inizio) for s in risorse.router.shard]
+
+
+def cerca_voci(risorse, voci: Sequence[Voce], k: int = 1, modalita: str = "ibrida") -> List[RisultatoVoce]:
+    if modalita not in MODALITA:
+        raise ValueError(f"Modalità di ricerca non riconosciuta: {modalita}")
+    if isinstance(k, bool) or not isinstance(k, (int, np.integer)) or not 1 <= k <= K_MASSIMO:
+        raise ValueError(f"Numero di alternative non valido: {k} (min 1, max {K_MASSIMO})")
+    artefatto = risorse.artefatto
+    info = artefatto.info_indice
+    sorgenti = _sorgenti(risorse)
+
+    # Con parole chiave vincolanti (modalità rigorosa o voci tra virgolette) si
+    # filtra in tutti gli shard: decide l'indice token, gli shard senza righe
+    # ammesse si saltano. Le altre voci vanno dove le manda il router.
+    vincolate = [modalita == "rigorosa" or bool(v.exact_keywords) for v in voci]
+    candidati = {}              # (voce, sorgente) -> posizioni locali ammesse, None = tutte
+    with metriche.fase("ricerca.filtro"):
+        for i, v in enumerate(voci):
+            if not vincolate[i]:
+                continue
+            keywords = v.keywords if modalita == "rigorosa" else []
+            for s, (sorgente, _) in enumerate(sorgenti):
+                c = sorgente.indice_token.filtra(keywords, v.exact_keywords)
+                if c.size > 0:
+                    candidati[i, s] = c
+    con_candidati = [
+        i for i in range(len(voci)) if not vincolate[i] or any((i, s) in candidati for s in range(len(sorgenti)))
+    ]
+
+    vuoto = np.empty(0, dtype=np.int64)
+    risultati = [RisultatoVoce(v, vuoto, vuoto.astype(np.float32)) for v in voci]
+    if not con_candidati or artefatto.manifest["n_righe"] == 0:
+        return risultati
+
+    with metriche.fase("ricerca.encode"):
+        query_embeddings = prepara_query(
+            info, risorse.cache_query.encode(risorse.encoder, [voci[i].testo for i in con_candidati])
+        )
+    with metriche.fase("ricerca.router"):
+        for j, i in enumerate(con_candidati):
+            if vincolate[i]:
+                continue
+            if risorse.router is None:
+                scelti = range(len(sorgenti))
+            else:
+                scelti = risorse.router.instrada(voci[i].testo, query_embeddings[j])
+            for s in scelti:
+                candidati[i, s] = None
+
+    # Ricerca per sorgente; i risultati (posizioni nel listino) si uniscono per voce
+    k_denso = k if modalita == "rigorosa" else max(k, K_CANDIDATI_IBRIDA)
+    parziali = {i: [] for i in con_candidati}
+    for s, (sorgente, inizio) in enumerate(sorgenti):
+        mie = [(j, i) for j, i in enumerate(con_candidati) if (i, s) in candidati]
+        if not mie or sorgente.index.ntotal == 0:
+            continue
+        q = query_embeddings[[j for j, _ in mie]]
+        with metriche.fase("ricerca.faiss"):
+            trovati = cerca_batch(sorgente, q, [candidati[i, s] for _, i in mie], k_denso)
+
+        if modalita == "rigorosa":
+            for (_, i), (righe, dist) in zip(mie, trovati):
+                parziali[i].append((righe + inizio, _punteggi_faiss(info, dist)))
+            continue
+
+        # Candidati della voce nella sorgente: top BM25 ∪ top denso
+        with metriche.fase("ricerca.fusione"):
+            bm25 = sorgente.bm25
+            for r, ((_, i), (righe, _)) in enumerate(zip(mie, trovati)):
+                score_lex = bm25.punteggi(voci[i].keywords)
+                righe_lex, _ = bm25.top_k(score_lex, K_CANDIDATI_IBRIDA, candidati[i, s])
+                condivise = np.union1d(righe[righe >= 0], righe_lex)
+                if condivise.size == 0:
+                    continue
+                denso = _punteggio_denso(info, sorgente.vettori, condivise, q[r])
+                parziali[i].append((condivise + inizio, denso, score_lex[condivise]))
+
+    for i, parti in parziali.items():
+        if not parti:
+            continue
+        if modalita == "rigorosa":
+            righe, punteggi = (np.concatenate(x) for x in zip(*parti))
+            ordine = np.argsort(-punteggi, kind="stable")[:k]
+            risultati[i] = RisultatoVoce(voci[i], righe[ordine], punteggi[ordine])
+            continue
+        # Fusione sul set condiviso (di tutti gli shard della voce)
+        with metriche.fase("ricerca.fusione"):
+            condivise, denso, lex = (np.concatenate(x) for x in zip(*parti))
+            fuso = PESO_DENSO * _min_max(denso) + (1 - PESO_DENSO) * _min_max(lex)
+            ordine = np.argsort(-fuso, kind="stable")[:k]
+            risultati[i] = RisultatoVoce(voci[i], condivise[ordine], fuso[ordine].astype(np.float32))
+    return risultati
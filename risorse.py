@@ -0,0 +1,238 @@
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import faiss
+
+import metriche
+from artefatto import Artefatto, hash_manifest
+from bm25 import IndiceBM25
+from cache_embedding import CacheEmbedding
+from encoder import Encoder, crea_encoder, nome_encoder, tipo_encoder
+from famiglie import Router
+from indice_token import IndiceToken
+from listino import IndiceCodici
+from scheduler_encoder import SchedulerEncoder
+from tabella_configuratore import get_tabella
+
+# =========================
+# Risorse condivise: modello, listino e indice caricati UNA volta per processo
+# e passati in sola lettura a tutte le sessioni Streamlit.
+# Ricarica a caldo: un thread (sorveglia) legge il manifest dell'artefatto ogni
+# INTERVALLO_RICARICA_S secondi; se l'hash cambia carica la nuova versione fuori
+# dalle richieste e la sostituisce in un colpo solo. Chi ha già preso le risorse
+# da get_risorse() finisce su quelle; le vecchie si liberano quando nessuno le
+# usa più. Modello, encoder e cache delle query restano gli stessi.
+# =========================
+PERCORSO_ARTEFATTO = "indice_listino"
+
+logger = logging.getLogger("baltur.risorse")
+
+# Encoder delle query (encoder.py): None = BALTUR_ENCODER, poi fp32.
+# Deve essere lo stesso con cui build_index.py ha costruito l'artefatto.
+TIPO_ENCODER: Optional[str] = None
+
+# Secondi tra due controlli del manifest (None o 0 = niente ricarica a caldo)
+INTERVALLO_RICARICA_S: Optional[float] = 5.0
+
+# Artefatti costruiti con --shard: ricerca per famiglia di prodotto tramite il
+# router (famiglie.py). False = sempre l'indice dell'intero listino.
+USA_SHARD = True
+
+# Cache degli embedding delle query, salvata accanto all'artefatto
+# (<artefatto>.cache_query.pkl; None = solo in memoria)
+CACHE_QUERY_MAX_VOCI = 2048
+SUFFISSO_CACHE_QUERY: Optional[str] = ".cache_query.pkl"
+
+# Micro-batching delle query tra sessioni concorrenti (scheduler_encoder.py)
+ENCODER_MAX_BATCH = 32
+ENCODER_MAX_ATTESA_MS = 5.0
+ENCODER_THREAD_TORCH: Optional[int] = None     # None = default di torch
+
+
+@dataclass(frozen=True)
+class Risorse:
+    model: Encoder
+    artefatto: Artefatto
+    cache_query: CacheEmbedding
+    encoder: SchedulerEncoder           # unico punto di accesso al modello per le query
+    usa_shard: bool = True              # False = indice completo anche con shard (report del router)
+
+    # Le parti dell'artefatto si caricano al primo accesso (vedi precarica)
+    @property
+    def df(self) -> pd.DataFrame:
+        return self.artefatto.df
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self.artefatto.vettori
+
+    @property
+    def index(self) -> faiss.Index:
+        return self.artefatto.index
+
+    @property
+    def testo_completo(self) -> pd.Series:   # Codice + Prodotto + Descrizione, minuscolo
+        return self.artefatto.testo_completo
+
+    @property
+    def indice_token(self) -> IndiceToken:
+        return self.artefatto.indice_token
+
+    @property
+    def bm25(self) -> IndiceBM25:
+        return self.artefatto.bm25
+
+    @cached_property
+    def codici(self) -> IndiceCodici:        # codice -> riga/prezzo/descrizione, per la distinta
+        return IndiceCodici.costruisci(self.df)
+
+    @cached_property
+    def router(self) -> Optional[Router]:    # None = artefatto senza shard (o USA_SHARD spento)
+        if not (USA_SHARD and self.usa_shard) or not self.artefatto.shard:
+            return None
+        return Router(self.artefatto.shard, self.artefatto.centroidi)
+
+    def precarica(self) -> None:
+        # con il router si caricano gli indici degli shard al posto di quelli completi
+        parti = ("df", "embeddings") + (("index", "indice_token", "bm25") if self.router is None else ()) + ("codici",)
+        for nome in parti:
+            with metriche.fase(f"carica.{nome}"):
+                getattr(self, nome)
+        for shard in self.router.shard if self.router is not None else ():
+            with metriche.fase(f"carica.shard.{shard.nome}"):
+                shard.precarica()
+        with metriche.fase("carica.tabella_configuratore"):
+            get_tabella()   # tabella del configuratore (rigenerata qui se le regole sono cambiate)
+
+
+def _percorso_cache_query() -> Optional[str]:
+    # fuori dalla cartella dell'artefatto, che build_index.py sostituisce intera
+    if not SUFFISSO_CACHE_QUERY:
+        return None
+    return os.path.abspath(PERCORSO_ARTEFATTO).rstrip(os.sep) + SUFFISSO_CACHE_QUERY
+
+
+def _carica() -> Risorse:
+    # Il manifest si controlla prima di caricare il modello: encoder diverso = errore subito
+    tipo = tipo_encoder(TIPO_ENCODER)
+    artefatto = Artefatto(PERCORSO_ARTEFATTO, modello=nome_encoder(tipo))
+
+    with metriche.fase("carica.modello"):
+        model = crea_encoder(tipo)
+
+    risorse = Risorse(
+        model=model,
+        artefatto=artefatto,
+        cache_query=CacheEmbedding(model.impronta, CACHE_QUERY_MAX_VOCI, _percorso_cache_query()),
+        encoder=SchedulerEncoder(model, ENCODER_MAX_BATCH, ENCODER_MAX_ATTESA_MS, ENCODER_THREAD_TORCH),
+    )
+    metriche.registra_statistiche("cache_query", risorse.cache_query.statistiche)
+    metriche.registra_statistiche("encoder", risorse.encoder.statistiche)
+    return risorse
+
+
+_lock = threading.Lock()
+_lock_ricarica = threading.Lock()
+_risorse: Optional[Risorse] = None
+_thread_riscaldamento: Optional[threading.Thread] = None
+_thread_sorveglianza: Optional[threading.Thread] = None
+_ricariche = {"ricariche": 0, "errori": 0, "ultimo_errore": None, "scartata": None}
+
+
+def get_risorse() -> Risorse:
+    global _risorse
+    if _risorse is None:
+        with _lock:
+            if _risorse is None:
+                _risorse = _carica()
+    return _risorse
+
+
+def riscalda(in_background: bool = True) -> None:
+    # Warm-up esplicito all'avvio: il primo utente non paga il caricamento.
+    # Idempotente: più chiamate (una per sessione/rerun) avviano un solo thread.
+    global _thread_riscaldamento
+    if not in_background:
+        get_risorse().precarica()
+        return
+    with _lock:
+        if _thread_riscaldamento is None:
+            _thread_riscaldamento = threading.Thread(
+                target=lambda: get_risorse().precarica(), name="riscaldamento-risorse", daemon=True
+            )
+            _thread_riscaldamento.start()
+
+
+# =========================
+# Ricarica a caldo dell'artefatto
+# =========================
+def ricarica() -> bool:
+    # Carica e mette in servizio la versione su disco, se diversa da quella servita.
+    # Il caricamento completo (catalogo, indici, codici) avviene prima dello scambio.
+    global _risorse
+    with _lock_ricarica:
+        attuali = get_risorse()
+        versione = hash_manifest(PERCORSO_ARTEFATTO)
+        if versione in (None, attuali.artefatto.hash, _ricariche["scartata"]):
+            return False
+        try:
+            with metriche.fase("carica.ricarica"):
+                nuove = replace(attuali, artefatto=Artefatto(PERCORSO_ARTEFATTO, modello=attuali.model.nome))
+                nuove.precarica()
+        except Exception:
+            _ricariche["scartata"] = versione     # non si riprova finché il manifest non cambia
+            raise
+        if hash_manifest(PERCORSO_ARTEFATTO) != nuove.artefatto.hash:
+            return False        # sostituito di nuovo durante il caricamento: si riprova al giro dopo
+        with _lock:
+            _risorse = nuove
+        _ricariche["ricariche"] += 1
+        return True
+
+
+def statistiche_ricarica() -> dict:
+    return dict(_ricariche, listino=get_risorse().artefatto.hash)
+
+
+def _sorveglia(intervallo_s: float) -> None:
+    while True:
+        time.sleep(intervallo_s)
+        try:
+            if ricarica():
+                logger.info("Listino ricaricato: %s", get_risorse().artefatto.hash[:12])
+        except Exception as e:
+            # artefatto nuovo non valido (es. altro encoder): si continua con quello in servizio
+            _ricariche["errori"] += 1
+            _ricariche["ultimo_errore"] = str(e)
+            logger.warning("Ricarica del listino non riuscita: %s", e)
+
+
+def sorveglia(intervallo_s: Optional[float] = None) -> None:
+    # Avvia il thread di ricarica a caldo. Idempotente, come riscalda.
+    global _thread_sorveglianza
+    intervallo_s = INTERVALLO_RICARICA_S if intervallo_s is None else intervallo_s
+    if not intervallo_s:
+        return
+    with _lock:
+        if _thread_sorveglianza is None:
+            _thread_sorveglianza = threading.Thread(
+                target=_sorveglia, args=(intervallo_s,), name="sorveglianza-listino", daemon=True
+            )
+            _thread_sorveglianza.start()
+    metriche.registra_statistiche("ricarica", statistiche_ricarica)
+
+
+if __name__ == "__main__":
+    # Verifica/preriscaldamento da riga di comando (es. nello script di avvio del server)
+    r = get_risorse()
+    r.precarica()
+    print(f"✅ Risorse caricate: {len(r.df)} prodotti, {len(r.embeddings)} vettori, "
+          f"{len(r.router.shard) if r.router is not None else 0} shard")
@@ -1,7 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple, Literal
 
+import metriche
+from motore_regole import Decisione, Errore, Intervalli, Riga, Scelta, espandi, valore
+
 # =========================
 # MODELLI & POTENZE (kW eq.)
 # =========================
@@ -99,6 +103,21 @@ C = {
     "KIT_TUBI_SCAMB_CIRC_DX": "96870015",
     "KIT_TUBI_SCAMB_CIRC_SX": "96870016",
 
+    # Singole: kit tubi scambiatore, INAIL 160, equilibratore
+    "KIT_TUBI_SCAMB_INT": "96870026",
+    "KIT_TUBI_SCAMB_INT_160": "96870027",
+    "KIT_INAIL_SMILE160_INT": "96870529",
+    "EQUIL_SINGOLA": "96870515",
+    "KIT_TUBI_EQUIL_SINGOLA": "96870512",
+    "ACC_EQUIL_SINGOLA": "96870500",
+
+    # Scambiatori SSB (singole)
+    "SSB_55": "96900326",
+    "SSB_68": "96900327",
+    "SSB_90": "96900328",
+    "SSB_115": "96900329",
+    "SSB_180": "96900331",
+
     # Centraline
     "ALPHA_MASTER": "96870212",
     "ALPHA_SLAVE": "96870213",
@@ -140,17 +159,39 @@ Separatore = Literal["NESSUNA", "SSB", "SII_PRO", "EQUILIBRATORE"]
 SottoOpz = Literal["KIT_TUBI", "KIT_TUBI_CIRC", "NESSUNA"]
 Centralina = Literal["ALPHA", "THETA", "OMEGA", "MODBUS", "0-10V"]
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class LineItem:
     code: str
     name: str
     qty: int = 1
 
-@dataclass
+Caldaie = Tuple[Tuple[str, int], ...]
+
+def canonizza_caldaie(caldaie) -> Optional[Caldaie]:
+    # Forma canonica del mix caldaie: nomi completi (alias normalizzati),
+    # quantità a zero scartate, ordine di BOILERS_POT (modelli ignoti in coda,
+    # così _potenze li segnala come prima). Accetta dict o coppie (nome, qty).
+    # Mix vuoto -> None (caldaie mancanti); solo quantità a zero -> () (numero
+    # caldaie non valido): gli stessi due errori di un dict non canonizzato.
+    if caldaie is None:
+        return None
+    coppie = list(caldaie.items() if isinstance(caldaie, dict) else caldaie)
+    if not coppie:
+        return None
+    qty: Dict[str, int] = {}
+    for nome, q in coppie:
+        if q == 0:
+            continue
+        std = _norm_boiler_name(nome)
+        qty[std] = qty.get(std, 0) + q
+    noti = [(m, qty.pop(m)) for m in BOILERS_POT if m in qty]
+    return tuple(noti + list(qty.items()))
+
+@dataclass(frozen=True, slots=True)
 class ConfigInput:
     macro: MacroCfg
     # cascata
-    caldaie: Optional[Dict[str, int]] = None
+    caldaie: Optional[Caldaie] = None       # canonizzato in __post_init__ (si può passare un dict)
     separatore: Optional[Separatore] = None
     sottoopzione: Optional[SottoOpz] = None
     ssb_code: Optional[str] = None
@@ -160,17 +201,20 @@ class ConfigInput:
     singola_modello: Optional[str] = None
     singola_sottocat: Optional[Literal["SSB", "EQUILIBRATORE"]] = None
 
+    def __post_init__(self):
+        object.__setattr__(self, "caldaie", canonizza_caldaie(self.caldaie))
+
 # =========================
 # Utilità comuni
 # =========================
 def _norm_boiler_name(name: str) -> str:
     return BOILERS_ALIAS.get(name, name)
 
-def _potenze(caldaie: Dict[str, int]) -> Tuple[int, int, int, Dict[int, int]]:
+def _potenze(caldaie: Caldaie) -> Tuple[int, int, int, Dict[int, int]]:
     qty = 0
     potenze = []
     attacchi = {80: 0, 100: 0}
-    for k, q in caldaie.items():
+    for k, q in caldaie:
         std = _norm_boiler_name(k)
         if std not in BOILERS_POT:
             raise ValueError(f"Modello non riconosciuto: {k}")
@@ -187,461 +231,393 @@ def _potenze(caldaie: Dict[str, int]) -> Tuple[int, int, int, Dict[int, int]]:
     pmax = max(potenze) if potenze else 0
     return qty, ptot, pmax, attacchi
 
-def _valvola_inail_cascata(pmax: int) -> LineItem:
-    if pmax in (46, 61):
-        return LineItem(C["VALV_2_7_BAR_1\":1_1_4F"], 'VALV. INAIL 2.7 BAR 1"Fx1"1/4F', 1)
-    return LineItem(C["VALV_4_BAR_1\":1_1_4F"], 'VALV. INAIL 4 BAR 1"Fx1"1/4F', 1)
-
-def _valvola_interc_comb(ptot: int) -> Optional[LineItem]:
-    if ptot < 250:
-        return LineItem(C["VALV_INT_COMB_1"], 'VALVOLA INTERC.NE COMB. 1"')
-    if 250 <= ptot <= 450:
-        return LineItem(C["VALV_INT_COMB_1_1_2"], 'VALVOLA INTERC.NE COMB. 1"1/2')
-    return None
-
-# =========================
-# Telai
-# =========================
-def _telai_linea(qty: int) -> List[LineItem]:
-    if qty == 2:
-        return [LineItem(C["TELAIO_MURO_2E"], "KIT TELAIO MURO 2ELEM. ENERGY", 1)]
-    if qty == 3:
-        return [
-            LineItem(C["TELAIO_MURO_2E"], "KIT TELAIO MURO 2ELEM. ENERGY", 1),
-            LineItem(C["TELAIO_MURO_1E"], "KIT TELAIO MURO 1ELEM. ENERGY", 1),
-        ]
-    if qty == 4:
-        return [LineItem(C["TELAIO_MURO_2E"], "KIT TELAIO MURO 2ELEM. ENERGY", 2)]
-    raise ValueError("qty non gestita per telai linea")
-
-def _telai_isola(qty: int) -> List[LineItem]:
-    if qty == 2:
-        return [LineItem(C["TELAIO_ISOLA_2E"], "KIT TELAIO ISOLA 2ELEM. ENERGY", 1)]
-    if qty in (3, 4):
-        return [LineItem(C["TELAIO_ISOLA_4E"], "KIT TELAIO ISOLA 4ELEM. ENERGY", 1)]
-    raise ValueError("qty non gestita per telai isola")
-
-# =========================
-# Collettori
-# =========================
-def _collettori_linea(qty: int) -> List[LineItem]:
-    if qty == 2:
-        return [
-            LineItem(C["COLL_GAS_2E"], "KIT COLLETTORE GAS 2E", 1),
-            LineItem(C["COLL_MIRI_2E"], "KIT COLLETTORE MI-RI 2E", 1),
-            LineItem(C["COLL_SC_COND_2E"], "KIT COLLETTORE SC.COND. 2E", 1),
-        ]
-    if qty == 3:
-        return [
-            LineItem(C["COLL_GAS_2E"], "KIT COLLETTORE GAS 2E", 1),
-            LineItem(C["COLL_GAS_1E"], "KIT COLLETTORE GAS 1E", 1),
-            LineItem(C["COLL_MIRI_2E"], "KIT COLLETTORE MI-RI 2E", 1),
-            LineItem(C["COLL_MIRI_1E"], "KIT COLLETTORE MI-RI 1E", 1),
-            LineItem(C["COLL_SC_COND_2E"], "KIT COLLETTORE SC.COND. 2E", 1),
-            LineItem(C["COLL_SC_COND_1E"], "KIT COLLETTORE SC.COND. 1E", 1),
-        ]
-    if qty == 4:
-        return [
-            LineItem(C["COLL_GAS_2E"], "KIT COLLETTORE GAS 2E", 2),
-            LineItem(C["COLL_MIRI_2E"], "KIT COLLETTORE MI-RI 2E", 2),
-            LineItem(C["COLL_SC_COND_2E"], "KIT COLLETTORE SC.COND. 2E", 2),
-        ]
-    raise ValueError("qty non gestita per collettori linea")
-
-def _collettori_isola(qty: int) -> List[LineItem]:
-    if qty == 2:
-        return [
-            LineItem(C["COLL_GAS_1E"], "KIT COLLETTORE GAS 1E", 1),
-            LineItem(C["COLL_MIRI_1E"], "KIT COLLETTORE MI-RI 1E", 1),
-            LineItem(C["COLL_SC_COND_1E"], "KIT COLLETTORE SC.COND. 1E", 1),
-            LineItem(C["COLL_ISOLA_EXTRA"], "ACCESSORIO ISOLA", 1),
-        ]
-    if qty == 3:
-        return [
-            LineItem(C["COLL_GAS_2E"], "KIT COLLETTORE GAS 2E", 1),
-            LineItem(C["COLL_GAS_1E"], "KIT COLLETTORE GAS 1E", 1),
-            LineItem(C["COLL_MIRI_2E"], "KIT COLLETTORE MI-RI 2E", 1),
-            LineItem(C["COLL_MIRI_1E"], "KIT COLLETTORE MI-RI 1E", 1),
-            LineItem(C["COLL_SC_COND_2E"], "KIT COLLETTORE SC.COND. 2E", 1),
-            LineItem(C["COLL_SC_COND_1E"], "KIT COLLETTORE SC.COND. 1E", 1),
-            LineItem(C["COLL_ISOLA_EXTRA"], "ACCESSORIO ISOLA", 1),
-        ]
-    if qty == 4:
-        return [
-            LineItem(C["COLL_GAS_2E"], "KIT COLLETTORE GAS 2E", 2),
-            LineItem(C["COLL_MIRI_2E"], "KIT COLLETTORE MI-RI 2E", 2),
-            LineItem(C["COLL_SC_COND_2E"], "KIT COLLETTORE SC.COND. 2E", 2),
-            LineItem(C["COLL_ISOLA_EXTRA"], "ACCESSORIO ISOLA", 1),
-        ]
-    raise ValueError("qty non gestita per collettori isola")
-
 # =========================
-# Fumisteria (interno)
+# REGOLE A TABELLE (vedi motore_regole.py)
+# Ogni scelta è una Decisione su una grandezza del contesto:
+#   cascata  macro, qty, ptot, pmax, att80/att100, separatore, sottoopzione, centralina
+#   singole  macro, sottocat, modello
+# Le potenze sono kW interi: le soglie "<= 160" / "<= 260" coprono
+# esattamente le fasce 0-160 / 161-260 / oltre.
 # =========================
-def _fumisteria_linea(ptot: int, attacchi: Dict[int, int]) -> List[LineItem]:
-    items: List[LineItem] = []
-    if ptot <= 160:
-        if attacchi[80] > 0:
-            items.append(LineItem(C["KIT_FUMI_D125_AT80"], "KIT COL.RE FUMI D125 AT.DN80", attacchi[80]))
-        items.append(LineItem(C["TAPPO_D125"], "TAPPO COL.RE FUMI D125", 1))
-    elif 161 <= ptot <= 260:
-        if attacchi[80] > 0:
-            items.append(LineItem(C["KIT_FUMI_D160_AT80"], "KIT COL.RE FUMI D160 AT.DN80", attacchi[80]))
-        if attacchi[100] > 0:
-            items.append(LineItem(C["KIT_FUMI_D160_AT100"], "KIT COL.RE FUMI D160 AT.DN100", attacchi[100]))
-        items.append(LineItem(C["TAPPO_D160"], "TAPPO COL.RE FUMI D160", 1))
-    else:
-        if attacchi[80] > 0:
-            items.append(LineItem(C["KIT_FUMI_D200_AT80"], "KIT COL.RE FUMI D200 AT.DN80", attacchi[80]))
-        if attacchi[100] > 0:
-            items.append(LineItem(C["KIT_FUMI_D200_AT100"], "KIT COL.RE FUMI D200 AT.DN100", attacchi[100]))
-        items.append(LineItem(C["TAPPO_D200"], "TAPPO COL.RE FUMI D200", 1))
-    return items
+def _att(codice: str, nome: str, attacco: str) -> Riga:
+    # riga per attacco fumi (att80/att100), omessa se non ci sono caldaie con quell'attacco
+    return Riga(codice, nome, attacco, opzionale=True)
+
+KIT_INAIL_ORIZZ = Riga("KIT_INAIL_ORIZZ", "KIT INAIL ORIZZONTALE")
+
+VALVOLA_INAIL = Decisione("pmax", Scelta(
+    {
+        46: Riga("VALV_2_7_BAR_1\":1_1_4F", 'VALV. INAIL 2.7 BAR 1"Fx1"1/4F'),
+        61: Riga("VALV_2_7_BAR_1\":1_1_4F", 'VALV. INAIL 2.7 BAR 1"Fx1"1/4F'),
+    },
+    Riga("VALV_4_BAR_1\":1_1_4F", 'VALV. INAIL 4 BAR 1"Fx1"1/4F'),
+))
+
+VALVOLA_COMB = Decisione("ptot", Intervalli([
+    ("<", 250, Riga("VALV_INT_COMB_1", 'VALVOLA INTERC.NE COMB. 1"')),
+    ("<=", 450, Riga("VALV_INT_COMB_1_1_2", 'VALVOLA INTERC.NE COMB. 1"1/2')),
+]))
+
+CIRCOLATORE = Decisione("ptot", Intervalli(
+    [("<", 280, Riga("CIRC_MAGNA1_50_100", "CIRCOLATORE SECONDARIO"))],
+    Riga("CIRC_MAGNA1_65_150", "CIRCOLATORE SECONDARIO"),
+))
+
+def _per_dn(righe) -> Decisione:
+    # righe(dn) per equilibratore DN65 (ptot < 280) o DN100
+    return Decisione("ptot", Intervalli([("<", 280, righe("DN65"))], righe("DN100")))
+
+# --- Telai ---
+TELAI = Decisione("macro", Scelta({
+    "INT_LINEA": Decisione("qty", Scelta({
+        2: [Riga("TELAIO_MURO_2E", "KIT TELAIO MURO 2ELEM. ENERGY")],
+        3: [Riga("TELAIO_MURO_2E", "KIT TELAIO MURO 2ELEM. ENERGY"),
+            Riga("TELAIO_MURO_1E", "KIT TELAIO MURO 1ELEM. ENERGY")],
+        4: [Riga("TELAIO_MURO_2E", "KIT TELAIO MURO 2ELEM. ENERGY", 2)],
+    }, Errore("qty non gestita per telai linea"))),
+    "INT_ISOLA": Decisione("qty", Scelta({
+        2: [Riga("TELAIO_ISOLA_2E", "KIT TELAIO ISOLA 2ELEM. ENERGY")],
+        3: [Riga("TELAIO_ISOLA_4E", "KIT TELAIO ISOLA 4ELEM. ENERGY")],
+        4: [Riga("TELAIO_ISOLA_4E", "KIT TELAIO ISOLA 4ELEM. ENERGY")],
+    }, Errore("qty non gestita per telai isola"))),
+    # ESTERNO: nessun telaio
+}))
+
+# --- Collettori ---
+COLLETTORI_LINEA = Decisione("qty", Scelta({
+    2: [Riga("COLL_GAS_2E", "KIT COLLETTORE GAS 2E"),
+        Riga("COLL_MIRI_2E", "KIT COLLETTORE MI-RI 2E"),
+        Riga("COLL_SC_COND_2E", "KIT COLLETTORE SC.COND. 2E")],
+    3: [Riga("COLL_GAS_2E", "KIT COLLETTORE GAS 2E"),
+        Riga("COLL_GAS_1E", "KIT COLLETTORE GAS 1E"),
+        Riga("COLL_MIRI_2E", "KIT COLLETTORE MI-RI 2E"),
+        Riga("COLL_MIRI_1E", "KIT COLLETTORE MI-RI 1E"),
+        Riga("COLL_SC_COND_2E", "KIT COLLETTORE SC.COND. 2E"),
+        Riga("COLL_SC_COND_1E", "KIT COLLETTORE SC.COND. 1E")],
+    4: [Riga("COLL_GAS_2E", "KIT COLLETTORE GAS 2E", 2),
+        Riga("COLL_MIRI_2E", "KIT COLLETTORE MI-RI 2E", 2),
+        Riga("COLL_SC_COND_2E", "KIT COLLETTORE SC.COND. 2E", 2)],
+}, Errore("qty non gestita per collettori linea")))
+
+COLLETTORI = Decisione("macro", Scelta({
+    "INT_LINEA": COLLETTORI_LINEA,
+    "INT_ISOLA": Decisione("qty", Scelta({
+        2: [Riga("COLL_GAS_1E", "KIT COLLETTORE GAS 1E"),
+            Riga("COLL_MIRI_1E", "KIT COLLETTORE MI-RI 1E"),
+            Riga("COLL_SC_COND_1E", "KIT COLLETTORE SC.COND. 1E"),
+            Riga("COLL_ISOLA_EXTRA", "ACCESSORIO ISOLA")],
+        3: [Riga("COLL_GAS_2E", "KIT COLLETTORE GAS 2E"),
+            Riga("COLL_GAS_1E", "KIT COLLETTORE GAS 1E"),
+            Riga("COLL_MIRI_2E", "KIT COLLETTORE MI-RI 2E"),
+            Riga("COLL_MIRI_1E", "KIT COLLETTORE MI-RI 1E"),
+            Riga("COLL_SC_COND_2E", "KIT COLLETTORE SC.COND. 2E"),
+            Riga("COLL_SC_COND_1E", "KIT COLLETTORE SC.COND. 1E"),
+            Riga("COLL_ISOLA_EXTRA", "ACCESSORIO ISOLA")],
+        4: [Riga("COLL_GAS_2E", "KIT COLLETTORE GAS 2E", 2),
+            Riga("COLL_MIRI_2E", "KIT COLLETTORE MI-RI 2E", 2),
+            Riga("COLL_SC_COND_2E", "KIT COLLETTORE SC.COND. 2E", 2),
+            Riga("COLL_ISOLA_EXTRA", "ACCESSORIO ISOLA")],
+    }, Errore("qty non gestita per collettori isola"))),
+    "ESTERNO": COLLETTORI_LINEA,     # collettori come interno in linea (richiesta)
+}))
+
+# --- Accessori per separatore ---
+SSB_SELEZIONATO = Riga("$ssb_code", "SCAMBIATORE SSB SELEZIONATO")
+SII_SELEZIONATO = Riga("$sii_code", "SCAMBIATORE SII PRO SELEZIONATO")
+
+ACCESSORI = Decisione("separatore", Scelta({
+    "NESSUNA": [KIT_INAIL_ORIZZ, VALVOLA_INAIL, VALVOLA_COMB],
+    "SSB": Decisione("sottoopzione", Scelta({
+        None: Errore("Per SSB serve la sotto-opzione."),
+        "KIT_TUBI": [Riga("KIT_TUBI_SCAMB_DX", "KIT TUBI SCAMBIATORE BOX DX"),
+                     VALVOLA_INAIL, VALVOLA_COMB, SSB_SELEZIONATO],
+        "KIT_TUBI_CIRC": [Riga("KIT_TUBI_SCAMB_CIRC_DX", "KIT TUBI SCAMB.-CIRCOL. BOX DX"),
+                          VALVOLA_INAIL, CIRCOLATORE, VALVOLA_COMB, SSB_SELEZIONATO],
+    }, [KIT_INAIL_ORIZZ, VALVOLA_INAIL, VALVOLA_COMB, SSB_SELEZIONATO])),
+    "SII_PRO": [KIT_INAIL_ORIZZ, VALVOLA_INAIL, VALVOLA_COMB, SII_SELEZIONATO],
+    "EQUILIBRATORE": Decisione("sottoopzione", Scelta({
+        None: Errore("Per EQUILIBRATORE serve la sotto-opzione."),
+        "KIT_TUBI": [
+            _per_dn(lambda dn: [Riga(f"EQUIL_{dn}", f"EQUILIBRATORE BOX {dn}"),
+                                Riga(f"KIT_TUBI_EQUIL_{dn}", f"KIT TUBI EQUILIBRATORE BOX {dn}")]),
+            VALVOLA_INAIL, VALVOLA_COMB,
+        ],
+        "KIT_TUBI_CIRC": [
+            _per_dn(lambda dn: [Riga(f"EQUIL_{dn}", f"EQUILIBRATORE BOX {dn}"),
+                                Riga(f"KIT_TUBI_EQUIL_CIRC_{dn}", f"KIT TUBI EQUIL.-CIRC. BOX {dn}")]),
+            VALVOLA_INAIL, CIRCOLATORE, VALVOLA_COMB,
+        ],
+    }, [
+        KIT_INAIL_ORIZZ, VALVOLA_INAIL,
+        _per_dn(lambda dn: Riga(f"EQUIL_{dn}", f"EQUILIBRATORE BOX {dn}")),
+        VALVOLA_COMB,
+    ])),
+}, Errore("Separatore non riconosciuto")))
+
+# --- Fumisteria (interno) / terminali (esterno) ---
+def _fumi_isola(d: str) -> list:
+    collettore = Riga(f"COLL_ISOLA_{d}", f"COLLETTORE ISOLA {d}")
+    collettore_x2 = Riga(f"COLL_ISOLA_{d}", f"COLLETTORE ISOLA {d}", 2)
+    tappo = Riga(f"TAPPO_ISOLA_{d}", f"TAPPO COL.RE FUMI {d}")
+    return [
+        Decisione("qty", Scelta({
+            2: [collettore, tappo],
+            3: [collettore_x2, tappo, Riga("TAPPO_ISOLA", "TAPPO ACCESSORIO ISOLA")],
+            4: [collettore_x2],
+        })),
+        _att("ADATT_ISOLA_AT80", "ADATTATORE ISOLA AT80", "att80"),
+        _att("ADATT_ISOLA_AT100", "ADATTATORE ISOLA AT100", "att100"),
+    ]
 
-def _fumisteria_isola(ptot: int, attacchi: Dict[int, int], qty: int) -> List[LineItem]:
-    items: List[LineItem] = []
-    if ptot <= 260:
-        if qty == 2:
-            items.append(LineItem(C["COLL_ISOLA_D160"], "COLLETTORE ISOLA D160", 1))
-            items.append(LineItem(C["TAPPO_ISOLA_D160"], "TAPPO COL.RE FUMI D160", 1))
-        elif qty == 3:
-            items.append(LineItem(C["COLL_ISOLA_D160"], "COLLETTORE ISOLA D160", 2))
-            items.append(LineItem(C["TAPPO_ISOLA_D160"], "TAPPO COL.RE FUMI D160", 1))
-            items.append(LineItem(C["TAPPO_ISOLA"], "TAPPO ACCESSORIO ISOLA", 1))
-        elif qty == 4:
-            items.append(LineItem(C["COLL_ISOLA_D160"], "COLLETTORE ISOLA D160", 2))
-        if attacchi[80] > 0:
-            items.append(LineItem(C["ADATT_ISOLA_AT80"], "ADATTATORE ISOLA AT80", attacchi[80]))
-        if attacchi[100] > 0:
-            items.append(LineItem(C["ADATT_ISOLA_AT100"], "ADATTATORE ISOLA AT100", attacchi[100]))
-    else:
-        if qty == 2:
-            items.append(LineItem(C["COLL_ISOLA_D200"], "COLLETTORE ISOLA D200", 1))
-            items.append(LineItem(C["TAPPO_ISOLA_D200"], "TAPPO COL.RE FUMI D200", 1))
-        elif qty == 3:
-            items.append(LineItem(C["COLL_ISOLA_D200"], "COLLETTORE ISOLA D200", 2))
-            items.append(LineItem(C["TAPPO_ISOLA_D200"], "TAPPO COL.RE FUMI D200", 1))
-            items.append(LineItem(C["TAPPO_ISOLA"], "TAPPO ACCESSORIO ISOLA", 1))
-        elif qty == 4:
-            items.append(LineItem(C["COLL_ISOLA_D200"], "COLLETTORE ISOLA D200", 2))
-        if attacchi[80] > 0:
-            items.append(LineItem(C["ADATT_ISOLA_AT80"], "ADATTATORE ISOLA AT80", attacchi[80]))
-        if attacchi[100] > 0:
-            items.append(LineItem(C["ADATT_ISOLA_AT100"], "ADATTATORE ISOLA AT100", attacchi[100]))
-    return items
+FUMI = Decisione("macro", Scelta({
+    "INT_LINEA": Decisione("ptot", Intervalli([
+        ("<=", 160, [_att("KIT_FUMI_D125_AT80", "KIT COL.RE FUMI D125 AT.DN80", "att80"),
+                     Riga("TAPPO_D125", "TAPPO COL.RE FUMI D125")]),
+        ("<=", 260, [_att("KIT_FUMI_D160_AT80", "KIT COL.RE FUMI D160 AT.DN80", "att80"),
+                     _att("KIT_FUMI_D160_AT100", "KIT COL.RE FUMI D160 AT.DN100", "att100"),
+                     Riga("TAPPO_D160", "TAPPO COL.RE FUMI D160")]),
+    ], [_att("KIT_FUMI_D200_AT80", "KIT COL.RE FUMI D200 AT.DN80", "att80"),
+        _att("KIT_FUMI_D200_AT100", "KIT COL.RE FUMI D200 AT.DN100", "att100"),
+        Riga("TAPPO_D200", "TAPPO COL.RE FUMI D200")])),
+    "INT_ISOLA": Decisione("ptot", Intervalli([("<=", 260, _fumi_isola("D160"))], _fumi_isola("D200"))),
+    "ESTERNO": [_att("TERMINALE_D80", "TERMINALE SCARICO D80", "att80"),
+                _att("TERMINALE_D100", "TERMINALE SCARICO D100", "att100")],
+}))
+
+# --- Centraline (qty = caldaie, slave = caldaie - 1) ---
+CENTRALINE = Decisione("centralina", Scelta({
+    "ALPHA": [Riga("ALPHA_MASTER", "ALPHA MASTER CONTROL"),
+              Riga("ALPHA_SLAVE", "ALPHA SLAVE", "slave")],
+    "THETA": [Riga("THETA_KIT", "KIT CENTR. CLIMATICA THETA"),
+              Riga("THETA_IF_OT", "SCHEDA INTERFACCIA OPENTHERM", "qty")],
+    "OMEGA": [Riga("OMEGA_BOX", "OMEGA CONTROL BOX"),
+              Riga("OMEGA_IF_MODBUS_OT", "OMEGA INTERFACCIA MODBUS-OT", "qty")],
+    "MODBUS": [Riga("MODBUS_IF", "SCHEDA INTERF. OT-MODBUS MK/TK", "qty")],
+    "0-10V": [Riga("IF_0_10V", "SCHEDA INTERFAC. 0-10V ENERGY", "qty")],
+}, Errore("Centralina non riconosciuta")))
+
+# --- Esterno: box/pannelli (box = caldaie + moduli per il separatore) ---
+MODULI_BOX_SEPARATORE = Decisione("separatore", Scelta({
+    "NESSUNA": 1,
+    "SSB": Decisione("sottoopzione", Scelta({"KIT_TUBI": 1, "KIT_TUBI_CIRC": 1}, 2)),
+    "SII_PRO": 2,
+    "EQUILIBRATORE": Decisione("sottoopzione", Scelta({"KIT_TUBI": 1}, 2)),
+}, 0))
+
+BOX_ESTERNO = Decisione("macro", Scelta({
+    "ESTERNO": [Riga("BOX_1_MOD_SE", "BOX 1 MODULO ENERGY SE", "box"),
+                Riga("KIT_PANNELLI_BOX_SE", "KIT PANNELLI BOX ENERGY SE")],
+}))
+
+# Distinta cascata: caldaie (da _boiler_lines_cascata) + queste sezioni, in ordine
+CASCATA = [TELAI, COLLETTORI, ACCESSORI, FUMI, CENTRALINE, BOX_ESTERNO]
 
 # =========================
-# Scenari separatore (cascata)
+# DISTINTE - SINGOLE
 # =========================
-def _acc_nessuna(pmax: int, ptot: int) -> List[LineItem]:
-    items = [LineItem(C["KIT_INAIL_ORIZZ"], "KIT INAIL ORIZZONTALE", 1)]
-    items.append(_valvola_inail_cascata(pmax))
-    vcomb = _valvola_interc_comb(ptot)
-    if vcomb: items.append(vcomb)
-    return items
-
-def _acc_ssb(pmax: int, ptot: int, sottoopzione: SottoOpz, ssb_code: Optional[str]) -> List[LineItem]:
-    items: List[LineItem] = []
-    if sottoopzione == "KIT_TUBI":
-        items.append(LineItem(C["KIT_TUBI_SCAMB_DX"], "KIT TUBI SCAMBIATORE BOX DX", 1))
-        items.append(_valvola_inail_cascata(pmax))
-    elif sottoopzione == "KIT_TUBI_CIRC":
-        items.append(LineItem(C["KIT_TUBI_SCAMB_CIRC_DX"], "KIT TUBI SCAMB.-CIRCOL. BOX DX", 1))
-        items.append(_valvola_inail_cascata(pmax))
-        circ = C["CIRC_MAGNA1_50_100"] if ptot < 280 else C["CIRC_MAGNA1_65_150"]
-        items.append(LineItem(circ, "CIRCOLATORE SECONDARIO", 1))
-    else:
-        items.append(LineItem(C["KIT_INAIL_ORIZZ"], "KIT INAIL ORIZZONTALE", 1))
-        items.append(_valvola_inail_cascata(pmax))
-    vcomb = _valvola_interc_comb(ptot)
-    if vcomb: items.append(vcomb)
-    if ssb_code:
-        items.append(LineItem(ssb_code, "SCAMBIATORE SSB SELEZIONATO", 1))
-    return items
-
-def _acc_sii(pmax: int, ptot: int, sii_code: Optional[str]) -> List[LineItem]:
-    items = [LineItem(C["KIT_INAIL_ORIZZ"], "KIT INAIL ORIZZONTALE", 1), _valvola_inail_cascata(pmax)]
-    vcomb = _valvola_interc_comb(ptot)
-    if vcomb: items.append(vcomb)
-    if sii_code:
-        items.append(LineItem(sii_code, "SCAMBIATORE SII PRO SELEZIONATO", 1))
-    return items
-
-def _acc_equil(ptot: int, pmax: int, sottoopzione: SottoOpz) -> List[LineItem]:
-    dn = "DN65" if ptot < 280 else "DN100"
-    items: List[LineItem] = []
-    if sottoopzione == "KIT_TUBI":
-        items.append(LineItem(C[f"EQUIL_{dn}"], f"EQUILIBRATORE BOX {dn}", 1))
-        items.append(LineItem(C[f"KIT_TUBI_EQUIL_{dn}"], f"KIT TUBI EQUILIBRATORE BOX {dn}", 1))
-        items.append(_valvola_inail_cascata(pmax))
-    elif sottoopzione == "KIT_TUBI_CIRC":
-        items.append(LineItem(C[f"EQUIL_{dn}"], f"EQUILIBRATORE BOX {dn}", 1))
-        items.append(LineItem(C[f"KIT_TUBI_EQUIL_CIRC_{dn}"], f"KIT TUBI EQUIL.-CIRC. BOX {dn}", 1))
-        items.append(_valvola_inail_cascata(pmax))
-        circ = C["CIRC_MAGNA1_50_100"] if dn == "DN65" else C["CIRC_MAGNA1_65_150"]
-        items.append(LineItem(circ, "CIRCOLATORE SECONDARIO", 1))
-    else:
-        items.append(LineItem(C["KIT_INAIL_ORIZZ"], "KIT INAIL ORIZZONTALE", 1))
-        items.append(_valvola_inail_cascata(pmax))
-        items.append(LineItem(C[f"EQUIL_{dn}"], f"EQUILIBRATORE BOX {dn}", 1))
-    vcomb = _valvola_interc_comb(ptot)
-    if vcomb: items.append(vcomb)
-    return items
+VALV_2_7_SINGOLA = "VALV_2_7_BAR_1_2\"Fx3_4\"F"
+VALV_4_SINGOLA = "VALV_4_BAR_1_2\"Fx3_4\"F"
+KIT_INAIL_ENERGY = Riga("KIT_INAIL_ENERGY", "KIT INAIL ENERGY")
+BOX_SINGOLA = [Riga("BOX_1_MOD_SE", "BOX 1 MODULO ENERGY SE"),
+               Riga("KIT_PANNELLI_BOX_SE", "KIT PANNELLI BOX ENERGY SE")]
+ESTENSIONE_BOX = Riga("KIT_ESTENSIONE_BOX_SE", "KIT ESTENSIONE BOX MODULO SE")
+
+SSB_INT = {
+    "MK50": [Riga("MK50", "SMILE ENERGY MK 50"),
+             Riga("KIT_TUBI_SCAMB_INT", "KIT TUBI SCAMBIATORE (INT)"),
+             KIT_INAIL_ENERGY,
+             Riga("SSB_55", "SSB 55"),
+             Riga(VALV_2_7_SINGOLA, "VALV. INAIL 2.7 BAR 1/2\"Fx3/4\"F")],
+    "MK70": [Riga("MK70", "SMILE ENERGY MK 70"),
+             Riga("KIT_TUBI_SCAMB_INT", "KIT TUBI SCAMBIATORE (INT)"),
+             KIT_INAIL_ENERGY,
+             Riga("SSB_68", "SSB 68"),
+             Riga(VALV_2_7_SINGOLA, "VALV. INAIL 2.7 BAR 1/2\"Fx3/4\"F")],
+    "MK90": [Riga("MK90", "SMILE ENERGY MK 90"),
+             Riga("KIT_TUBI_SCAMB_INT", "KIT TUBI SCAMBIATORE (INT)"),
+             KIT_INAIL_ENERGY,
+             Riga("SSB_90", "SSB 90"),
+             Riga(VALV_4_SINGOLA, "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")],
+    "MK115": [Riga("MK115", "SMILE ENERGY MK 115"),
+              Riga("KIT_TUBI_SCAMB_INT", "KIT TUBI SCAMBIATORE (INT)"),
+              KIT_INAIL_ENERGY,
+              Riga("SSB_115", "SSB 115"),
+              Riga(VALV_4_SINGOLA, "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")],
+    "MK160SP": [Riga("MK160SP", "SMILE ENERGY MK 160SP"),
+                Riga("KIT_TUBI_SCAMB_INT_160", "KIT TUBI SCAMBIATORE (INT) 160"),
+                Riga("KIT_INAIL_SMILE160_INT", "KIT INAIL SMILE ENERGY 160SP"),
+                Riga("SSB_180", "SSB 180"),
+                Riga(VALV_4_SINGOLA, "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")],
+    "MK160": [Riga("MK160", "SMILE ENERGY MK 160"),
+              Riga("KIT_TUBI_SCAMB_INT_160", "KIT TUBI SCAMBIATORE (INT) 160"),
+              Riga("KIT_INAIL_SMILE160_INT", "KIT INAIL SMILE ENERGY 160"),
+              Riga("SSB_180", "SSB 180"),
+              Riga(VALV_4_SINGOLA, "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")],
+}
 
-# =========================
-# Centraline
-# =========================
-def _centralina_items(centralina: Centralina, qty_cald: int) -> List[LineItem]:
-    if centralina == "ALPHA":
-        return [
-            LineItem(C["ALPHA_MASTER"], "ALPHA MASTER CONTROL", 1),
-            LineItem(C["ALPHA_SLAVE"], "ALPHA SLAVE", max(qty_cald - 1, 0)),
-        ]
-    if centralina == "THETA":
-        return [
-            LineItem(C["THETA_KIT"], "KIT CENTR. CLIMATICA THETA", 1),
-            LineItem(C["THETA_IF_OT"], "SCHEDA INTERFACCIA OPENTHERM", qty_cald),
-        ]
-    if centralina == "OMEGA":
-        return [
-            LineItem(C["OMEGA_BOX"], "OMEGA CONTROL BOX", 1),
-            LineItem(C["OMEGA_IF_MODBUS_OT"], "OMEGA INTERFACCIA MODBUS-OT", qty_cald),
-        ]
-    if centralina == "MODBUS":
-        return [LineItem(C["MODBUS_IF"], "SCHEDA INTERF. OT-MODBUS MK/TK", qty_cald)]
-    if centralina == "0-10V":
-        return [LineItem(C["IF_0_10V"], "SCHEDA INTERFAC. 0-10V ENERGY", qty_cald)]
-    raise ValueError("Centralina non riconosciuta")
+# modello: (caldaia, SSB, kit tubi, kit INAIL, valvola INAIL) per SSB esterno
+SSB_EST = {
+    "MK50": ("MK50", "SSB_55", "KIT_TUBI_SCAMB_INT", "KIT_INAIL_ENERGY", VALV_2_7_SINGOLA),
+    "MK70": ("MK70", "SSB_68", "KIT_TUBI_SCAMB_INT", "KIT_INAIL_ENERGY", VALV_2_7_SINGOLA),
+    "MK90": ("MK90", "SSB_90", "KIT_TUBI_SCAMB_INT", "KIT_INAIL_ENERGY", VALV_4_SINGOLA),
+    "MK115": ("MK115", "SSB_115", "KIT_TUBI_SCAMB_INT", "KIT_INAIL_ENERGY", VALV_4_SINGOLA),
+    "MK160SP": ("MK160SP", "SSB_180", "KIT_TUBI_SCAMB_INT_160", "KIT_INAIL_SMILE160", VALV_4_SINGOLA),
+    "MK160": ("MK160", "SSB_180", "KIT_TUBI_SCAMB_INT_160", "KIT_INAIL_SMILE160", VALV_4_SINGOLA),
+}
 
-# =========================
-# Esterno: terminali + box/pannelli
-# =========================
-def _terminali_esterno(attacchi: Dict[int, int]) -> List[LineItem]:
-    items: List[LineItem] = []
-    if attacchi[80] > 0:
-        items.append(LineItem(C["TERMINALE_D80"], "TERMINALE SCARICO D80", attacchi[80]))
-    if attacchi[100] > 0:
-        items.append(LineItem(C["TERMINALE_D100"], "TERMINALE SCARICO D100", attacchi[100]))
-    return items
+# modello: valvola INAIL per equilibratore (MK 160 / 160SP non ammessi)
+VALVOLA_EQUIL_SINGOLA = {
+    "MK50": VALV_2_7_SINGOLA,
+    "MK70": VALV_2_7_SINGOLA,
+    "MK90": VALV_4_SINGOLA,
+    "MK115": VALV_4_SINGOLA,
+}
 
-def _box_pannelli_esterno(separatore: Separatore, sottoopzione: Optional[SottoOpz], qty_cald: int) -> List[LineItem]:
-    add = 0
-    if separatore == "SII_PRO":
-        add = 2
-    elif separatore == "SSB":
-        add = 1 if sottoopzione in ("KIT_TUBI", "KIT_TUBI_CIRC") else 2
-    elif separatore == "EQUILIBRATORE":
-        add = 1 if sottoopzione == "KIT_TUBI" else 2
-    elif separatore == "NESSUNA":
-        add = 1
-    return [
-        LineItem(C["BOX_1_MOD_SE"], "BOX 1 MODULO ENERGY SE", qty_cald + add),
-        LineItem(C["KIT_PANNELLI_BOX_SE"], "KIT PANNELLI BOX ENERGY SE", 1)
-    ]
+def _nome_singola(m: str) -> str:
+    return f"SMILE ENERGY {m.replace('MK', 'MK ')}"
+
+def _equil_singola(m: str, valvola: str, dove: str) -> list:
+    return [Riga(m, _nome_singola(m)),
+            Riga("EQUIL_SINGOLA", f"EQUILIBRATORE ({dove})"),
+            Riga("KIT_TUBI_EQUIL_SINGOLA", f"KIT TUBI EQUIL ({dove})"),
+            KIT_INAIL_ENERGY,
+            Riga(valvola, "VALV. INAIL"),
+            Riga("ACC_EQUIL_SINGOLA", f"ACCESSORIO EQUIL ({dove})")]
+
+SINGOLE = Decisione("macro", Scelta({
+    "SINGOLO_INT": Decisione("sottocat", Scelta({
+        "SSB": Decisione("modello", Scelta(SSB_INT)),
+        "EQUILIBRATORE": Decisione("modello", Scelta(
+            {
+                "MK160": Errore("Equilibratore non selezionabile per MK 160 / 160SP (singola)."),
+                "MK160SP": Errore("Equilibratore non selezionabile per MK 160 / 160SP (singola)."),
+                **{m: _equil_singola(m, v, "INT") for m, v in VALVOLA_EQUIL_SINGOLA.items()},
+            },
+        )),
+    })),
+    "SINGOLO_EST": Decisione("sottocat", Scelta({
+        "SSB": Decisione("modello", Scelta(
+            {
+                m: [Riga(cald, _nome_singola(m)),
+                    Riga(tubi, "KIT TUBI SCAMB. (EST)"),
+                    Riga(inail, "KIT INAIL"),
+                    Riga(ssb, "SCAMBIATORE SSB"),
+                    Riga(valv, "VALV. INAIL"),
+                    *BOX_SINGOLA,
+                    *([ESTENSIONE_BOX] if m in ("MK160", "MK160SP") else [])]
+                for m, (cald, ssb, tubi, inail, valv) in SSB_EST.items()
+            },
+            Errore("Modello singola non riconosciuto"),
+        )),
+        "EQUILIBRATORE": Decisione("modello", Scelta(
+            {
+                "MK160": Errore("Equilibratore non selezionabile per MK 160 / 160SP (singola esterna)."),
+                "MK160SP": Errore("Equilibratore non selezionabile per MK 160 / 160SP (singola esterna)."),
+                **{m: _equil_singola(m, v, "EST") + BOX_SINGOLA + [ESTENSIONE_BOX]
+                   for m, v in VALVOLA_EQUIL_SINGOLA.items()},
+            },
+            Errore("{modello}", KeyError),      # come le regole originali: modello fuori tabella
+        )),
+    }, Errore("Sottocategoria singola esterna non riconosciuta"))),
+}))
 
 # =========================
 # Helper: caldaie in distinta (cascata)
 # =========================
-def _boiler_lines_cascata(caldaie: Dict[str, int]) -> List[LineItem]:
-    items: List[LineItem] = []
-    for full_name, qty in caldaie.items():
+RigaDistinta = Tuple[str, str, int]      # (codice, nome, qty) prima del merge
+
+def _boiler_lines_cascata(caldaie: Caldaie) -> List[RigaDistinta]:
+    items: List[RigaDistinta] = []
+    for full_name, qty in caldaie:
         if qty <= 0:
             continue
         code = BOILERS_CODE_CASCATA.get(full_name)
         if not code:
             continue
-        items.append(LineItem(code, full_name, qty))
+        items.append((code, full_name, qty))
     return items
 
+def _contesto_cascata(cfg: ConfigInput) -> Dict[str, object]:
+    qty, ptot, pmax, att = _potenze(cfg.caldaie)
+    contesto: Dict[str, object] = {
+        "macro": cfg.macro,
+        "qty": qty,
+        "slave": max(qty - 1, 0),
+        "ptot": ptot,
+        "pmax": pmax,
+        "att80": att[80],
+        "att100": att[100],
+        "separatore": cfg.separatore,
+        "sottoopzione": cfg.sottoopzione or None,
+        "centralina": cfg.centralina,
+        "ssb_code": cfg.ssb_code,
+        "sii_code": cfg.sii_code,
+    }
+    contesto["box"] = qty + valore(MODULI_BOX_SEPARATORE, contesto)
+    return contesto
+
 # =========================
 # GENERATORE DISTINTA
+# ConfigInput è immutabile e hashable: le distinte sono memoizzate (LRU)
 # =========================
+CACHE_DISTINTE_MAX = 4096
+
 def genera_distinta(cfg: ConfigInput) -> List[LineItem]:
+    # Lista nuova a ogni chiamata: il chiamante può modificarla senza toccare la cache
+    # (le righe sono LineItem immutabili, condivise)
+    return list(_distinta_memo(cfg))
+
+@lru_cache(maxsize=CACHE_DISTINTE_MAX)
+def _distinta_memo(cfg: ConfigInput) -> Tuple[LineItem, ...]:
+    with metriche.fase("configuratore.regole"):       # solo i miss della cache
+        return tuple(_genera_distinta(cfg))
+
+def statistiche_cache_distinte() -> Dict[str, float]:
+    info = _distinta_memo.cache_info()
+    totale = info.hits + info.misses
+    return {
+        "voci": info.currsize,
+        "max_voci": info.maxsize,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / totale if totale else 0.0,
+    }
+
+metriche.registra_statistiche("cache_distinte", statistiche_cache_distinte)
+
+def _genera_distinta(cfg: ConfigInput) -> List[LineItem]:
     if cfg.macro in ("INT_LINEA", "INT_ISOLA", "ESTERNO"):
-        if not cfg.caldaie or not cfg.separatore or not cfg.centralina:
+        if cfg.caldaie is None or not cfg.separatore or not cfg.centralina:
             raise ValueError("Per le configurazioni in cascata servono caldaie, separatore e centralina.")
-        qty, ptot, pmax, att = _potenze(cfg.caldaie)
-
-        # Telai & Collettori
-        if cfg.macro == "INT_LINEA":
-            telai = _telai_linea(qty)
-            coll = _collettori_linea(qty)
-        elif cfg.macro == "INT_ISOLA":
-            telai = _telai_isola(qty)
-            coll = _collettori_isola(qty)
-        else:  # ESTERNO -> collettori come interno in linea (richiesta)
-            telai = []
-            coll = _collettori_linea(qty)
-
-        # Accessori per separatore
-        if cfg.separatore == "NESSUNA":
-            acc = _acc_nessuna(pmax, ptot)
-        elif cfg.separatore == "SSB":
-            if not cfg.sottoopzione:
-                raise ValueError("Per SSB serve la sotto-opzione.")
-            acc = _acc_ssb(pmax, ptot, cfg.sottoopzione, cfg.ssb_code)
-        elif cfg.separatore == "SII_PRO":
-            acc = _acc_sii(pmax, ptot, cfg.sii_code)
-        elif cfg.separatore == "EQUILIBRATORE":
-            if not cfg.sottoopzione:
-                raise ValueError("Per EQUILIBRATORE serve la sotto-opzione.")
-            acc = _acc_equil(ptot, pmax, cfg.sottoopzione)
-        else:
-            raise ValueError("Separatore non riconosciuto")
-
-        # Fumi / terminali
-        if cfg.macro == "INT_LINEA":
-            fumi = _fumisteria_linea(ptot, att)
-        elif cfg.macro == "INT_ISOLA":
-            fumi = _fumisteria_isola(ptot, att, qty)
-        else:
-            fumi = _terminali_esterno(att)
-
-        # Centralina
-        centr = _centralina_items(cfg.centralina, qty)
-
-        # Aggiunta: caldaie in distinta per tutte le configurazioni in batteria
-        boilers = _boiler_lines_cascata(cfg.caldaie)
-
-        out = []
-        out += boilers + telai + coll + acc + fumi + centr
+        contesto = _contesto_cascata(cfg)
+        righe = espandi(CASCATA, contesto, C, _riga)
+        # caldaie in distinta per tutte le configurazioni in batteria
+        return _merge_same_code(_boiler_lines_cascata(cfg.caldaie) + righe)
 
-        # Esterno: box/pannelli
-        if cfg.macro == "ESTERNO":
-            out += _box_pannelli_esterno(cfg.separatore, cfg.sottoopzione, qty)
-
-        return _merge_same_code(out)
-
-    # SINGOLE (immutato)
     if cfg.macro in ("SINGOLO_INT", "SINGOLO_EST"):
         if not cfg.singola_modello or not cfg.singola_sottocat:
             raise ValueError("Per le singole servono modello e sottocategoria.")
-        return _distinta_singola(cfg)
+        contesto = {
+            "macro": cfg.macro,
+            "sottocat": cfg.singola_sottocat,
+            "modello": cfg.singola_modello.strip().upper().replace(" ", ""),
+        }
+        return _merge_same_code(espandi(SINGOLE, contesto, C, _riga))
     raise ValueError("Macro configurazione non riconosciuta.")
 
-def _merge_same_code(items: List[LineItem]) -> List[LineItem]:
-    acc: Dict[str, LineItem] = {}
-    ordered: List[str] = []
-    for it in items:
-        if not it.code:
-            continue
-        if it.code not in acc:
-            acc[it.code] = LineItem(it.code, it.name, it.qty)
-            ordered.append(it.code)
-        else:
-            acc[it.code].qty += it.qty
-    return [acc[c] for c in ordered]
+def _riga(code: str, name: str, qty: int) -> RigaDistinta:
+    return (code, name, qty)
 
-# =========================
-# DISTINTE - SINGOLE (immutato)
-# =========================
-def _distinta_singola(cfg: ConfigInput) -> List[LineItem]:
-    m = cfg.singola_modello.strip().upper().replace(" ", "")
-    cat = cfg.singola_sottocat
-
-    def LI(code, name, qty=1): return LineItem(code, name, qty)
-
-    out: List[LineItem] = []
-
-    if cfg.macro == "SINGOLO_INT":
-        if cat == "SSB":
-            if m == "MK50":
-                out = [LI(C["MK50"], "SMILE ENERGY MK 50"),
-                       LI("96870026", "KIT TUBI SCAMBIATORE (INT)"),
-                       LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                       LI("96900326", "SSB 55"),
-                       LI(C["VALV_2_7_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 2.7 BAR 1/2\"Fx3/4\"F")]
-            elif m == "MK70":
-                out = [LI(C["MK70"], "SMILE ENERGY MK 70"),
-                       LI("96870026", "KIT TUBI SCAMBIATORE (INT)"),
-                       LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                       LI("96900327", "SSB 68"),
-                       LI(C["VALV_2_7_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 2.7 BAR 1/2\"Fx3/4\"F")]
-            elif m == "MK90":
-                out = [LI(C["MK90"], "SMILE ENERGY MK 90"),
-                       LI("96870026", "KIT TUBI SCAMBIATORE (INT)"),
-                       LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                       LI("96900328", "SSB 90"),
-                       LI(C["VALV_4_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")]
-            elif m == "MK115":
-                out = [LI(C["MK115"], "SMILE ENERGY MK 115"),
-                       LI("96870026", "KIT TUBI SCAMBIATORE (INT)"),
-                       LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                       LI("96900329", "SSB 115"),
-                       LI(C["VALV_4_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")]
-            elif m == "MK160SP":
-                out = [LI(C["MK160SP"], "SMILE ENERGY MK 160SP"),
-                       LI("96870027", "KIT TUBI SCAMBIATORE (INT) 160"),
-                       LI("96870529", "KIT INAIL SMILE ENERGY 160SP"),
-                       LI("96900331", "SSB 180"),
-                       LI(C["VALV_4_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")]
-            elif m == "MK160":
-                out = [LI(C["MK160"], "SMILE ENERGY MK 160"),
-                       LI("96870027", "KIT TUBI SCAMBIATORE (INT) 160"),
-                       LI("96870529", "KIT INAIL SMILE ENERGY 160"),
-                       LI("96900331", "SSB 180"),
-                       LI(C["VALV_4_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL 4 BAR 1/2\"Fx3/4\"F")]
-
-        elif cat == "EQUILIBRATORE":
-            if m in ("MK160", "MK160SP"):
-                raise ValueError("Equilibratore non selezionabile per MK 160 / 160SP (singola).")
-            base = [
-                ("MK50", C["MK50"], "SMILE ENERGY MK 50", C["VALV_2_7_BAR_1_2\"Fx3_4\"F"]),
-                ("MK70", C["MK70"], "SMILE ENERGY MK 70", C["VALV_2_7_BAR_1_2\"Fx3_4\"F"]),
-                ("MK90", C["MK90"], "SMILE ENERGY MK 90", C["VALV_4_BAR_1_2\"Fx3_4\"F"]),
-                ("MK115", C["MK115"], "SMILE ENERGY MK 115", C["VALV_4_BAR_1_2\"Fx3_4\"F"]),
-            ]
-            for key, code_boiler, name_boiler, valv_code in base:
-                if m == key:
-                    out = [LI(code_boiler, name_boiler),
-                           LI("96870515", "EQUILIBRATORE (INT)"),
-                           LI("96870512", "KIT TUBI EQUIL (INT)"),
-                           LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                           LI(valv_code, "VALV. INAIL"),
-                           LI("96870500", "ACCESSORIO EQUIL (INT)")]
-                    break
-
-    elif cfg.macro == "SINGOLO_EST":
-        if cat == "SSB":
-            base = {
-                "MK50": (C["MK50"], "96900326"),
-                "MK70": (C["MK70"], "96900327"),
-                "MK90": (C["MK90"], "96900328"),
-                "MK115": (C["MK115"], "96900329"),
-                "MK160SP": (C["MK160SP"], "96900331"),
-                "MK160": (C["MK160"], "96900331"),
-            }
-            if m not in base: raise ValueError("Modello singola non riconosciuto")
-            boiler_code, ssb = base[m]
-            out = [LI(boiler_code, f"SMILE ENERGY {m.replace('MK','MK ')}"),
-                   LI("96870026" if m in ("MK50","MK70","MK90","MK115") else "96870027", "KIT TUBI SCAMB. (EST)"),
-                   LI(C["KIT_INAIL_ENERGY"] if m not in ("MK160","MK160SP") else C["KIT_INAIL_SMILE160"], "KIT INAIL"),
-                   LI(ssb, "SCAMBIATORE SSB"),
-                   LI(C["VALV_2_7_BAR_1_2\"Fx3_4\"F"] if m in ("MK50","MK70") else C["VALV_4_BAR_1_2\"Fx3_4\"F"], "VALV. INAIL"),
-                   LI(C["BOX_1_MOD_SE"], "BOX 1 MODULO ENERGY SE"),
-                   LI(C["KIT_PANNELLI_BOX_SE"], "KIT PANNELLI BOX ENERGY SE")]
-            if m in ("MK160","MK160SP"):
-                out.append(LI(C["KIT_ESTENSIONE_BOX_SE"], "KIT ESTENSIONE BOX MODULO SE"))
-        elif cat == "EQUILIBRATORE":
-            if m in ("MK160", "MK160SP"):
-                raise ValueError("Equilibratore non selezionabile per MK 160 / 160SP (singola esterna).")
-            base = {
-                "MK50": (C["MK50"], C["VALV_2_7_BAR_1_2\"Fx3_4\"F"]),
-                "MK70": (C["MK70"], C["VALV_2_7_BAR_1_2\"Fx3_4\"F"]),
-                "MK90": (C["MK90"], C["VALV_4_BAR_1_2\"Fx3_4\"F"]),
-                "MK115": (C["MK115"], C["VALV_4_BAR_1_2\"Fx3_4\"F"]),
-            }
-            boiler_code, valv = base[m]
-            out = [LI(boiler_code, f"SMILE ENERGY {m.replace('MK','MK ')}"),
-                   LI("96870515", "EQUILIBRATORE (EST)"),
-                   LI("96870512", "KIT TUBI EQUIL (EST)"),
-                   LI(C["KIT_INAIL_ENERGY"], "KIT INAIL ENERGY"),
-                   LI(valv, "VALV. INAIL"),
-                   LI("96870500", "ACCESSORIO EQUIL (EST)"),
-                   LI(C["BOX_1_MOD_SE"], "BOX 1 MODULO ENERGY SE"),
-                   LI(C["KIT_PANNELLI_BOX_SE"], "KIT PANNELLI BOX ENERGY SE"),
-                   LI(C["KIT_ESTENSIONE_BOX_SE"], "KIT ESTENSIONE BOX MODULO SE")]
+def _merge_same_code(items: List[RigaDistinta]) -> List[LineItem]:
+    # Si sommano le quantità per codice e si crea un solo LineItem (immutabile) per codice
+    qty: Dict[str, int] = {}
+    nomi: Dict[str, str] = {}
+    for code, name, q in items:
+        if not code:
+            continue
+        if code in qty:
+            qty[code] += q
         else:
-            raise ValueError("Sottocategoria singola esterna non riconosciuta")
-
-    return _merge_same_code(out)
+            qty[code] = q
+            nomi[code] = name
+    return [LineItem(c, nomi[c], q) for c, q in qty.items()]
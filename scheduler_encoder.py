@@ -0,0 +1,175 @@
+from __future__ import annotations
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# =========================
+# Micro-batching delle chiamate all'encoder
+# Le query delle sessioni concorrenti finiscono in una coda; un solo thread
+# prende tutte quelle già in coda e fa UN forward per tutte, poi restituisce
+# a ogni chiamante i suoi vettori. Si aspetta (al più max_attesa_ms, o finché
+# arrivano max_batch testi) solo se altri chiamanti stanno per accodarsi: un
+# utente da solo non paga attese.
+# Un solo thread chiama il modello: i core non sono contesi da più encode
+# piccoli in parallelo e il numero di thread torch è deciso qui.
+# Stessa firma di model.encode: si passa al posto del modello (CacheEmbedding).
+# =========================
+
+
+@dataclass
+class _Richiesta:
+    testi: List[str]
+    futuro: Future
+
+
+class SchedulerEncoder:
+    def __init__(self, model, max_batch: int = 32, max_attesa_ms: float = 5.0,
+                 thread_torch: Optional[int] = None):
+        if max_batch < 1:
+            raise ValueError(f"max_batch deve essere almeno 1 (ricevuto {max_batch})")
+        self.model = model
+        self.max_batch = max_batch
+        self.max_attesa = max_attesa_ms / 1000.0
+        self.thread_torch = thread_torch
+        self.batch = 0
+        self.testi = 0
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._avvia()
+
+    def _avvia(self) -> None:
+        # Anche dopo un fork (preventivo_batch.py): il thread del padre non esiste nel figlio
+        self._pid = os.getpid()
+        self._coda: "queue.SimpleQueue[_Richiesta]" = queue.SimpleQueue()
+        self._in_arrivo = 0                 # richieste entrate in encode e non ancora raccolte
+        self._thread = threading.Thread(target=self._ciclo, name="scheduler-encoder", daemon=True)
+        self._thread.start()
+
+    def encode(self, testi: Sequence[str], **_) -> np.ndarray:
+        testi = list(testi)
+        if not testi:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype="float32")
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._avvia()
+        futuro: Future = Future()
+        with self._lock:
+            self._in_arrivo += 1
+        self._coda.put(_Richiesta(testi, futuro))
+        return futuro.result()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def statistiche(self) -> Dict[str, float]:
+        return {
+            "batch": self.batch,
+            "testi": self.testi,
+            "testi_per_batch": self.testi / self.batch if self.batch else 0.0,
+        }
+
+    # ---- thread dello scheduler ----
+    def _preso(self) -> None:
+        with self._lock:
+            self._in_arrivo -= 1
+
+    def _raccogli(self) -> List[_Richiesta]:
+        prima = self._coda.get()
+        self._preso()
+        lotto, n = [prima], len(prima.testi)
+        scadenza = time.monotonic() + self.max_attesa
+        while n < self.max_batch:
+            try:
+                r = self._coda.get_nowait()          # già in coda: nessuna attesa
+            except queue.Empty:
+                # coda vuota: si aspetta solo chi è entrato in encode e non si è ancora accodato
+                resto = scadenza - time.monotonic()
+                if resto <= 0 or self._in_arrivo <= 0:
+                    break
+                try:
+                    r = self._coda.get(timeout=resto)
+                except queue.Empty:
+                    break
+            self._preso()
+            lotto.append(r)
+            n += len(r.testi)
+        return lotto
+
+    def _ciclo(self) -> None:
+        torch = sys.modules.get("torch")
+        if self.thread_torch and torch is not None:
+            torch.set_num_threads(self.thread_torch)
+        while True:
+            lotto = self._raccogli()
+            # testi uguali da chiamanti diversi: un solo embedding
+            unici: Dict[str, int] = {}
+            for r in lotto:
+                for t in r.testi:
+                    unici.setdefault(t, len(unici))
+            try:
+                vettori = np.asarray(
+                    self.model.encode(list(unici), batch_size=self.max_batch), dtype="float32"
+                )
+            except Exception as e:
+                for r in lotto:
+                    r.futuro.set_exception(e)
+                continue
+            self.batch += 1
+            self.testi += len(unici)
+            for r in lotto:
+                r.futuro.set_result(vettori[[unici[t] for t in r.testi]])
+
+
+# =========================
+# Latenza sotto carico concorrente: encode diretto vs scheduler
+#   python scheduler_encoder.py --utenti 8 --richieste 50
+# =========================
+def _misura(encoder, utenti: int, richieste: int, testi: List[str]) -> np.ndarray:
+    latenze: List[float] = []
+    lock = threading.Lock()
+
+    def utente(u: int) -> None:
+        for i in range(richieste):
+            q = [testi[(u * richieste + i + j) % len(testi)] for j in range(3)]   # ~3 voci per preventivo
+            t = time.perf_counter()
+            encoder.encode(q)
+            with lock:
+                latenze.append((time.perf_counter() - t) * 1000)
+
+    thread = [threading.Thread(target=utente, args=(u,)) for u in range(utenti)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    return np.array(latenze)
+
+
+if __name__ == "__main__":
+    import argparse
+    from encoder import TIPI_ENCODER, crea_encoder, tipo_encoder
+
+    p = argparse.ArgumentParser(description="Latenza p50/p99 dell'encoder con e senza micro-batching")
+    p.add_argument("--utenti", type=int, default=8)
+    p.add_argument("--richieste", type=int, default=50, help="richieste per utente")
+    p.add_argument("--max-batch", type=int, default=32)
+    p.add_argument("--max-attesa-ms", type=float, default=5.0)
+    p.add_argument("--thread-torch", type=int, default=None)
+    p.add_argument("--encoder", choices=TIPI_ENCODER, default=tipo_encoder())
+    args = p.parse_args()
+
+    model = crea_encoder(args.encoder)
+    testi = [f"pompa {i} accumulo {i * 7 % 300} valvola" for i in range(args.utenti * args.richieste * 3)]
+    model.encode(testi[:8])   # riscaldamento
+    scheduler = SchedulerEncoder(model, args.max_batch, args.max_attesa_ms, args.thread_torch)
+    for nome, encoder in (("diretto", model), ("scheduler", scheduler)):
+        lat = _misura(encoder, args.utenti, args.richieste, testi)
+        print(f"{nome:>10}: p50 {np.percentile(lat, 50):.1f} ms  p99 {np.percentile(lat, 99):.1f} ms")
+    print(f"   scheduler: {scheduler.statistiche()}")
@@ -0,0 +1,166 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import metriche
+from motore import MotoreLocale
+from risorse import INTERVALLO_RICARICA_S, get_risorse, sorveglia
+
+# =========================
+# Servizio HTTP/JSON locale del motore dei preventivi
+#   python servizio.py --porta 8765 --thread 8
+#   BALTUR_MOTORE_URL=http://127.0.0.1:8765 streamlit run app.py
+# Un solo modello e un solo indice in memoria, un pool di thread fisso
+# serve le richieste concorrenti (FAISS e l'encoder rilasciano il GIL).
+#   GET  /stato        hash del listino, tipo di indice, statistiche cache e ricarica
+#   GET  /metriche     istogrammi dei tempi per fase e cache, formato testo Prometheus
+#                      (tempi registrati solo con --metriche o BALTUR_METRICHE=1)
+#   POST /cerca        {"descrizione", "k", "modalita"}
+#   POST /distinta     {"cfg": {...ConfigInput}}
+#   POST /preventivo   {"descrizione", "cfg", "sconti", "modalita"}
+# Errori di validazione: 400 {"errore": "..."}.
+# Ogni risposta riporta in "listino" l'hash dell'artefatto usato: con la
+# ricarica a caldo (--ricarica) cambia senza riavviare il servizio.
+# =========================
+MAX_CORPO = 1 << 20
+# Connessioni keep-alive inattive oltre questo tempo si chiudono: altrimenti
+# ogni client fermo terrebbe occupato un thread del pool
+TIMEOUT_CONNESSIONE_S = 30.0
+
+
+class ServerPool(HTTPServer):
+    # Come ThreadingHTTPServer, ma con un pool di dimensione fissa al posto
+    # di un thread per connessione
+
+    def __init__(self, indirizzo, handler, motore: MotoreLocale, thread: int):
+        super().__init__(indirizzo, handler)
+        self.motore = motore
+        self.pool = ThreadPoolExecutor(thread, thread_name_prefix="motore")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._gestisci, request, client_address)
+
+    def _gestisci(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class GestoreMotore(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = TIMEOUT_CONNESSIONE_S
+    server: ServerPool
+
+    def _rispondi(self, codice: int, dati) -> None:
+        try:
+            # allow_nan=False: NaN/Infinity non sono JSON validi per i client non Python
+            corpo = json.dumps(dati, ensure_ascii=False, allow_nan=False)
+        except ValueError as e:
+            self.log_error("risposta non serializzabile su %s: %r", self.path, e)
+            codice, corpo = 500, json.dumps({"errore": "Errore interno del motore"})
+        self._invia(codice, corpo.encode("utf-8"), "application/json; charset=utf-8")
+
+    def _invia(self, codice: int, corpo: bytes, tipo: str) -> None:
+        self.send_response(codice)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        if self.path == "/stato":
+            self._rispondi(200, self.server.motore.stato())
+        elif self.path == "/metriche":
+            self._invia(200, self.server.motore.metriche().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._rispondi(404, {"errore": f"Percorso non trovato: {self.path}"})
+
+    def do_POST(self):
+        motore = self.server.motore
+        azioni = {
+            "/cerca": lambda d: motore.cerca(d.get("descrizione", ""), _leggi_k(d), d.get("modalita", "ibrida")),
+            "/distinta": lambda d: motore.distinta(d.get("cfg")),
+            "/preventivo": lambda d: motore.preventivo(
+                d.get("descrizione", ""), d.get("cfg"), d.get("sconti") or (), d.get("modalita", "ibrida")
+            ),
+        }
+        azione = azioni.get(self.path)
+        if azione is None:
+            self._rispondi(404, {"errore": f"Percorso non trovato: {self.path}"})
+            return
+        lunghezza = int(self.headers.get("Content-Length") or 0)
+        if lunghezza > MAX_CORPO:
+            self._rispondi(413, {"errore": "Richiesta troppo grande"})
+            return
+        try:
+            dati = json.loads(self.rfile.read(lunghezza) or b"{}")
+            if not isinstance(dati, dict):
+                raise ValueError("Il corpo deve essere un oggetto JSON")
+            risultato = azione(dati)
+        except (ValueError, TypeError) as e:       # json.JSONDecodeError è un ValueError
+            self._rispondi(400, {"errore": str(e)})
+        except Exception as e:
+            self.log_error("errore interno su %s: %r", self.path, e)
+            self._rispondi(500, {"errore": "Errore interno del motore"})
+        else:
+            self._rispondi(200, risultato)
+
+    def log_message(self, formato, *args):
+        sys.stderr.write(f"{self.log_date_time_string()} {self.address_string()} {formato % args}\n")
+
+
+def _leggi_k(dati: dict) -> int:
+    # solo interi JSON: 2.5 o "3" sono errori del client, non si convertono
+    k = dati.get("k", 1)
+    if isinstance(k, bool) or not isinstance(k, int):
+        raise ValueError(f"k deve essere un intero JSON: {k!r}")
+    return k
+
+
+def avvia(host: str, porta: int, thread: int, ricarica: float = INTERVALLO_RICARICA_S) -> ServerPool:
+    t0 = time.perf_counter()
+    get_risorse().precarica()
+    sorveglia(ricarica)
+    # senza risorse fissate: ogni richiesta prende la versione in servizio
+    motore = MotoreLocale()
+    server = ServerPool((host, porta), GestoreMotore, motore, thread)
+    print(f"✅ Motore pronto su http://{host}:{server.server_port} "
+          f"({thread} thread, caricamento {time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+    return server
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Servizio HTTP locale del motore dei preventivi")
+    p.add_argument("--host", default="127.0.0.1", help="indirizzo di ascolto")
+    p.add_argument("--porta", type=int, default=8765, help="porta di ascolto")
+    p.add_argument("--thread", type=int, default=8, help="thread del pool che serve le richieste")
+    p.add_argument("--ricarica", type=float, default=INTERVALLO_RICARICA_S or 0,
+                   help="secondi tra due controlli dell'artefatto per la ricarica a caldo (0 = mai)")
+    p.add_argument("--metriche", action="store_true",
+                   help="registra i tempi per fase (log JSON su stderr, GET /metriche)")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    args = parse_args()
+    if args.metriche:
+        metriche.abilita()
+    server = avvia(args.host, args.porta, args.thread, args.ricarica)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,406 @@
+from __future__ import annotations
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import metriche
+import motore_regole
+import rules_configuratore_mk as regole
+from rules_configuratore_mk import BOILERS_POT, ConfigInput, LineItem
+
+# =========================
+# Tabella precalcolata del configuratore SMILE ENERGY MK
+# Tutto lo spazio degli input è finito: la distinta di ogni ConfigInput
+# (o l'errore che solleva) è calcolata una volta e salvata in
+# tabella_configuratore.json.gz, con l'hash del sorgente delle regole
+# (tabelle in rules_configuratore_mk.py + motore in motore_regole.py).
+#   cascate  multiinsiemi di 2-4 caldaie tra i modelli di BOILERS_POT
+#            x 3 macro x 4 separatori x sotto-opzione (o nessuna) x 5 centraline
+#   singole  2 macro x modelli x 2 sottocategorie
+# A runtime genera_distinta è una lookup O(1). Input fuori tabella (codici
+# SSB/SII scritti a mano, modelli sconosciuti) passano alle regole, che
+# restano la fonte di verità.
+# Se uno dei due sorgenti cambia, la tabella si rigenera al primo uso e
+# le differenze rispetto alla precedente vengono stampate (vedi anche __main__).
+# La tabella segue sempre le regole attuali: il confronto con il comportamento
+# originale del configuratore è il golden (verifica_golden, in fondo al file).
+# =========================
+VERSIONE_TABELLA = 1
+PERCORSO_TABELLA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tabella_configuratore.json.gz")
+PERCORSO_GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_configuratore.json.gz")
+
+MACRO_CASCATA = ("INT_LINEA", "INT_ISOLA", "ESTERNO")
+MACRO_SINGOLA = ("SINGOLO_INT", "SINGOLO_EST")
+SEPARATORI = ("NESSUNA", "SSB", "SII_PRO", "EQUILIBRATORE")
+SOTTOOPZIONI = (None, "KIT_TUBI", "KIT_TUBI_CIRC", "NESSUNA")
+CENTRALINE = ("ALPHA", "THETA", "OMEGA", "MODBUS", "0-10V")
+SOTTOCAT_SINGOLA = ("SSB", "EQUILIBRATORE")
+
+Riga = Tuple[str, str, int]                 # LineItem su disco
+Chiave = Tuple
+Esito = Union[Tuple[LineItem, ...], str]    # distinta (righe immutabili) oppure messaggio d'errore
+
+
+def hash_regole() -> str:
+    h = hashlib.sha256()
+    for modulo in (regole, motore_regole):
+        with open(modulo.__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# =========================
+# Chiavi canoniche
+# =========================
+def _modello_singola(modello: str) -> str:
+    # stessa normalizzazione del contesto delle singole in _genera_distinta
+    return modello.strip().upper().replace(" ", "")
+
+
+def chiave(cfg: ConfigInput) -> Optional[Chiave]:
+    # None se l'input è fuori dalla tabella: il risultato delle regole
+    # dipenderebbe da dettagli che la chiave non rappresenta (codici SSB/SII
+    # scritti a mano). Alias e ordine delle caldaie sono già canonizzati da ConfigInput.
+    if cfg.macro in MACRO_CASCATA:
+        if not cfg.caldaie or any(type(q) is not int for _, q in cfg.caldaie):
+            return None
+        if (cfg.separatore == "SSB" and cfg.ssb_code) or (cfg.separatore == "SII_PRO" and cfg.sii_code):
+            return None
+        return ("C", cfg.macro, cfg.caldaie, cfg.separatore, cfg.sottoopzione, cfg.centralina)
+    if cfg.macro in MACRO_SINGOLA:
+        if not isinstance(cfg.singola_modello, str) or not cfg.singola_sottocat:
+            return None
+        return ("S", cfg.macro, _modello_singola(cfg.singola_modello), cfg.singola_sottocat)
+    return None
+
+
+def _chiave_str(k: Chiave) -> str:
+    if k[0] == "C":
+        mix = ",".join(f"{nome}={q}" for nome, q in k[2])
+        return "|".join(["C", k[1], mix, k[3] or "", k[4] or "", k[5] or ""])
+    return "|".join(k)
+
+
+def _chiave_da_str(s: str) -> Chiave:
+    parti = s.split("|")
+    if parti[0] == "C":
+        mix = tuple((nome, int(q)) for nome, q in (p.split("=") for p in parti[2].split(",")))
+        return ("C", parti[1], mix, parti[3] or None, parti[4] or None, parti[5] or None)
+    return tuple(parti)
+
+
+# =========================
+# Enumerazione dello spazio degli input
+# =========================
+def enumera_input():
+    modelli = list(BOILERS_POT)
+    for n in range(regole.MIN_QTY, regole.MAX_QTY + 1):
+        for combo in itertools.combinations_with_replacement(modelli, n):
+            caldaie = {m: combo.count(m) for m in modelli if m in combo}
+            for macro, sep, sotto, centr in itertools.product(MACRO_CASCATA, SEPARATORI, SOTTOOPZIONI, CENTRALINE):
+                yield ConfigInput(macro=macro, caldaie=dict(caldaie), separatore=sep,
+                                  sottoopzione=sotto, centralina=centr)
+    for macro, modello, cat in itertools.product(MACRO_SINGOLA, regole.BOILERS_ALIAS, SOTTOCAT_SINGOLA):
+        yield ConfigInput(macro=macro, singola_modello=modello, singola_sottocat=cat)
+
+
+def costruisci_tabella() -> Dict[Chiave, Esito]:
+    tabella: Dict[Chiave, Esito] = {}
+    for cfg in enumera_input():
+        try:
+            # regole senza memo: l'enumerazione non deve riempire la LRU delle distinte
+            esito: Esito = tuple(regole._genera_distinta(cfg))
+        except ValueError as e:
+            esito = str(e)
+        tabella[chiave(cfg)] = esito
+    return tabella
+
+
+# =========================
+# Persistenza: righe e distinte deduplicate, gzip deterministico
+# =========================
+def salva_tabella(tabella: Dict[Chiave, Esito], percorso: str = PERCORSO_TABELLA,
+                  sorgente: Optional[str] = None) -> None:
+    righe: Dict[Riga, int] = {}
+    distinte: Dict[Tuple[int, ...], int] = {}
+    voci: Dict[str, object] = {}
+    for k, esito in tabella.items():
+        if isinstance(esito, str):
+            voci[_chiave_str(k)] = {"errore": esito}
+            continue
+        ids = tuple(righe.setdefault((it.code, it.name, it.qty), len(righe)) for it in esito)
+        voci[_chiave_str(k)] = distinte.setdefault(ids, len(distinte))
+    dati = {
+        "versione": VERSIONE_TABELLA,
+        "sorgente_regole": sorgente or hash_regole(),
+        "righe": [list(r) for r in righe],
+        "distinte": [list(d) for d in distinte],
+        "voci": voci,
+    }
+    corpo = json.dumps(dati, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    tmp = f"{percorso}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        with gzip.GzipFile(filename="", fileobj=f, mode="wb", mtime=0) as gz:
+            gz.write(corpo)
+    os.replace(tmp, percorso)
+
+
+def leggi_tabella(percorso: str = PERCORSO_TABELLA) -> Tuple[Dict[Chiave, Esito], Optional[str]]:
+    # (tabella, hash delle regole con cui è stata generata); ({}, None) se assente o illeggibile
+    try:
+        with gzip.open(percorso, "rb") as f:
+            dati = json.loads(f.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return {}, None
+    if dati.get("versione") != VERSIONE_TABELLA:
+        return {}, None
+    righe = [LineItem(c, n, q) for c, n, q in dati["righe"]]
+    distinte = [tuple(righe[i] for i in d) for d in dati["distinte"]]
+    tabella: Dict[Chiave, Esito] = {}
+    for s, v in dati["voci"].items():
+        tabella[_chiave_da_str(s)] = v["errore"] if isinstance(v, dict) else distinte[v]
+    return tabella, dati["sorgente_regole"]
+
+
+def differenze(vecchia: Dict[Chiave, Esito], nuova: Dict[Chiave, Esito]) -> Dict[str, List[Chiave]]:
+    return {
+        "aggiunte": [k for k in nuova if k not in vecchia],
+        "rimosse": [k for k in vecchia if k not in nuova],
+        "cambiate": [k for k in nuova if k in vecchia and vecchia[k] != nuova[k]],
+    }
+
+
+def stampa_differenze(diff: Dict[str, List[Chiave]], esempi: int = 5, file=sys.stderr) -> None:
+    print(
+        f"   tabella configuratore: {len(diff['aggiunte'])} aggiunte, "
+        f"{len(diff['rimosse'])} rimosse, {len(diff['cambiate'])} cambiate",
+        file=file,
+    )
+    for tipo, chiavi in diff.items():
+        for k in chiavi[:esempi]:
+            print(f"     {tipo}: {_chiave_str(k)}", file=file)
+
+
+def aggiorna_tabella(percorso: str = PERCORSO_TABELLA, forza: bool = False) -> Dict[Chiave, Esito]:
+    # Rigenera se il sorgente delle regole non è quello della tabella salvata
+    vecchia, sorgente = leggi_tabella(percorso)
+    attuale = hash_regole()
+    if sorgente == attuale and not forza:
+        return vecchia
+    nuova = costruisci_tabella()
+    motivo = "rigenerazione richiesta" if sorgente == attuale else "regole del configuratore cambiate"
+    print(f"🔄 Tabella configuratore rigenerata ({motivo}, {len(nuova)} voci)", file=sys.stderr)
+    stampa_differenze(differenze(vecchia, nuova))
+    try:
+        salva_tabella(nuova, percorso, attuale)
+    except OSError as e:
+        print(f"   tabella non salvata ({e}): resta solo in memoria", file=sys.stderr)
+    return nuova
+
+
+# =========================
+# Lookup a runtime
+# =========================
+_lock = threading.Lock()
+_tabella: Optional[Dict[Chiave, Esito]] = None
+
+
+def get_tabella() -> Dict[Chiave, Esito]:
+    global _tabella
+    if _tabella is None:
+        with _lock:
+            if _tabella is None:
+                _tabella = aggiorna_tabella()
+    return _tabella
+
+
+def genera_distinta(cfg: ConfigInput) -> List[LineItem]:
+    # Stesso contratto di rules_configuratore_mk.genera_distinta (liste nuove a ogni chiamata)
+    with metriche.fase("configuratore.distinta"):
+        k = chiave(cfg)
+        esito = get_tabella().get(k) if k is not None else None
+        if esito is None:
+            return regole.genera_distinta(cfg)
+        if isinstance(esito, str):
+            raise ValueError(esito)
+        return list(esito)
+
+
+def verifica(tabella: Optional[Dict[Chiave, Esito]] = None) -> List[Chiave]:
+    # Chiavi in cui la tabella non coincide con le regole attuali
+    tabella = get_tabella() if tabella is None else tabella
+    return [k for k, esito in costruisci_tabella().items() if tabella.get(k) != esito]
+
+
+# =========================
+# Golden: distinte ed errori del configuratore originale (regole scritte a
+# mano, prima di tabelle e memo) su tutto lo spazio degli input, bordi compresi:
+#   cascate  0-5 caldaie (anche mix tutto a zero, vuoto o assente), nomi
+#            completi e alias, modello sconosciuto, x macro x separatore
+#            (o nessuno) x sotto-opzione x centralina (o nessuna), con codici
+#            SSB/SII vuoti o scritti a mano
+#   singole  nomi completi, alias, varianti di scrittura, modello sconosciuto
+#            o mancante, x macro x sottocategoria (o nessuna)
+#   macro non riconosciuta
+# golden_configuratore.json.gz è generato una volta e NON si rigenera da qui:
+# se le regole cambiano di proposito, il diff di verifica_golden va rivisto e
+# il golden rigenerato a mano dalle regole originali (salva_golden).
+# Il file riporta l'hash dell'enumerazione: cambiarla invalida il golden.
+# Unica differenza voluta: ConfigInput canonizza il mix caldaie (alias -> nomi
+# completi, ordine di BOILERS_POT), quindi per un mix scritto in altro modo
+# l'atteso è il golden del mix canonico (prima gli alias non avevano la riga
+# caldaia in distinta e le caldaie seguivano l'ordine del dict).
+# =========================
+_CODICI_SCAMBIATORE = (None, "", "96900326")        # assente, vuoto, scritto a mano
+_MODELLO_SCONOSCIUTO = "SMILE ENERGY MK 999"
+
+
+def _mix_golden() -> List[Optional[Dict[str, int]]]:
+    modelli = list(BOILERS_POT)
+    alias = {std: a for a, std in regole.BOILERS_ALIAS.items()}
+    mix: List[Optional[Dict[str, int]]] = [None, {m: 0 for m in modelli}]      # {} arriva da n = 0
+    for n in range(0, regole.MAX_QTY + 2):
+        for combo in itertools.combinations_with_replacement(modelli, n):
+            caldaie = {m: combo.count(m) for m in modelli if m in combo}
+            mix.append(caldaie)
+            if regole.MIN_QTY <= n <= regole.MAX_QTY:
+                mix.append({alias[m]: q for m, q in caldaie.items()})
+                mix.append(dict(reversed(caldaie.items())))
+    primo, secondo = modelli[0], modelli[-1]
+    mix += [
+        {primo: 1, alias[primo]: 1},                        # stesso modello con due nomi
+        {primo: 0, secondo: 2},                             # quantità a zero nel mix
+        {_MODELLO_SCONOSCIUTO: 2},
+        {primo: 1, _MODELLO_SCONOSCIUTO: 1},
+    ]
+    return mix
+
+
+def input_golden():
+    # kwargs di ConfigInput, in un ordine fisso (il golden è allineato a questo)
+    for caldaie in _mix_golden():
+        for macro, sep, sotto, centr in itertools.product(
+            MACRO_CASCATA, SEPARATORI + (None,), SOTTOOPZIONI, CENTRALINE + (None,)
+        ):
+            codici = {"SSB": "ssb_code", "SII_PRO": "sii_code"}.get(sep)
+            for codice in _CODICI_SCAMBIATORE if codici else (None,):
+                cfg = {"macro": macro, "caldaie": None if caldaie is None else dict(caldaie),
+                       "separatore": sep, "sottoopzione": sotto, "centralina": centr}
+                if codici and codice is not None:
+                    cfg[codici] = codice
+                yield cfg
+    modelli = list(regole.BOILERS_ALIAS.values()) + list(regole.BOILERS_ALIAS)
+    modelli += [m.lower().replace(" ", "") for m in regole.BOILERS_ALIAS] + [f" {m} " for m in regole.BOILERS_ALIAS]
+    modelli += ["MK 999", "", None]
+    for macro, modello, cat in itertools.product(MACRO_SINGOLA, modelli, SOTTOCAT_SINGOLA + (None,)):
+        yield {"macro": macro, "singola_modello": modello, "singola_sottocat": cat}
+    yield {"macro": "ALTRO", "caldaie": {modelli[0]: 2}, "separatore": "NESSUNA", "centralina": "ALPHA"}
+
+
+def _chiave_input(cfg: dict) -> str:
+    # l'ordine delle caldaie conta (sort_keys lo perderebbe)
+    caldaie = cfg.get("caldaie")
+    return json.dumps([sorted((k, v) for k, v in cfg.items() if k != "caldaie"),
+                       None if caldaie is None else list(caldaie.items())])
+
+
+def _hash_input_golden() -> str:
+    h = hashlib.sha256()
+    for cfg in input_golden():
+        h.update(_chiave_input(cfg).encode("utf-8") + b"\n")
+    return h.hexdigest()
+
+
+def _esito(genera, cfg) -> Union[List[Riga], str]:
+    # righe, o messaggio d'errore (con il tipo, se non è un ValueError)
+    try:
+        return [(it.code, it.name, it.qty) for it in genera(cfg)]
+    except ValueError as e:
+        return str(e)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def salva_golden(genera, config_input, percorso: str = PERCORSO_GOLDEN) -> int:
+    # genera/config_input: funzione e classe del configuratore di riferimento
+    esiti: Dict[str, int] = {}
+    sequenza = []
+    for cfg in input_golden():
+        esito = _esito(genera, config_input(**cfg))
+        chiave_esito = json.dumps({"errore": esito} if isinstance(esito, str) else esito, ensure_ascii=False)
+        sequenza.append(esiti.setdefault(chiave_esito, len(esiti)))
+    dati = {"input": _hash_input_golden(), "esiti": [json.loads(e) for e in esiti], "sequenza": sequenza}
+    corpo = json.dumps(dati, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    with open(percorso, "wb") as f:
+        with gzip.GzipFile(filename="", fileobj=f, mode="wb", mtime=0) as gz:
+            gz.write(corpo)
+    return len(sequenza)
+
+
+def _gemello_canonico(cfg: dict) -> Optional[str]:
+    # Input con lo stesso mix in forma canonica, se diverso da quello dato
+    caldaie = cfg.get("caldaie")
+    if not caldaie or any(regole._norm_boiler_name(nome) not in BOILERS_POT for nome in caldaie):
+        return None
+    canonico = dict(regole.canonizza_caldaie(caldaie) or ())
+    if not canonico or list(canonico.items()) == list(caldaie.items()):
+        return None
+    return _chiave_input(dict(cfg, caldaie=canonico))
+
+
+def verifica_golden(genera=None, percorso: str = PERCORSO_GOLDEN) -> Tuple[int, List[Tuple[dict, object, object]]]:
+    # (input confrontati, [(input, atteso, ottenuto)]) per genera_distinta (default: quella della tabella)
+    genera = genera_distinta if genera is None else genera
+    with gzip.open(percorso, "rb") as f:
+        dati = json.loads(f.read().decode("utf-8"))
+    if dati["input"] != _hash_input_golden() or len(dati["sequenza"]) != sum(1 for _ in input_golden()):
+        raise ValueError("Enumerazione degli input cambiata: il golden non corrisponde più agli input")
+    attesi = [e["errore"] if isinstance(e, dict) else [tuple(r) for r in e] for e in dati["esiti"]]
+    gemelli = {cfg_str: g for cfg_str, g in (
+        (_chiave_input(cfg), _gemello_canonico(cfg)) for cfg in input_golden()
+    ) if g is not None}
+    richiesti = set(gemelli.values())
+    esito_di = {
+        cfg_str: i for cfg_str, i in (
+            (_chiave_input(cfg), i) for cfg, i in zip(input_golden(), dati["sequenza"])
+        ) if cfg_str in richiesti
+    }
+    diverse = []
+    n = 0
+    for n, (cfg, i) in enumerate(zip(input_golden(), dati["sequenza"]), start=1):
+        gemello = gemelli.get(_chiave_input(cfg))
+        atteso = attesi[esito_di[gemello] if gemello is not None else i]
+        ottenuto = _esito(genera, ConfigInput(**cfg))
+        if ottenuto != atteso:
+            diverse.append((cfg, atteso, ottenuto))
+    return n, diverse
+
+
+if __name__ == "__main__":
+    # python tabella_configuratore.py            rigenera se le regole sono cambiate
+    # python tabella_configuratore.py --forza    rigenera comunque e mostra le differenze
+    # python tabella_configuratore.py --verifica confronta la tabella con le regole
+    # python tabella_configuratore.py --verifica-golden
+    #                                            confronta tabella e regole con il golden
+    if "--verifica-golden" in sys.argv:
+        esito = 0
+        for nome, genera in (("tabella", genera_distinta), ("regole", regole.genera_distinta)):
+            n, diverse = verifica_golden(genera)
+            print(f"{'✅' if not diverse else '❌'} {nome}: {n} input, {len(diverse)} diversi dal golden")
+            for cfg, atteso, ottenuto in diverse[:5]:
+                print(f"     {cfg}\n       atteso:   {atteso}\n       ottenuto: {ottenuto}")
+            esito = esito or (1 if diverse else 0)
+        sys.exit(esito)
+    if "--verifica" in sys.argv:
+        tabella, _ = leggi_tabella()
+        diverse = verifica(tabella)
+        print(f"{'✅' if not diverse else '❌'} {len(tabella)} voci, {len(diverse)} diverse dalle regole")
+        sys.exit(1 if diverse else 0)
+    t = aggiorna_tabella(forza="--forza" in sys.argv)
+    errori = sum(isinstance(v, str) for v in t.values())
+    print(f"✅ Tabella configuratore: {len(t)} voci ({len(t) - errori} distinte, {errori} combinazioni non valide)")